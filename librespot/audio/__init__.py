@@ -3,7 +3,7 @@ from librespot import util
 from librespot.audio.decrypt import AesAudioDecrypt
 from librespot.audio.format import SuperAudioFormat
 from librespot.audio.storage import ChannelManager
-from librespot.cache import CacheManager
+from librespot.cache import AudioKeyCache, CacheManager
 from librespot.crypto import Packet
 from librespot.metadata import EpisodeId, PlayableId, TrackId
 from librespot.proto import Metadata_pb2 as Metadata, StorageResolve_pb2 as StorageResolve
@@ -13,6 +13,8 @@ import concurrent.futures
 import io
 import logging
 import math
+import mmap
+import os
 import queue
 import random
 import struct
@@ -20,8 +22,8 @@ import threading
 import time
 import typing
 import urllib.parse
+import weakref
 
-lock = threading.Lock()
 reading_pending = 0
 
 if typing.TYPE_CHECKING:
@@ -34,39 +36,71 @@ class KeyUnavailableError(Exception):
     """Raised when the requested stream is unavailable from the API."""
     pass
 
-class AbsChunkedInputStream(io.BytesIO, HaltListener):
+class AbsChunkedInputStream(io.RawIOBase, HaltListener):
+    """Seekable raw binary stream over the chunks of a file
+
+    Follows the io.RawIOBase protocol, so it can be wrapped in an
+    io.BufferedReader or passed to anything that expects a file object.
+    Reads block until the bytes they cover have been downloaded.
+    """
     chunk_exception = None
-    closed = False
     max_chunk_tries = 128
     preload_ahead = 3
     preload_chunk_retries = 2
+    read_ahead: AbsChunkedInputStream.ReadAhead
     retries: typing.List[int]
     retry_on_chunk_error: bool
-    wait_lock: threading.Condition = threading.Condition()
+    wait_lock: threading.Condition
     wait_for_chunk = -1
     __decoded_length = 0
     __mark = 0
     __pos = 0
 
-    def __init__(self, retry_on_chunk_error: bool):
+    def __init__(self,
+                 retry_on_chunk_error: bool,
+                 prepare: bool = True,
+                 read_ahead: AbsChunkedInputStream.ReadAhead = None):
         super().__init__()
-        self.retries = [0] * self.chunks()
+        self.read_ahead = AbsChunkedInputStream.ReadAhead(
+            self.preload_ahead,
+            self.preload_ahead) if read_ahead is None else read_ahead
+        self.wait_lock = threading.Condition()
+        self.retries = []
         self.retry_on_chunk_error = retry_on_chunk_error
+        if prepare:
+            self.prepare()
+
+    def prepare(self) -> None:
+        """Set up the per chunk state once the size of the stream is known"""
+        self.retries = [0] * self.chunks()
 
     def is_closed(self) -> bool:
         return self.closed
 
-    def buffer(self) -> typing.List[bytes]:
+    def buffer(self) -> memoryview:
+        """Decrypted content of the whole stream, valid where chunks are
+        available"""
         raise NotImplementedError()
 
+    def head(self) -> bytes:
+        """Decrypted start of the stream, readable before any chunk"""
+        return b""
+
     def size(self) -> int:
         raise NotImplementedError()
 
     def close(self) -> None:
-        self.closed = True
+        super().close()
+        self.read_ahead.close()
         with self.wait_lock:
             self.wait_lock.notify_all()
 
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
     def available(self):
         return self.size() - self.__pos
 
@@ -82,25 +116,45 @@ class AbsChunkedInputStream(io.BytesIO, HaltListener):
     def pos(self) -> int:
         return self.__pos
 
-    def seek(self, where: int, **kwargs) -> None:
-        if where < 0:
-            raise TypeError()
+    def tell(self) -> int:
         if self.closed:
-            raise IOError("Stream is closed!")
+            raise ValueError("Stream is closed!")
+        return self.__pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if self.closed:
+            raise ValueError("Stream is closed!")
+        if whence == io.SEEK_SET:
+            where = offset
+        elif whence == io.SEEK_CUR:
+            where = self.__pos + offset
+        elif whence == io.SEEK_END:
+            where = self.size() + offset
+        else:
+            raise ValueError("Invalid whence: {}".format(whence))
+        if where < 0:
+            raise ValueError("Negative seek position: {}".format(where))
         self.__pos = where
-        self.check_availability(int(self.__pos / (128 * 1024)), False, False)
+        if len(self.head()) <= where < self.size():
+            self.check_availability(int(where / ChannelManager.chunk_size),
+                                    False, False)
+        return where
 
     def skip(self, n: int) -> int:
         if n < 0:
             raise TypeError()
         if self.closed:
-            raise IOError("Stream is closed!")
-        k = self.size() - self.__pos
+            raise ValueError("Stream is closed!")
+        if self.__pos + n < len(self.head()):
+            self.__pos += n
+            return n
+        k = max(0, self.size() - self.__pos)
         if n < k:
             k = n
         self.__pos += k
-        chunk = int(self.__pos / (128 * 1024))
-        self.check_availability(chunk, False, False)
+        if self.__pos < self.size():
+            self.check_availability(
+                int(self.__pos / ChannelManager.chunk_size), False, False)
         return k
 
     def requested_chunks(self) -> typing.List[bool]:
@@ -109,6 +163,11 @@ class AbsChunkedInputStream(io.BytesIO, HaltListener):
     def available_chunks(self) -> typing.List[bool]:
         raise NotImplementedError()
 
+    def chunk_progress(self) -> typing.List[int]:
+        """Decrypted bytes present in each chunk, readable before the chunk
+        is complete"""
+        raise NotImplementedError()
+
     def chunks(self) -> int:
         raise NotImplementedError()
 
@@ -122,28 +181,41 @@ class AbsChunkedInputStream(io.BytesIO, HaltListener):
             return False
         return self.retry_on_chunk_error
 
-    def check_availability(self, chunk: int, wait: bool, halted: bool) -> None:
+    def check_availability(self,
+                           chunk: int,
+                           wait: bool,
+                           halted: bool,
+                           end: int = None) -> None:
+        """Request a chunk and the ones after it, optionally waiting for it
+
+        :param end: Offset in the chunk up to which bytes are needed, the
+            whole chunk if None
+
+        """
         if halted and not wait:
             raise TypeError()
         if not self.requested_chunks()[chunk]:
-            self.request_chunk_from_stream(chunk)
-            self.requested_chunks()[chunk] = True
-        for i in range(chunk + 1,
-                       min(self.chunks() - 1, chunk + self.preload_ahead) + 1):
-            if (self.requested_chunks()[i]
-                    and self.retries[i] < self.preload_chunk_retries):
-                self.request_chunk_from_stream(i)
-                self.requested_chunks()[chunk] = True
+            self.read_ahead.request(self, chunk)
+        self.read_ahead.advance(self, chunk)
         if wait:
-            if self.available_chunks()[chunk]:
+
+            def present() -> bool:
+                return self.available_chunks()[chunk] or (
+                    end is not None and self.chunk_progress()[chunk] >= end)
+
+            if present():
+                self.read_ahead.hits += 1
                 return
+            self.read_ahead.stall()
             retry = False
             with self.wait_lock:
                 if not halted:
                     self.stream_read_halted(chunk, int(time.time() * 1000))
                 self.chunk_exception = None
                 self.wait_for_chunk = chunk
-                self.wait_lock.wait_for(lambda: self.available_chunks()[chunk])
+                self.wait_lock.wait_for(lambda: self.closed or self.
+                                        chunk_exception is not None or
+                                        present())
                 if self.closed:
                     return
                 if self.chunk_exception is not None:
@@ -155,63 +227,67 @@ class AbsChunkedInputStream(io.BytesIO, HaltListener):
                     self.stream_read_halted(chunk, int(time.time() * 1000))
             if retry:
                 time.sleep(math.log10(self.retries[chunk]))
-                self.check_availability(chunk, True, True)
+                self.check_availability(chunk, True, True, end)
+
+    def read(self, size: typing.Union[int, None] = -1) -> bytes:
+        return bytes(self.read_view(size))
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, b) -> int:
+        target = memoryview(b).cast("B")
+        view = self.read_view(len(target))
+        target[:len(view)] = view
+        return len(view)
+
+    def read_view(self, size: typing.Union[int, None] = -1) -> memoryview:
+        """Read like read() without copying
 
-    def read(self, __size: int = 0) -> bytes:
+        The view points into the buffer of the stream and must not be used
+        after the stream is closed.
+        """
         if self.closed:
-            raise IOError("Stream is closed!")
-        if __size <= 0:
-            if self.__pos == self.size():
-                return b""
-            buffer = io.BytesIO()
-            total_size = self.size()
-            chunk = int(self.__pos / (ChannelManager.chunk_size))
-            chunk_off = int(self.__pos % (ChannelManager.chunk_size))
-            chunk_total = int(math.ceil(total_size / (ChannelManager.chunk_size)))
-            self.check_availability(chunk, True, False)
-            buffer.write(self.buffer()[chunk][chunk_off:])
-            chunk += 1
-            if chunk != chunk_total:
-                while chunk <= chunk_total - 1:
-                    self.check_availability(chunk, True, False)
-                    buffer.write(self.buffer()[chunk])
-                    chunk += 1
-            buffer.seek(0)
-            self.__pos += buffer.getbuffer().nbytes
-            return buffer.read()
-        buffer = io.BytesIO()
-        chunk = int(self.__pos / (ChannelManager.chunk_size))
-        chunk_off = int(self.__pos % (ChannelManager.chunk_size))
-        chunk_end = int(__size / (ChannelManager.chunk_size))
-        chunk_end_off = int(__size % (ChannelManager.chunk_size))
-        if chunk_end > self.size():
-            chunk_end = int(self.size() / (ChannelManager.chunk_size))
-            chunk_end_off = int(self.size() % (ChannelManager.chunk_size))
-        self.check_availability(chunk, True, False)
-        if chunk_off + __size > len(self.buffer()[chunk]):
-            buffer.write(self.buffer()[chunk][chunk_off:])
-            chunk += 1
-            while chunk <= chunk_end:
-                self.check_availability(chunk, True, False)
-                if chunk == chunk_end:
-                    buffer.write(self.buffer()[chunk][:chunk_end_off])
-                else:
-                    buffer.write(self.buffer()[chunk])
-                chunk += 1
-        else:
-            buffer.write(self.buffer()[chunk][chunk_off:chunk_off + __size])
-        buffer.seek(0)
-        self.__pos += buffer.getbuffer().nbytes
-        return buffer.read()
+            raise ValueError("Stream is closed!")
+        if size == 0:
+            return memoryview(b"")
+        head = self.head()
+        if size is not None and 0 < size and \
+                self.__pos + size <= len(head):
+            start = self.__pos
+            self.__pos += size
+            return memoryview(head)[start:self.__pos]
+        total_size = self.size()
+        if self.__pos >= total_size:
+            return memoryview(b"")
+        if size is None or size < 0 or self.__pos + size > total_size:
+            size = total_size - self.__pos
+        start = self.__pos
+        end = self.__pos + size
+        while self.__pos < end:
+            chunk = int(self.__pos / ChannelManager.chunk_size)
+            chunk_start = chunk * ChannelManager.chunk_size
+            chunk_end = min(end - chunk_start, ChannelManager.chunk_size)
+            self.check_availability(chunk, True, False, chunk_end)
+            if self.closed:
+                raise ValueError("Stream is closed!")
+            self.__pos = chunk_start + chunk_end
+        return self.buffer()[start:end]
 
     def notify_chunk_available(self, index: int) -> None:
+        self.read_ahead.chunk_available(index)
         self.available_chunks()[index] = True
-        self.__decoded_length += len(self.buffer()[index])
+        self.__decoded_length += self.chunk_progress()[index]
         with self.wait_lock:
             if index == self.wait_for_chunk and not self.closed:
                 self.wait_for_chunk = -1
                 self.wait_lock.notify_all()
 
+    def notify_chunk_progress(self, index: int) -> None:
+        with self.wait_lock:
+            if index == self.wait_for_chunk and not self.closed:
+                self.wait_lock.notify_all()
+
     def notify_chunk_error(self, index: int, ex):
         self.available_chunks()[index] = False
         self.requested_chunks()[index] = False
@@ -232,23 +308,144 @@ class AbsChunkedInputStream(io.BytesIO, HaltListener):
             return AbsChunkedInputStream \
                 .ChunkException("Failed due to stream error, code: {}".format(stream_error))
 
+    class ReadAhead:
+        """Sliding window of chunks requested ahead of the reader
+
+        The window starts at min_window chunks. It grows to cover the chunks
+        the reader consumes while one chunk downloads, and by one chunk after
+        every stall, up to max_window. While the read-ahead of all streams
+        together exceeds memory_budget bytes, it falls back to min_window.
+        """
+        alpha = 0.3
+        hits = 0
+        max_window: int
+        memory_budget: int
+        min_window: int
+        requests = 0
+        stalls = 0
+        window: int
+        __ahead = 0
+        __ahead_bytes = 0
+        __ahead_lock = threading.Lock()
+        __chunk = -1
+        __chunk_time = 0.0
+        __fetch_time = 0.0
+        __interval = 0.0
+        __requested_at: typing.Dict[int, float]
+        __stall_window: int
+
+        def __init__(self,
+                     min_window: int,
+                     max_window: int,
+                     memory_budget: int = 0):
+            self.max_window = max(min_window, max_window)
+            self.memory_budget = memory_budget
+            self.min_window = min_window
+            self.window = min_window
+            self.__requested_at = {}
+            self.__stall_window = min_window
+
+        def advance(self, stream: AbsChunkedInputStream, chunk: int) -> None:
+            """Request the chunks of the window after the read position"""
+            now = time.monotonic()
+            if chunk != self.__chunk:
+                if chunk == self.__chunk + 1:
+                    self.__interval = self.__average(self.__interval,
+                                                     now - self.__chunk_time)
+                self.__chunk = chunk
+                self.__chunk_time = now
+            self.window = self.__target()
+            requested = stream.requested_chunks()
+            last = min(stream.chunks() - 1, chunk + self.window)
+            for i in range(chunk + 1, last + 1):
+                if (not requested[i]
+                        and stream.retries[i] < stream.preload_chunk_retries):
+                    self.request(stream, i)
+            self.__account(sum(requested[chunk + 1:last + 1]))
+
+        def chunk_available(self, index: int) -> None:
+            requested_at = self.__requested_at.pop(index, None)
+            if requested_at is not None:
+                self.__fetch_time = self.__average(
+                    self.__fetch_time,
+                    time.monotonic() - requested_at)
+
+        def close(self) -> None:
+            self.__account(0)
+
+        def request(self, stream: AbsChunkedInputStream, index: int) -> None:
+            self.requests += 1
+            self.__requested_at[index] = time.monotonic()
+            stream.request_chunk_from_stream(index)
+            stream.requested_chunks()[index] = True
+
+        def stall(self) -> None:
+            self.stalls += 1
+            self.__stall_window = min(self.max_window,
+                                      self.__stall_window + 1)
+
+        def __account(self, ahead: int) -> None:
+            with AbsChunkedInputStream.ReadAhead.__ahead_lock:
+                AbsChunkedInputStream.ReadAhead.__ahead_bytes += \
+                    (ahead - self.__ahead) * ChannelManager.chunk_size
+                self.__ahead = ahead
+
+        def __average(self, average: float, sample: float) -> float:
+            if average == 0:
+                return sample
+            return (1 - self.alpha) * average + self.alpha * sample
+
+        def __target(self) -> int:
+            if (self.memory_budget > 0 and AbsChunkedInputStream.ReadAhead.
+                    __ahead_bytes > self.memory_budget):
+                return self.min_window
+            window = self.__stall_window
+            if self.__interval > 0 and self.__fetch_time > 0:
+                window = max(window,
+                             math.ceil(self.__fetch_time / self.__interval) + 1)
+            return max(self.min_window, min(self.max_window, window))
+
+        def __str__(self) -> str:
+            return "requests: {}, hits: {}, stalls: {}, window: {}".format(
+                self.requests, self.hits, self.stalls, self.window)
+
 
 class AudioKeyManager(PacketsReceiver, Closeable):
     audio_key_request_timeout = 20
     logger = logging.getLogger("Librespot:AudioKeyManager")
-    __callbacks: typing.Dict[int, Callback] = {}
-    __seq_holder = 0
-    __seq_holder_lock = threading.Condition()
+    __cache: typing.Union[AudioKeyCache, None]
+    __callbacks: typing.Dict[int, Callback]
+    __pending: typing.Dict[typing.Tuple[bytes, bytes],
+                           concurrent.futures.Future]
+    __seq_holder: int
+    __seq_holder_lock: threading.Condition
     __session: Session
     __zero_short = b"\x00\x00"
 
     def __init__(self, session: Session):
+        conf = session.configuration()
+        self.__cache = None
+        if conf.audio_key_cache_size > 0:
+            self.__cache = AudioKeyCache(
+                conf.audio_key_cache_size, conf.audio_key_cache_ttl,
+                session.username(),
+                os.path.join(conf.cache_dir, "audio-keys")
+                if conf.cache_enabled else None,
+                conf.audio_key_cache_disk_size,
+                None if conf.stored_credentials_file is None else
+                os.path.join(os.path.dirname(conf.stored_credentials_file),
+                             "audio-keys.key"))
+        self.__callbacks = {}
+        self.__pending = {}
+        self.__seq_holder = 0
+        self.__seq_holder_lock = threading.Condition()
         self.__session = session
 
     def dispatch(self, packet: Packet) -> None:
         payload = io.BytesIO(packet.payload)
         seq = struct.unpack(">i", payload.read(4))[0]
-        callback = self.__callbacks.get(seq)
+        self.__session.in_flight().complete(("audio-key", seq))
+        callback = self.__callbacks.pop(seq, None)
         if callback is None:
             self.logger.warning(
                 "Couldn't find callback for seq: {}".format(seq))
@@ -263,39 +460,142 @@ class AudioKeyManager(PacketsReceiver, Closeable):
             self.logger.warning(
                 "Couldn't handle packet, cmd: {}, length: {}".format(
                     packet.cmd, len(packet.payload)))
+
+    def cache(self) -> typing.Union[AudioKeyCache, None]:
+        return self.__cache
+
+    def cached_audio_key(self, gid: bytes,
+                         file_id: bytes) -> typing.Union[bytes, None]:
+        """Look a key up in the audio key cache without requesting it
+
+        :returns: The key, None if it isn't cached or the cache is disabled
+
+        """
+        if self.__cache is None:
+            return None
+        return self.__cache.get(gid, file_id)
+
     def get_audio_key(self, gid: bytes, file_id: bytes, retry: bool = True) -> bytes:
-        global reading_pending 
+        key = self.cached_audio_key(gid, file_id)
+        if key is not None:
+            return key
+        return self.request_audio_key(gid, file_id, retry)
+
+    def request_audio_key(self,
+                          gid: bytes,
+                          file_id: bytes,
+                          retry: bool = True) -> bytes:
+        """Request a key from the AP without looking it up in the cache
+
+        For callers that already missed in cached_audio_key.
+
+        """
+        global reading_pending
         reading_pending += 1
-        with lock:
-             key = self.audio_key(gid, file_id, retry = True)
-             reading_pending -= 1
-             return key
-    
+        try:
+            return self.audio_key(gid, file_id, retry)
+        finally:
+            reading_pending -= 1
+
+    def get_audio_keys(
+        self, files: typing.List[typing.Tuple[bytes, bytes]]
+    ) -> typing.List[bytes]:
+        """Request the keys of several files at once
+
+        All the requests are sent before waiting, so the keys arrive
+        within about one round trip.
+
+        :param files: (gid, file_id) pairs
+        :returns: Keys in the order of files
+
+        """
+        futures = []
+        for gid, file_id in files:
+            key = self.cached_audio_key(gid, file_id)
+            if key is None:
+                future = self.audio_key_async(gid, file_id)
+            else:
+                future = concurrent.futures.Future()
+                future.set_result(key)
+            futures.append((gid, file_id, future))
+        return [
+            self.__await_key(gid, file_id, future, True)
+            for gid, file_id, future in futures
+        ]
+
     def audio_key(self,
                       gid: bytes,
                       file_id: bytes,
                       retry: bool = True) -> bytes:
-        seq: int
+        return self.__await_key(gid, file_id,
+                                self.audio_key_async(gid, file_id), retry)
+
+    def audio_key_async(self, gid: bytes,
+                        file_id: bytes) -> concurrent.futures.Future[bytes]:
+        """Send a key request without waiting for the answer
+
+        A request for a (gid, file_id) pair that is still pending returns
+        the same future, once that one is done a new request is sent.
+
+        :returns: Future of the key, failing with KeyUnavailableError
+
+        """
         with self.__seq_holder_lock:
+            future = self.__pending.get((gid, file_id))
+            if future is not None and not future.done():
+                return future
+            future = concurrent.futures.Future()
+            self.__pending[(gid, file_id)] = future
             seq = self.__seq_holder
             self.__seq_holder += 1
+            self.__callbacks[seq] = AudioKeyManager.FutureCallback(
+                self, future)
         out = io.BytesIO()
         out.write(file_id)
         out.write(gid)
         out.write(struct.pack(">i", seq))
         out.write(self.__zero_short)
         out.seek(0)
-        self.__session.send(Packet.Type.request_key, out.read())
-        callback = AudioKeyManager.SyncCallback(self)
-        self.__callbacks[seq] = callback
-        key = callback.wait_response()
-        if key is None:
+        payload = out.read()
+
+        def expire() -> None:
+            util.settle_future(
+                future,
+                exception=KeyUnavailableError(
+                    "Audio key request timed out! gid: {}, fileId: {}".format(
+                        util.bytes_to_hex(gid), util.bytes_to_hex(file_id))))
+
+        timer = util.TimerWheel.instance().schedule(
+            self.audio_key_request_timeout, expire)
+
+        def done(_) -> None:
+            timer.cancel()
+            self.__session.in_flight().complete(("audio-key", seq))
+            with self.__seq_holder_lock:
+                self.__callbacks.pop(seq, None)
+                if self.__pending.get((gid, file_id)) is future:
+                    del self.__pending[(gid, file_id)]
+            if (self.__cache is not None and not future.cancelled()
+                    and future.exception() is None):
+                self.__cache.put(gid, file_id, future.result())
+
+        future.add_done_callback(done)
+        self.__session.in_flight().track(("audio-key", seq),
+                                         Packet.Type.request_key, payload,
+                                         self.audio_key_request_timeout)
+        self.__session.send(Packet.Type.request_key, payload)
+        return future
+
+    def __await_key(self, gid: bytes, file_id: bytes,
+                    future: concurrent.futures.Future, retry: bool) -> bytes:
+        try:
+            return future.result(self.audio_key_request_timeout)
+        except (KeyUnavailableError, concurrent.futures.TimeoutError):
             if retry:
                 return self.audio_key(gid, file_id, False)
             raise KeyUnavailableError(
                 "Failed fetching audio key! gid: {}, fileId: {}".format(
                     util.bytes_to_hex(gid), util.bytes_to_hex(file_id)))
-        return key
 
     class Callback:
 
@@ -305,35 +605,53 @@ class AudioKeyManager(PacketsReceiver, Closeable):
         def error(self, code: int) -> None:
             raise NotImplementedError
 
+    class FutureCallback(Callback):
+        __audio_key_manager: AudioKeyManager
+        __future: concurrent.futures.Future
+
+        def __init__(self, audio_key_manager: AudioKeyManager,
+                     future: concurrent.futures.Future):
+            self.__audio_key_manager = audio_key_manager
+            self.__future = future
+
+        def key(self, key: bytes) -> None:
+            util.settle_future(self.__future, key)
+
+        def error(self, code: int) -> None:
+            self.__audio_key_manager.logger.fatal(
+                "Audio key error, code: {}".format(code))
+            util.settle_future(
+                self.__future,
+                exception=KeyUnavailableError(
+                    "Audio key error, code: {}".format(code)))
+
     class SyncCallback(Callback):
         __audio_key_manager: AudioKeyManager
-        __reference = queue.Queue()
-        __reference_lock = threading.Condition()
+        __reference: queue.Queue
 
         def __init__(self, audio_key_manager: AudioKeyManager):
             self.__audio_key_manager = audio_key_manager
+            self.__reference = queue.Queue()
 
         def key(self, key: bytes) -> None:
-            with self.__reference_lock:
-                self.__reference.put(key)
-                self.__reference_lock.notify_all()
+            self.__reference.put(key)
 
         def error(self, code: int) -> None:
             self.__audio_key_manager.logger.fatal(
                 "Audio key error, code: {}".format(code))
-            with self.__reference_lock:
-                self.__reference.put(None)
-                self.__reference_lock.notify_all()
+            self.__reference.put(None)
 
         def wait_response(self) -> bytes:
-            with self.__reference_lock:
-                self.__reference_lock.wait(
-                    AudioKeyManager.audio_key_request_timeout)
-                return self.__reference.get(block=False)
+            try:
+                return self.__reference.get(
+                    timeout=AudioKeyManager.audio_key_request_timeout)
+            except queue.Empty:
+                return None
 
 
 class CdnFeedHelper:
     _LOGGER: logging = logging.getLogger(__name__)
+    head_timeout = 10
 
     @staticmethod
     def get_url(resp: StorageResolve.StorageResolveResponse) -> str:
@@ -342,6 +660,29 @@ class CdnFeedHelper:
             selected_url = random.choice(resp.cdnurl)
         return selected_url
 
+    @staticmethod
+    def request_head(
+        session: Session, file: Metadata.AudioFile
+    ) -> typing.Union[concurrent.futures.Future, None]:
+        """Fetch the head file next to the audio key if head files are on"""
+        if not session.configuration().use_head_files:
+            return None
+        return CdnManager.Streamer.executor_service.submit(
+            session.cdn().get_head, file.file_id)
+
+    @staticmethod
+    def await_head(
+        future: typing.Union[concurrent.futures.Future, None]
+    ) -> typing.Union[bytes, None]:
+        if future is None:
+            return None
+        try:
+            return future.result(CdnFeedHelper.head_timeout)
+        except (IOError, concurrent.futures.TimeoutError) as ex:
+            CdnFeedHelper._LOGGER.warning(
+                "Couldn't fetch head file, starting from CDN: {}".format(ex))
+            return None
+
     @staticmethod
     def load_track(
             session: Session, track: Metadata.Track, file: Metadata.AudioFile,
@@ -353,21 +694,32 @@ class CdnFeedHelper:
             url = resp_or_url
         else:
             url = CdnFeedHelper.get_url(resp_or_url)
+        head = CdnFeedHelper.request_head(session, file)
         start = int(time.time() * 1000)
-        key = session.audio_key().get_audio_key(track.gid, file.file_id)                       
+        key = session.audio_key().cached_audio_key(track.gid, file.file_id)
+        preloaded = preload or key is not None
+        if key is None:
+            key = session.audio_key().request_audio_key(
+                track.gid, file.file_id)
         audio_key_time = int(time.time() * 1000) - start
 
-        streamer = session.cdn().stream_file(file, key, url, halt_listener)
+        streamer = session.cdn().stream_file(file, key, url, halt_listener,
+                                             CdnFeedHelper.await_head(head))
         input_stream = streamer.stream()
         normalization_data = NormalizationData.read(input_stream)
         if input_stream.skip(0xA7) != 0xA7:
             raise IOError("Couldn't skip 0xa7 bytes!")
+        time_to_first_byte = int(time.time() * 1000) - start
+        CdnFeedHelper._LOGGER.debug(
+            "First bytes of {} after {}ms".format(streamer.describe(),
+                                                 time_to_first_byte))
         return PlayableContentFeeder.LoadedStream(
             track,
             streamer,
             normalization_data,
-            PlayableContentFeeder.Metrics(file.file_id, preload,
-                                          -1 if preload else audio_key_time),
+            PlayableContentFeeder.Metrics(
+                file.file_id, preloaded,
+                -1 if preloaded else audio_key_time, time_to_first_byte),
         )
 
     @staticmethod
@@ -383,13 +735,15 @@ class CdnFeedHelper:
         CdnFeedHelper._LOGGER.debug("Fetched external url for {}: {}".format(
             util.bytes_to_hex(episode.gid), url))
 
+        start = int(time.time() * 1000)
         streamer = session.cdn().stream_external_episode(
             episode, url, halt_listener)
         return PlayableContentFeeder.LoadedStream(
             episode,
             streamer,
             None,
-            PlayableContentFeeder.Metrics(None, False, -1),
+            PlayableContentFeeder.Metrics(None, False, -1,
+                                          int(time.time() * 1000) - start),
         )
 
     @staticmethod
@@ -405,21 +759,32 @@ class CdnFeedHelper:
             url = resp_or_url
         else:
             url = CdnFeedHelper.get_url(resp_or_url)
+        head = CdnFeedHelper.request_head(session, file)
         start = int(time.time() * 1000)
-        key = session.audio_key().get_audio_key(episode.gid, file.file_id)
+        key = session.audio_key().cached_audio_key(episode.gid, file.file_id)
+        preloaded = preload or key is not None
+        if key is None:
+            key = session.audio_key().request_audio_key(
+                episode.gid, file.file_id)
         audio_key_time = int(time.time() * 1000) - start
 
-        streamer = session.cdn().stream_file(file, key, url, halt_listener)
+        streamer = session.cdn().stream_file(file, key, url, halt_listener,
+                                             CdnFeedHelper.await_head(head))
         input_stream = streamer.stream()
         normalization_data = NormalizationData.read(input_stream)
         if input_stream.skip(0xA7) != 0xA7:
             raise IOError("Couldn't skip 0xa7 bytes!")
+        time_to_first_byte = int(time.time() * 1000) - start
+        CdnFeedHelper._LOGGER.debug(
+            "First bytes of {} after {}ms".format(streamer.describe(),
+                                                 time_to_first_byte))
         return PlayableContentFeeder.LoadedStream(
             episode,
             streamer,
             normalization_data,
-            PlayableContentFeeder.Metrics(file.file_id, preload,
-                                          -1 if preload else audio_key_time),
+            PlayableContentFeeder.Metrics(
+                file.file_id, preloaded,
+                -1 if preloaded else audio_key_time, time_to_first_byte),
         )
 
 
@@ -452,10 +817,16 @@ class CdnManager:
             self.__session.cache(),
             NoopAudioDecrypt(),
             halt_listener,
+            fast_start_size=self.__session.configuration().fast_start_size,
+            progressive=self.__session.configuration().progressive_chunks,
         )
 
-    def stream_file(self, file: Metadata.AudioFile, key: bytes, url: str,
-                    halt_listener: HaltListener):
+    def stream_file(self,
+                    file: Metadata.AudioFile,
+                    key: bytes,
+                    url: str,
+                    halt_listener: HaltListener,
+                    head: bytes = None):
         return CdnManager.Streamer(
             self.__session,
             StreamId(file=file),
@@ -464,6 +835,9 @@ class CdnManager:
             self.__session.cache(),
             AesAudioDecrypt(key),
             halt_listener,
+            head,
+            self.__session.configuration().fast_start_size,
+            self.__session.configuration().progressive_chunks,
         )
 
     def get_audio_url(self, file_id: bytes):
@@ -496,9 +870,12 @@ class CdnManager:
             self.headers = headers
 
     class CdnUrl:
+        refresh_ahead = 5 * 60
+        refresh_min_interval = 30
         __cdn_manager = None
         __file_id: bytes
         __expiration: int
+        __refresh_timer: typing.Union[util.TimerWheel.Timer, None] = None
         url: str
 
         def __init__(self, cdn_manager, file_id: typing.Union[bytes, None],
@@ -514,8 +891,42 @@ class CdnManager:
                 self.url = self.__cdn_manager.get_audio_url(self.__file_id)
             return self.url
 
+        def close(self) -> None:
+            if self.__refresh_timer is not None:
+                self.__refresh_timer.cancel()
+                self.__refresh_timer = None
+
         def set_url(self, url: str):
             self.url = url
+            self.__set_expiration(url)
+            self.close()
+            if self.__expiration != -1:
+                # The timer only holds a weak reference, so a stream that is
+                # dropped without close() stops refreshing and frees its
+                # session
+                self.__refresh_timer = util.TimerWheel.instance(
+                ).schedule_blocking(
+                    max(self.refresh_min_interval,
+                        self.__expiration / 1000 - time.time() -
+                        self.refresh_ahead), CdnManager.CdnUrl.__refresh_ref,
+                    weakref.ref(self))
+
+        @staticmethod
+        def __refresh_ref(ref: weakref.ref) -> None:
+            cdn_url = ref()
+            if cdn_url is not None:
+                cdn_url.__refresh()
+
+        def __refresh(self) -> None:
+            self.__refresh_timer = None
+            try:
+                self.set_url(self.__cdn_manager.get_audio_url(self.__file_id))
+            except (IOError, CdnManager.CdnException) as ex:
+                self.__cdn_manager.logger.warning(
+                    "Couldn't refresh CDN url for {}: {}".format(
+                        util.bytes_to_hex(self.__file_id), ex))
+
+        def __set_expiration(self, url: str):
             if self.__file_id is not None:
                 token_url = urllib.parse.urlparse(url)
                 token_query = urllib.parse.parse_qs(token_url.query)
@@ -570,55 +981,186 @@ class CdnManager:
 
     class Streamer(GeneralAudioStream, GeneralWritableStream):
         available: typing.List[bool]
-        buffer: typing.List[bytes]
+        buffer: memoryview
         chunks: int
         executor_service = concurrent.futures.ThreadPoolExecutor()
         halt_listener: HaltListener
+        head: bytes
+        mmap_threshold = 16 * 1024 * 1024
+        progress: typing.List[int]
+        progressive_piece_size = 16 * 1024
         requested: typing.List[bool]
         size: int
         __audio_format: SuperAudioFormat
         __audio_decrypt: AudioDecrypt
         __cdn_url: CdnManager.CdnUrl
+        __fetching: typing.Set[int]
+        __fetching_lock: threading.Lock
         __internal_stream: InternalStream
+        __open_error: typing.Union[Exception, None] = None
+        __prefix = b""
+        __progressive: bool
+        __ready: threading.Event
         __session: Session
+        __storage: typing.Union[bytearray, mmap.mmap, None] = None
         __stream_id: StreamId
 
-        def __init__(self, session: Session, stream_id: StreamId,
+        def __init__(self,
+                     session: Session,
+                     stream_id: StreamId,
                      audio_format: SuperAudioFormat,
-                     cdn_url: CdnManager.CdnUrl, cache: CacheManager,
-                     audio_decrypt: AudioDecrypt, halt_listener: HaltListener):
+                     cdn_url: CdnManager.CdnUrl,
+                     cache: CacheManager,
+                     audio_decrypt: AudioDecrypt,
+                     halt_listener: HaltListener,
+                     head: bytes = None,
+                     fast_start_size: int = 0,
+                     progressive: bool = False):
             self.__session = session
             self.__stream_id = stream_id
             self.__audio_format = audio_format
             self.__audio_decrypt = audio_decrypt
             self.__cdn_url = cdn_url
             self.halt_listener = halt_listener
-            response = self.request(range_start=0,
-                                    range_end=ChannelManager.chunk_size - 1)
+            self.head = b"" if head is None else head
+            self.__progressive = progressive
+            self.__fetching = set()
+            self.__fetching_lock = threading.Lock()
+            self.__ready = threading.Event()
+            conf = session.configuration()
+            self.__internal_stream = CdnManager.Streamer.InternalStream(
+                self, False,
+                AbsChunkedInputStream.ReadAhead(conf.read_ahead_chunks,
+                                                conf.read_ahead_max_chunks,
+                                                conf.read_ahead_memory))
+            if head is not None:
+                self.executor_service.submit(self.__open_in_background)
+            elif fast_start_size > 0:
+                self.__open(min(fast_start_size, ChannelManager.chunk_size))
+            else:
+                self.__open()
+
+        def __open(self, first_size: int = None) -> None:
+            if first_size is None:
+                first_size = ChannelManager.chunk_size
+            response = self.request(range_start=0, range_end=first_size - 1)
             content_range = response.headers.get("Content-Range")
             if content_range is None:
                 raise IOError("Missing Content-Range header!")
+            if self.__internal_stream.is_closed():
+                # Closed while the first chunk was on its way
+                self.__open_error = IOError("Stream closed while opening")
+                self.__ready.set()
+                return
             split = content_range.split("/")
             self.size = int(split[1])
             self.chunks = int(math.ceil(self.size / ChannelManager.chunk_size))
             first_chunk = response.buffer
             self.available = [False for _ in range(self.chunks)]
+            self.progress = [0 for _ in range(self.chunks)]
             self.requested = [False for _ in range(self.chunks)]
-            self.buffer = [b"" for _ in range(self.chunks)]
-            self.__internal_stream = CdnManager.Streamer.InternalStream(
-                self, False)
+            self.__allocate()
             self.requested[0] = True
-            self.write_chunk(first_chunk, 0, False)
+            complete = len(first_chunk) >= min(self.size,
+                                               ChannelManager.chunk_size)
+            if not complete:
+                self.head = self.__audio_decrypt.decrypt_chunk(0, first_chunk)
+                # Only the rest of the first chunk is fetched later on
+                self.__prefix = first_chunk
+            self.__ready.set()
+            if self.__internal_stream.is_closed():
+                # close() may have checked is_ready() before it was set
+                self.release()
+                return
+            self.__internal_stream.prepare()
+            if complete:
+                self.write_chunk(first_chunk, 0, False)
+            else:
+                self.__internal_stream.request_chunk_from_stream(0)
+
+        def __allocate(self) -> None:
+            """Reserve one buffer for the whole file
 
-        def write_chunk(self, chunk: bytes, chunk_index: int,
-                        cached: bool) -> None:
+            Large files get anonymous memory maps, whose pages are only
+            committed once a chunk is written to them.
+            """
+            if self.size >= self.mmap_threshold:
+                self.__storage = mmap.mmap(-1, self.size)
+            else:
+                self.__storage = bytearray(self.size)
+            self.buffer = memoryview(self.__storage)
+
+        def close(self) -> None:
+            """Stop refreshing the CDN URL and free the buffer
+
+            Called by the input stream once it's closed.
+            """
+            self.__session.logger.debug("Read-ahead of {}: {}".format(
+                self.describe(), self.__internal_stream.read_ahead))
+            self.__cdn_url.close()
+            self.head = b""
+            if self.is_ready():
+                self.release()
+
+        def release(self) -> None:
+            storage = self.__storage
+            if storage is None:
+                return
+            self.__storage = None
+            self.buffer.release()
+            if isinstance(storage, mmap.mmap):
+                try:
+                    storage.close()
+                except BufferError:
+                    # Views handed out by read_view keep the map alive
+                    pass
+
+        def __open_in_background(self) -> None:
+            try:
+                self.__open()
+            except Exception as ex:
+                self.__session.logger.error(
+                    "Failed opening stream after head file, {}: {}".format(
+                        self.describe(), ex))
+                self.__open_error = ex
+                self.__ready.set()
+
+        def is_ready(self) -> bool:
+            return self.__ready.is_set()
+
+        def wait_ready(self) -> None:
+            """Block until the size of the stream is known
+
+            Streams started from a head file learn it from the first CDN
+            response, which arrives in the background.
+            """
+            self.__ready.wait()
+            if self.__open_error is not None:
+                raise IOError("Couldn't open stream: {}".format(
+                    self.__open_error))
+
+        def write_chunk(self,
+                        chunk: bytes,
+                        chunk_index: int,
+                        cached: bool,
+                        prefix: bytes = b"") -> None:
+            """Decrypt a chunk into the buffer
+
+            :param prefix: Encrypted start of the chunk, fetched before and
+                not part of chunk
+
+            """
             if self.__internal_stream.is_closed():
                 return
             self.__session.logger.debug(
                 "Chunk {}/{} completed, cached: {}, stream: {}".format(
                     chunk_index + 1, self.chunks, cached, self.describe()))
-            self.buffer[chunk_index] = self.__audio_decrypt.decrypt_chunk(
-                chunk_index, chunk)
+            start = ChannelManager.chunk_size * chunk_index
+            decrypt = self.__audio_decrypt.decrypt_stream(chunk_index)
+            decrypt(prefix, self.buffer[start:start + len(prefix)])
+            start += len(prefix)
+            decrypt(chunk, self.buffer[start:start + len(chunk)])
+            self.progress[chunk_index] = len(prefix) + len(chunk)
             self.__internal_stream.notify_chunk_available(chunk_index)
 
         def stream(self) -> AbsChunkedInputStream:
@@ -637,24 +1179,99 @@ class CdnManager:
             return self.__audio_decrypt.decrypt_time_ms()
 
         def request_chunk(self, index: int) -> None:
-            response = self.request(index)
-            self.write_chunk(response.buffer, index, False)
-
-        def request(self, chunk: int = None, range_start: int = None, range_end: int = None)\
-                -> CdnManager.InternalResponse:
-            if chunk is None and range_start is None and range_end is None:
-                raise TypeError()
-            if chunk is not None:
-                range_start = ChannelManager.chunk_size * chunk
-                range_end = (chunk + 1) * ChannelManager.chunk_size - 1
+            with self.__fetching_lock:
+                if index in self.__fetching or self.available[index]:
+                    return
+                self.__fetching.add(index)
+            try:
+                prefix = self.__prefix if index == 0 else b""
+                if self.__progressive:
+                    self.__stream_chunk(index, prefix)
+                else:
+                    response = self.request(
+                        range_start=ChannelManager.chunk_size * index +
+                        len(prefix),
+                        range_end=(index + 1) * ChannelManager.chunk_size - 1)
+                    self.__check_length(index,
+                                        len(prefix) + len(response.buffer))
+                    self.write_chunk(response.buffer, index, False, prefix)
+            except IOError as ex:
+                self.__session.logger.warning(
+                    "Failed fetching chunk {}, {}: {}".format(
+                        index, self.describe(), ex))
+                self.progress[index] = 0
+                self.__internal_stream.notify_chunk_error(index, ex)
+            finally:
+                with self.__fetching_lock:
+                    self.__fetching.discard(index)
+
+        def __stream_chunk(self, index: int, prefix: bytes = b"") -> None:
+            """Download and decrypt a chunk piece by piece
+
+            Every piece raises the progress of the chunk, so readers only
+            wait for the bytes they need instead of the whole chunk.
+
+            :param prefix: Encrypted start of the chunk, fetched before
+
+            """
+            offset = ChannelManager.chunk_size * index
+            response = self.__get(offset + len(prefix),
+                                  (index + 1) * ChannelManager.chunk_size - 1,
+                                  True)
+            decrypt = self.__audio_decrypt.decrypt_stream(index)
+            decrypt(prefix, self.buffer[offset:offset + len(prefix)])
+            offset += len(prefix)
+            self.progress[index] = len(prefix)
+            try:
+                for piece in response.iter_content(
+                        self.progressive_piece_size):
+                    if self.__internal_stream.is_closed():
+                        return
+                    decrypt(piece, self.buffer[offset:offset + len(piece)])
+                    offset += len(piece)
+                    self.progress[index] += len(piece)
+                    self.__internal_stream.notify_chunk_progress(index)
+            finally:
+                response.close()
+            self.__check_length(index, self.progress[index])
+            self.__session.logger.debug(
+                "Chunk {}/{} completed, cached: False, stream: {}".format(
+                    index + 1, self.chunks, self.describe()))
+            self.__internal_stream.notify_chunk_available(index)
+
+        def __check_length(self, index: int, length: int) -> None:
+            """Fail a chunk whose body was cut short
+
+            Otherwise readers would get the zeros of the buffer as audio.
+            """
+            expected = min(ChannelManager.chunk_size,
+                           self.size - ChannelManager.chunk_size * index)
+            if length != expected:
+                raise IOError("Chunk {} has {} bytes, expected {}".format(
+                    index, length, expected))
+
+        def __get(self, range_start: int, range_end: int,
+                  stream: bool = False):
             response = self.__session.client().get(
                 self.__cdn_url.url,
                 headers=CaseInsensitiveDict({
                     "Range": "bytes={}-{}".format(range_start, range_end)
                 }),
+                stream=stream,
             )
             if response.status_code != 206:
+                response.close()
                 raise IOError(response.status_code)
+            return response
+
+        def request(self, chunk: int = None, range_start: int = None, range_end: int = None)\
+                -> CdnManager.InternalResponse:
+            if chunk is None and range_start is None and range_end is None:
+                raise TypeError()
+            if chunk is not None:
+                range_start = ChannelManager.chunk_size * chunk
+                range_end = (chunk + 1) * ChannelManager.chunk_size - 1
+            response = self.__get(range_start, range_end)
             body = response.content
             if body is None:
                 raise IOError("Response body is empty!")
@@ -663,27 +1280,44 @@ class CdnManager:
         class InternalStream(AbsChunkedInputStream):
             streamer: CdnManager.Streamer
 
-            def __init__(self, streamer, retry_on_chunk_error: bool):
+            def __init__(self,
+                         streamer,
+                         retry_on_chunk_error: bool,
+                         read_ahead: AbsChunkedInputStream.ReadAhead = None):
                 self.streamer: CdnManager.Streamer = streamer
-                super().__init__(retry_on_chunk_error)
+                super().__init__(retry_on_chunk_error, False, read_ahead)
 
-            def buffer(self) -> typing.List[bytes]:
+            def buffer(self) -> memoryview:
+                self.streamer.wait_ready()
                 return self.streamer.buffer
 
+            def head(self) -> bytes:
+                return self.streamer.head
+
             def size(self) -> int:
+                self.streamer.wait_ready()
                 return self.streamer.size
 
             def close(self) -> None:
+                closing = not self.closed
                 super().close()
-                del self.streamer.buffer
+                if closing:
+                    self.streamer.close()
 
             def requested_chunks(self) -> typing.List[bool]:
+                self.streamer.wait_ready()
                 return self.streamer.requested
 
             def available_chunks(self) -> typing.List[bool]:
+                self.streamer.wait_ready()
                 return self.streamer.available
 
+            def chunk_progress(self) -> typing.List[int]:
+                self.streamer.wait_ready()
+                return self.streamer.progress
+
             def chunks(self) -> int:
+                self.streamer.wait_ready()
                 return self.streamer.chunks
 
             def request_chunk_from_stream(self, index: int) -> None:
@@ -848,6 +1482,13 @@ class PlayableContentFeeder:
     def resolve_storage_interactive(
             self, file_id: bytes,
             preload: bool) -> StorageResolve.StorageResolveResponse:
+        return self.__session.single_flight().do(
+            ("storage-resolve", file_id, preload),
+            self.__resolve_storage_interactive, file_id, preload)
+
+    def __resolve_storage_interactive(
+            self, file_id: bytes,
+            preload: bool) -> StorageResolve.StorageResolveResponse:
         resp = self.__session.api().send(
             "GET",
             (self.storage_resolve_interactive_prefetch
@@ -893,13 +1534,18 @@ class PlayableContentFeeder:
         file_id: str
         preloaded_audio_key: bool
         audio_key_time: int
+        time_to_first_byte: int
 
-        def __init__(self, file_id: typing.Union[bytes, None],
-                     preloaded_audio_key: bool, audio_key_time: int):
+        def __init__(self,
+                     file_id: typing.Union[bytes, None],
+                     preloaded_audio_key: bool,
+                     audio_key_time: int,
+                     time_to_first_byte: int = -1):
             self.file_id = None if file_id is None else util.bytes_to_hex(
                 file_id)
             self.preloaded_audio_key = preloaded_audio_key
             self.audio_key_time = audio_key_time
+            self.time_to_first_byte = time_to_first_byte
             if preloaded_audio_key and audio_key_time != -1:
                 raise RuntimeError()
 
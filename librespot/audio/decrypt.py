@@ -5,6 +5,7 @@ from librespot.audio.storage import ChannelManager
 from librespot.structure import AudioDecrypt
 import io
 import time
+import typing
 
 
 class AesAudioDecrypt(AudioDecrypt):
@@ -40,6 +41,21 @@ class AesAudioDecrypt(AudioDecrypt):
         new_buffer.seek(0)
         return new_buffer.read()
 
+    def decrypt_stream(self, chunk_index: int):
+        iv = self.iv_int + int(ChannelManager.chunk_size * chunk_index / 16)
+        cipher = AES.new(key=self.key,
+                         mode=AES.MODE_CTR,
+                         counter=Counter.new(128, initial_value=iv))
+        self.decrypt_count += 1
+
+        def decrypt(buffer: bytes, output=None) -> typing.Union[bytes, None]:
+            start = time.time_ns()
+            decrypted_buffer = cipher.decrypt(buffer, output=output)
+            self.decrypt_total_time += time.time_ns() - start
+            return decrypted_buffer
+
+        return decrypt
+
     def decrypt_time_ms(self):
         return 0 if self.decrypt_count == 0 else int(
             (self.decrypt_total_time / self.decrypt_count) / 1000000)
@@ -16,22 +16,27 @@ if typing.TYPE_CHECKING:
 
 
 class ChannelManager(Closeable, PacketsReceiver):
-    channels: typing.Dict[int, Channel] = {}
+    channels: typing.Dict[int, Channel]
     chunk_size = 1024 * 1024
-    executor_service = concurrent.futures.ThreadPoolExecutor()
+    executor_service: concurrent.futures.ThreadPoolExecutor
     logger = logging.getLogger("Librespot:ChannelManager")
-    seq_holder = 0
-    seq_holder_lock = threading.Condition()
+    seq_holder: int
+    seq_holder_lock: threading.Condition
     __session: Session = None
 
     def __init__(self, session: Session):
+        self.channels = {}
+        self.executor_service = concurrent.futures.ThreadPoolExecutor()
+        self.seq_holder = 0
+        self.seq_holder_lock = threading.Condition()
         self.__session = session
 
     def request_chunk(self, file_id: bytes, index: int, file: AudioFile):
         start = int(index * self.chunk_size / 4)
         end = int((index + 1) * self.chunk_size / 4)
         channel = ChannelManager.Channel(self, file, index)
-        self.channels[channel.chunk_id] = channel
+        with self.seq_holder_lock:
+            self.channels[channel.chunk_id] = channel
         out = io.BytesIO()
         out.write(struct.pack(">H", channel.chunk_id))
         out.write(struct.pack(">i", 0x00000000))
@@ -76,7 +81,7 @@ class ChannelManager(Closeable, PacketsReceiver):
     class Channel:
         channel_manager: ChannelManager
         chunk_id: int
-        q = queue.Queue()
+        q: queue.Queue
         __buffer: io.BytesIO
         __chunk_index: int
         __file: AudioFile
@@ -85,6 +90,7 @@ class ChannelManager(Closeable, PacketsReceiver):
         def __init__(self, channel_manager: ChannelManager, file: AudioFile,
                      chunk_index: int):
             self.__buffer = io.BytesIO()
+            self.q = queue.Queue()
             self.channel_manager = channel_manager
             self.__file = file
             self.__chunk_index = chunk_index
@@ -134,6 +140,6 @@ class ChannelManager(Closeable, PacketsReceiver):
                     "ChannelManager.Handler is starting")
                 with self.__channel.q.all_tasks_done:
                     self.__channel.channel_manager.channels.pop(
-                        self.__channel.chunk_id)
+                        self.__channel.chunk_id, None)
                 self.__channel.channel_manager.logger.debug(
                     "ChannelManager.Handler is shutting down")
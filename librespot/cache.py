@@ -1,4 +1,16 @@
 from __future__ import annotations
+from Cryptodome import Random
+from Cryptodome.Cipher import AES
+from Cryptodome.Hash import HMAC, SHA256
+from Cryptodome.Protocol.KDF import HKDF
+import collections
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import time
 import typing
 
 if typing.TYPE_CHECKING:
@@ -16,3 +28,464 @@ class CacheManager:
         @Todo Implement function
         :param session:
         """
+
+
+class ResponseCache:
+    """
+    LRU cache of responses with a memory tier and an optional disk tier
+
+    Entries are lists of byte parts that expire at a wall-clock time and
+    may carry an ETag, so an expired entry can still be revalidated.
+    Both tiers are capped in bytes and evict the least recently used
+    entries first.
+    """
+    logger = logging.getLogger("Librespot:ResponseCache")
+    disk_hits = 0
+    evictions = 0
+    hits = 0
+    invalidations = 0
+    misses = 0
+    revalidations = 0
+    stores = 0
+    __disk: typing.OrderedDict[str, typing.Tuple[str, int]]
+    __disk_dir: typing.Union[str, None]
+    __disk_size: int
+    __lock: threading.Lock
+    __max_disk_size: int
+    __max_memory_size: int
+    __memory: typing.OrderedDict[str, ResponseCache.Entry]
+    __memory_size: int
+
+    def __init__(self,
+                 max_memory_size: int,
+                 disk_dir: str = None,
+                 max_disk_size: int = 0):
+        self.__disk = collections.OrderedDict()
+        self.__disk_dir = disk_dir if max_disk_size > 0 else None
+        self.__disk_size = 0
+        self.__lock = threading.Lock()
+        self.__max_disk_size = max_disk_size
+        self.__max_memory_size = max_memory_size
+        self.__memory = collections.OrderedDict()
+        self.__memory_size = 0
+        if self.__disk_dir is not None:
+            self.__load_disk()
+
+    def get(self, key: str) -> typing.Union[ResponseCache.Entry, None]:
+        """
+        Find an entry, fresh or not
+        Args:
+            key: Cache key
+        Returns:
+            The entry, check expired() before using it without revalidation
+        """
+        with self.__lock:
+            entry = self.__memory.get(key)
+            if entry is not None:
+                self.__memory.move_to_end(key)
+                return entry
+            disk = self.__disk.get(key)
+        if disk is None:
+            return None
+        entry = self.__read(disk[0])
+        if entry is None:
+            with self.__lock:
+                self.__drop_disk(key)
+            return None
+        with self.__lock:
+            self.disk_hits += 1
+            if key in self.__disk:
+                self.__disk.move_to_end(key)
+            self.__put_memory(key, entry)
+        try:
+            os.utime(disk[0])
+        except OSError:
+            pass
+        return entry
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return 0.0 if total == 0 else self.hits / total
+
+    def lookup(self, key: str) -> typing.Union[ResponseCache.Entry, None]:
+        """
+        Find an entry like get() and count a hit if it's fresh, a miss
+        otherwise
+        Args:
+            key: Cache key
+        Returns:
+            The entry, fresh or not
+        """
+        entry = self.get(key)
+        with self.__lock:
+            if entry is not None and not entry.expired():
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry
+
+    def revalidate(self, key: str, entry: ResponseCache.Entry) -> None:
+        """
+        Store an entry the server confirmed is still current
+        Args:
+            key: Cache key
+            entry: Entry with its new expiry
+        """
+        with self.__lock:
+            self.revalidations += 1
+        self.put(key, entry)
+
+    def invalidate(self, prefix: str) -> int:
+        """
+        Drop the entries whose URI starts with prefix
+        Args:
+            prefix: URI prefix
+        Returns:
+            Number of entries dropped
+        """
+        with self.__lock:
+            keys = {
+                key
+                for key in list(self.__memory) + list(self.__disk)
+                if key.startswith(prefix)
+            }
+            for key in keys:
+                entry = self.__memory.pop(key, None)
+                if entry is not None:
+                    self.__memory_size -= entry.size
+                self.__drop_disk(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def put(self, key: str, entry: ResponseCache.Entry) -> None:
+        """
+        Store an entry in both tiers
+        Args:
+            key: Cache key, starting with the URI so invalidate() finds it
+            entry: Entry to store
+        """
+        with self.__lock:
+            self.stores += 1
+            self.__put_memory(key, entry)
+        if self.__disk_dir is not None and entry.size <= self.__max_disk_size:
+            self.__write(key, entry)
+
+    def __drop_disk(self, key: str) -> None:
+        disk = self.__disk.pop(key, None)
+        if disk is None:
+            return
+        self.__disk_size -= disk[1]
+        try:
+            os.remove(disk[0])
+        except OSError:
+            pass
+
+    def __load_disk(self) -> None:
+        try:
+            os.makedirs(self.__disk_dir, exist_ok=True)
+            names = os.listdir(self.__disk_dir)
+        except OSError as ex:
+            self.logger.warning("Disabling disk cache: {}".format(ex))
+            self.__disk_dir = None
+            return
+        files = []
+        for name in names:
+            path = os.path.join(self.__disk_dir, name)
+            try:
+                with open(path, "rb") as f:
+                    key = json.loads(f.readline())["key"]
+                stat = os.stat(path)
+            except (OSError, ValueError, KeyError):
+                continue
+            files.append((stat.st_mtime, key, path, stat.st_size))
+        for _, key, path, size in sorted(files):
+            self.__disk[key] = (path, size)
+            self.__disk_size += size
+        with self.__lock:
+            self.__trim_disk()
+
+    def __put_memory(self, key: str, entry: ResponseCache.Entry) -> None:
+        old = self.__memory.pop(key, None)
+        if old is not None:
+            self.__memory_size -= old.size
+        if entry.size > self.__max_memory_size:
+            return
+        self.__memory[key] = entry
+        self.__memory_size += entry.size
+        while self.__memory_size > self.__max_memory_size:
+            _, evicted = self.__memory.popitem(last=False)
+            self.__memory_size -= evicted.size
+            self.evictions += 1
+
+    def __read(self, path: str) -> typing.Union[ResponseCache.Entry, None]:
+        try:
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline())
+                parts = [f.read(length) for length in meta["parts"]]
+        except (OSError, ValueError, KeyError) as ex:
+            self.logger.debug("Couldn't read {}: {}".format(path, ex))
+            return None
+        if any(len(part) != length
+               for part, length in zip(parts, meta["parts"])):
+            return None
+        return ResponseCache.Entry(parts, meta["expires"], meta.get("etag"))
+
+    def __trim_disk(self) -> None:
+        while self.__disk_size > self.__max_disk_size and len(self.__disk) > 0:
+            key = next(iter(self.__disk))
+            self.__drop_disk(key)
+            self.evictions += 1
+
+    def __write(self, key: str, entry: ResponseCache.Entry) -> None:
+        path = os.path.join(self.__disk_dir,
+                            hashlib.sha1(key.encode()).hexdigest())
+        meta = json.dumps({
+            "key": key,
+            "expires": entry.expires,
+            "etag": entry.etag,
+            "parts": [len(part) for part in entry.parts],
+        }).encode() + b"\n"
+        try:
+            with open(path + ".tmp", "wb") as f:
+                f.write(meta)
+                for part in entry.parts:
+                    f.write(part)
+            os.replace(path + ".tmp", path)
+        except OSError as ex:
+            self.logger.debug("Couldn't write {}: {}".format(path, ex))
+            return
+        with self.__lock:
+            old = self.__disk.pop(key, None)
+            if old is not None:
+                self.__disk_size -= old[1]
+            self.__disk[key] = (path, len(meta) + entry.size)
+            self.__disk_size += len(meta) + entry.size
+            self.__trim_disk()
+
+    def __str__(self) -> str:
+        return ("hits: {} ({} from disk), misses: {}, hit_rate: {:.2f}, "
+                "revalidations: {}, stores: {}, evictions: {}, "
+                "invalidations: {}, memory: {}B, disk: {}B".format(
+                    self.hits, self.disk_hits, self.misses, self.hit_rate(),
+                    self.revalidations, self.stores, self.evictions,
+                    self.invalidations, self.__memory_size,
+                    self.__disk_size))
+
+    class Entry:
+        etag: typing.Union[str, None]
+        expires: float
+        parts: typing.List[bytes]
+        size: int
+
+        def __init__(self, parts: typing.List[bytes], expires: float,
+                     etag: str = None):
+            self.etag = etag
+            self.expires = expires
+            self.parts = parts
+            self.size = sum(len(part) for part in parts)
+
+        def expired(self) -> bool:
+            return self.expires <= time.time()
+
+
+class AudioKeyCache:
+    """
+    Audio keys by (gid, file_id) in a memory LRU backed by a disk store
+
+    Every key is stored in its own file, encrypted with AES-GCM under a
+    key derived from a random secret in key_file and the username. File
+    names are keyed hashes, so the store doesn't reveal which files were
+    played. Without a key file only the memory tier is used.
+    """
+    logger = logging.getLogger("Librespot:AudioKeyCache")
+    disk_hits = 0
+    hits = 0
+    misses = 0
+    stores = 0
+    __capacity: int
+    __disk_capacity: int
+    __disk_dir: typing.Union[str, None]
+    __disk_files: int
+    __lock: threading.Lock
+    __memory: typing.OrderedDict[typing.Tuple[bytes, bytes],
+                                 typing.Tuple[bytes, float]]
+    __secret: typing.Union[bytes, None]
+    __ttl: float
+
+    def __init__(self,
+                 capacity: int,
+                 ttl: float,
+                 username: str,
+                 disk_dir: str = None,
+                 disk_capacity: int = 0,
+                 key_file: str = None):
+        self.__capacity = capacity
+        self.__disk_capacity = disk_capacity
+        self.__disk_dir = disk_dir if (disk_capacity > 0
+                                       and key_file is not None) else None
+        self.__disk_files = 0
+        self.__lock = threading.Lock()
+        self.__memory = collections.OrderedDict()
+        self.__secret = None
+        self.__ttl = ttl
+        if self.__disk_dir is not None:
+            try:
+                self.__secret = HKDF(
+                    AudioKeyCache.__load_key_file(key_file) +
+                    username.encode(), 32, b"librespot-audio-key-cache",
+                    SHA256)
+                os.makedirs(self.__disk_dir, exist_ok=True)
+                self.__disk_files = len(os.listdir(self.__disk_dir))
+            except OSError as ex:
+                self.logger.warning("Disabling disk cache: {}".format(ex))
+                self.__disk_dir = None
+
+    def get(self, gid: bytes, file_id: bytes) -> typing.Union[bytes, None]:
+        """
+        Find a cached key
+        Args:
+            gid: Track or episode gid
+            file_id: Audio file id
+        Returns:
+            The key, None if it isn't cached or expired
+        """
+        now = time.time()
+        with self.__lock:
+            cached = self.__memory.get((gid, file_id))
+            if cached is not None:
+                if cached[1] > now:
+                    self.__memory.move_to_end((gid, file_id))
+                    self.hits += 1
+                    return cached[0]
+                del self.__memory[(gid, file_id)]
+        cached = self.__read(gid, file_id, now)
+        with self.__lock:
+            if cached is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self.__put_memory(gid, file_id, cached[0], cached[1])
+        return cached[0]
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return 0.0 if total == 0 else self.hits / total
+
+    def put(self, gid: bytes, file_id: bytes, key: bytes) -> None:
+        """
+        Store a key for the configured TTL
+        Args:
+            gid: Track or episode gid
+            file_id: Audio file id
+            key: AES key of the file
+        """
+        expires = time.time() + self.__ttl
+        with self.__lock:
+            self.stores += 1
+            self.__put_memory(gid, file_id, key, expires)
+        if self.__disk_dir is not None:
+            self.__write(gid, file_id, key, expires)
+
+    @staticmethod
+    def __load_key_file(path: str) -> bytes:
+        os.makedirs(os.path.dirname(path) or os.curdir, exist_ok=True)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            with open(path, "rb") as f:
+                secret = f.read()
+            if len(secret) != 32:
+                raise OSError("Invalid key file: {}".format(path))
+            return secret
+        secret = Random.get_random_bytes(32)
+        with os.fdopen(fd, "wb") as f:
+            f.write(secret)
+        return secret
+
+    def __path(self, gid: bytes, file_id: bytes) -> str:
+        name = HMAC.new(self.__secret, gid + file_id, SHA256).hexdigest()
+        return os.path.join(self.__disk_dir, name[:40])
+
+    def __put_memory(self, gid: bytes, file_id: bytes, key: bytes,
+                     expires: float) -> None:
+        self.__memory[(gid, file_id)] = (key, expires)
+        self.__memory.move_to_end((gid, file_id))
+        while len(self.__memory) > self.__capacity:
+            self.__memory.popitem(last=False)
+
+    def __read(self, gid: bytes, file_id: bytes,
+               now: float) -> typing.Union[typing.Tuple[bytes, float], None]:
+        if self.__disk_dir is None:
+            return None
+        path = self.__path(gid, file_id)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            cipher = AES.new(self.__secret, AES.MODE_GCM, nonce=data[:12])
+            cipher.update(gid + file_id)
+            plain = cipher.decrypt_and_verify(data[28:], data[12:28])
+        except (ValueError, KeyError):
+            self.logger.debug("Dropping unreadable entry {}".format(path))
+            plain = None
+        if plain is None or len(plain) != 24:
+            self.__remove(path)
+            return None
+        expires = struct.unpack(">d", plain[16:])[0]
+        if expires <= now:
+            self.__remove(path)
+            return None
+        return plain[:16], expires
+
+    def __remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        with self.__lock:
+            self.__disk_files -= 1
+
+    def __trim_disk(self) -> None:
+        try:
+            paths = [
+                os.path.join(self.__disk_dir, name)
+                for name in os.listdir(self.__disk_dir)
+            ]
+            paths.sort(key=os.path.getmtime)
+        except OSError:
+            return
+        with self.__lock:
+            self.__disk_files = len(paths)
+        for path in paths[:max(0, len(paths) - self.__disk_capacity)]:
+            self.__remove(path)
+
+    def __write(self, gid: bytes, file_id: bytes, key: bytes,
+                expires: float) -> None:
+        path = self.__path(gid, file_id)
+        nonce = Random.get_random_bytes(12)
+        cipher = AES.new(self.__secret, AES.MODE_GCM, nonce=nonce)
+        cipher.update(gid + file_id)
+        ciphertext, tag = cipher.encrypt_and_digest(
+            key + struct.pack(">d", expires))
+        try:
+            existed = os.path.exists(path)
+            with open(path + ".tmp", "wb") as f:
+                f.write(nonce + tag + ciphertext)
+            os.replace(path + ".tmp", path)
+        except OSError as ex:
+            self.logger.debug("Couldn't write {}: {}".format(path, ex))
+            return
+        with self.__lock:
+            if not existed:
+                self.__disk_files += 1
+            full = self.__disk_files > self.__disk_capacity
+        if full:
+            self.__trim_disk()
+
+    def __str__(self) -> str:
+        return ("hits: {} ({} from disk), misses: {}, hit_rate: {:.2f}, "
+                "stores: {}".format(self.hits, self.disk_hits, self.misses,
+                                    self.hit_rate(), self.stores))
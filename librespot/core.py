@@ -2,15 +2,19 @@ from __future__ import annotations
 
 import base64
 import binascii
+import collections
 import concurrent.futures
 import enum
+import errno
 import gzip
 import io
 import json
 import logging
+import math
 import os
+import queue
 import random
-import sched
+import selectors
 import socket
 import struct
 import threading
@@ -64,6 +68,7 @@ from librespot.proto.spotify.login5.v3.credentials import Credentials_pb2 as Log
 from librespot.proto.ExtensionKind_pb2 import ExtensionKind
 from librespot.structure import Closeable
 from librespot.structure import MessageListener
+from librespot.structure import PacketsReceiver
 from librespot.structure import RequestListener
 from librespot.structure import SubListener
 
@@ -214,11 +219,16 @@ class ApiClient(Closeable):
         return mdb
     
     def get_metadata_4_track(self, track: TrackId) -> Metadata.Track:
-        """
+        """Concurrent calls for the same track share one request
 
         :param track: TrackId:
 
         """
+        return self.__session.single_flight().do(
+            ("track-metadata", track.hex_id()), self.__get_metadata_4_track,
+            track)
+
+    def __get_metadata_4_track(self, track: TrackId) -> Metadata.Track:
         response = self.get_ext_metadata(ExtensionKind.TRACK_V4, track.to_spotify_uri())
         ApiClient.StatusCodeException.check_status(response)
         body = response.content
@@ -424,37 +434,95 @@ class ApiClient(Closeable):
 class ApResolver:
     """ """
     base_url = "https://apresolve.spotify.com/"
+    cache_ttl = 10 * 60
+    fallback = {
+        "accesspoint": [
+            "ap-gae2.spotify.com:4070", "ap-gae2.spotify.com:443",
+            "ap-gae2.spotify.com:80", "ap-guc3.spotify.com:4070",
+            "ap-gew1.spotify.com:443", "ap-gew4.spotify.com:80"
+        ],
+        "dealer": [
+            "gae2-dealer.spotify.com:443", "guc3-dealer.spotify.com:443",
+            "gue1-dealer.spotify.com:443", "gew1-dealer.spotify.com:443"
+        ],
+        "spclient": [
+            "gae2-spclient.spotify.com:443", "guc3-spclient.spotify.com:443",
+            "gue1-spclient.spotify.com:443", "gew4-spclient.spotify.com:443"
+        ],
+    }
+    logger = logging.getLogger("Librespot:ApResolver")
+    __cache: typing.Dict[str, typing.Tuple[float, typing.Any]] = {}
+    __cache_lock = threading.Lock()
+    __selector: typing.Union[EndpointSelector, None] = None
 
     @staticmethod
     def request(service_type: str) -> typing.Any:
-        """Gets the specified ApResolve
+        """Gets the specified ApResolve, cached for cache_ttl seconds
 
         :param service_type: str:
         :returns: The resulting object will be returned
 
         """
+        with ApResolver.__cache_lock:
+            cached = ApResolver.__cache.get(service_type)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
         response = requests.get("{}?type={}".format(ApResolver.base_url,
-                                                    service_type))
+                                                    service_type),
+                                timeout=5)
         if response.status_code != 200:
             if response.status_code == 502:
                 raise RuntimeError(
                     f"ApResolve request failed with the following return value: {response.content}. Servers might be down!"
                 )
-        return response.json()
+        pool = response.json()
+        with ApResolver.__cache_lock:
+            ApResolver.__cache[service_type] = (time.monotonic() +
+                                                ApResolver.cache_ttl, pool)
+        return pool
 
     @staticmethod
-    def get_random_of(service_type: str) -> str:
-        """Gets the specified random ApResolve url
+    def get_endpoints(service_type: str) -> typing.List[str]:
+        """Gets the endpoints of a service from ApResolve, or the built-in
+        list if ApResolve can't be reached
 
         :param service_type: str:
-        :returns: A random ApResolve url will be returned
+        :returns: List of host:port strings
 
         """
-        pool = ApResolver.request(service_type)
-        urls = pool.get(service_type)
+        try:
+            urls = ApResolver.request(service_type).get(service_type)
+        except (requests.RequestException, RuntimeError, ValueError) as ex:
+            ApResolver.logger.debug("ApResolve failed for {}: {}".format(
+                service_type, ex))
+            urls = None
         if urls is None or len(urls) == 0:
+            return list(ApResolver.fallback[service_type])
+        return urls
+
+    @staticmethod
+    def get_random_of(service_type: str) -> str:
+        """Gets the best ranked endpoint of a service, ties are broken at
+        random
+
+        :param service_type: str:
+        :returns: An endpoint url will be returned
+
+        """
+        urls = ApResolver.get_ranked_of(service_type)
+        if len(urls) == 0:
             raise RuntimeError("No ApResolve url available")
-        return random.choice(urls)
+        return urls[0]
+
+    @staticmethod
+    def get_ranked_of(service_type: str) -> typing.List[str]:
+        """Gets the endpoints of a service, best ranked first
+
+        :param service_type: str:
+
+        """
+        return ApResolver.selector().rank(
+            ApResolver.get_endpoints(service_type))
 
     @staticmethod
     def get_random_dealer() -> str:
@@ -464,10 +532,7 @@ class ApResolver:
         :returns: dealer endpoint url
 
         """
-        app_names = ["gae2-dealer.spotify.com:443","guc3-dealer.spotify.com:443","gue1-dealer.spotify.com:443","gew1-dealer.spotify.com:443"]
-        random.sample(app_names, len(app_names))
-        return random.choice(app_names)
-    #    return ApResolver.get_random_of("dealer")
+        return ApResolver.get_random_of("dealer")
 
     @staticmethod
     def get_random_spclient() -> str:
@@ -477,10 +542,7 @@ class ApResolver:
         :returns: spclient endpoint url
 
         """
-        app_names = ["gae2-spclient.spotify.com:443","guc3-spclient.spotify.com:443","gue1-spclient.spotify.com:443","gew4-spclient.spotify.com:443"]
-        random.sample(app_names, len(app_names))
-        return random.choice(app_names)
-    #    return ApResolver.get_random_of("spclient")
+        return ApResolver.get_random_of("spclient")
 
     @staticmethod
     def get_random_accesspoint() -> str:
@@ -490,30 +552,46 @@ class ApResolver:
         :returns: accesspoint endpoint url
 
         """
-        app_names = ["ap-gae2.spotify.com:4070","ap-gae2.spotify.com:443","ap-gae2.spotify.com:80","ap-guc3.spotify.com:4070","ap-gew1.spotify.com:443","ap-gew4.spotify.com:80"]
-        random.sample(app_names, len(app_names))
-        return random.choice(app_names)
-   #     return ApResolver.get_random_of("accesspoint")
+        return ApResolver.get_random_of("accesspoint")
 
+    @staticmethod
+    def get_ranked_accesspoints() -> typing.List[str]:
+        """Get accesspoint endpoint urls, best ranked first"""
+        return ApResolver.get_ranked_of("accesspoint")
+
+    @staticmethod
+    def selector() -> EndpointSelector:
+        """The EndpointSelector shared by the process"""
+        with ApResolver.__cache_lock:
+            if ApResolver.__selector is None:
+                ApResolver.__selector = EndpointSelector()
+            return ApResolver.__selector
 
 
 class DealerClient(Closeable):
     """ """
     logger = logging.getLogger("Librespot:DealerClient")
     __connection: typing.Union[ConnectionHolder, None]
-    __last_scheduled_reconnection: typing.Union[sched.Event, None]
-    __message_listeners: typing.Dict[MessageListener, typing.List[str]] = {}
-
-    __request_listeners: typing.Dict[str, RequestListener] = {}
-    
+    __last_scheduled_reconnection: typing.Union[util.TimerWheel.Timer,
+                                                None] = None
+    __message_listeners: typing.Dict[MessageListener, typing.List[str]]
+    __message_listeners_lock: threading.Condition
+    __message_router: util.PrefixRouter
+    __request_listeners: typing.Dict[str, RequestListener]
+    __request_listeners_lock: threading.Condition
+    __request_router: util.PrefixRouter
     __session: Session
-    __worker = concurrent.futures.ThreadPoolExecutor()
+    __worker: concurrent.futures.ThreadPoolExecutor
 
     def __init__(self, session: Session):
-        self.__session = session
-        self.__scheduler = sched.scheduler()
-        self.__request_listeners_lock = threading.Condition()
+        self.__message_listeners = {}
         self.__message_listeners_lock = threading.Condition()
+        self.__message_router = util.PrefixRouter()
+        self.__request_listeners = {}
+        self.__request_listeners_lock = threading.Condition()
+        self.__request_router = util.PrefixRouter()
+        self.__session = session
+        self.__worker = concurrent.futures.ThreadPoolExecutor()
     def add_message_listener(self, listener: MessageListener,
                              uris: list[str]) -> None:
         """
@@ -527,6 +605,8 @@ class DealerClient(Closeable):
                 raise TypeError(
                     "A listener for {} has already been added.".format(uris))
             self.__message_listeners[listener] = uris
+            for uri in uris:
+                self.__message_router.add(uri, listener)
             self.__message_listeners_lock.notify_all()
 
     def add_request_listener(self, listener: RequestListener, uri: str):
@@ -541,10 +621,14 @@ class DealerClient(Closeable):
                 raise TypeError(
                     "A listener for '{}' has already been added.".format(uri))
             self.__request_listeners[uri] = listener
+            self.__request_router.add(uri, listener)
             self.__request_listeners_lock.notify_all()
 
     def close(self) -> None:
         """ """
+        if self.__last_scheduled_reconnection is not None:
+            self.__last_scheduled_reconnection.cancel()
+            self.__last_scheduled_reconnection = None
         self.__worker.shutdown()
 
     def connect(self) -> None:
@@ -568,8 +652,8 @@ class DealerClient(Closeable):
             self.__last_scheduled_reconnection = None
             self.connect()
 
-        self.__last_scheduled_reconnection = self.__scheduler.enter(
-            10, 1, anonymous)
+        self.__last_scheduled_reconnection = util.TimerWheel.instance(
+        ).schedule_blocking(10, anonymous)
 
     def handle_message(self, obj: typing.Any) -> None:
         """
@@ -592,22 +676,11 @@ class DealerClient(Closeable):
                     decoded_payloads = gzip.decompress(decoded_payloads)
         else:
             decoded_payloads = b""
-        interesting = False
-        with self.__message_listeners_lock:
-            for listener in self.__message_listeners:
-                dispatched = False
-                keys = self.__message_listeners.get(listener)
-                for key in keys:
-                    if uri.startswith(key) and not dispatched:
-                        interesting = True
-
-                        def anonymous():
-                            """ """
-                            listener.on_message(uri, headers, decoded_payloads)
-
-                        self.__worker.submit(anonymous)
-                        dispatched = True
-        if not interesting:
+        listeners = self.__message_router.match(uri)
+        for listener in listeners:
+            self.__worker.submit(listener.on_message, uri, headers,
+                                 decoded_payloads)
+        if len(listeners) == 0:
             self.logger.debug("Couldn't dispatch message: {}".format(uri))
 
     def handle_request(self, obj: typing.Any) -> None:
@@ -629,24 +702,20 @@ class DealerClient(Closeable):
         self.logger.debug(
             "Received request. [mid: {}, key: {}, pid: {}, sender: {}, command: {}]"
             .format(mid, key, pid, sender, command))
-        interesting = False
-        with self.__request_listeners_lock:
-            for mid_prefix in self.__request_listeners:
-                if mid.startswith(mid_prefix):
-                    listener = self.__request_listeners.get(mid_prefix)
-                    interesting = True
-
-                    def anonymous():
-                        """ """
-                        result = listener.on_request(mid, pid, sender, command)
-                        if self.__connection is not None:
-                            self.__connection.send_reply(key, result)
-                        self.logger.warning(
-                            "Handled request. [key: {}, result: {}]".format(
-                                key, result))
-
-                    self.__worker.submit(anonymous)
-        if not interesting:
+        listeners = self.__request_router.match(mid)
+        for listener in listeners:
+
+            def anonymous(listener: RequestListener = listener):
+                """ """
+                result = listener.on_request(mid, pid, sender, command)
+                if self.__connection is not None:
+                    self.__connection.send_reply(key, result)
+                self.logger.warning(
+                    "Handled request. [key: {}, result: {}]".format(
+                        key, result))
+
+            self.__worker.submit(anonymous)
+        if len(listeners) == 0:
             self.logger.debug("Couldn't dispatch request: {}".format(mid))
 
     def remove_message_listener(self, listener: MessageListener) -> None:
@@ -657,6 +726,7 @@ class DealerClient(Closeable):
         """
         with self.__message_listeners_lock:
             self.__message_listeners.pop(listener)
+            self.__message_router.remove_value(listener)
 
     def remove_request_listener(self, listener: RequestListener) -> None:
         """
@@ -670,6 +740,7 @@ class DealerClient(Closeable):
                 if value != listener:
                     request_listeners[key] = value
             self.__request_listeners = request_listeners
+            self.__request_router.remove_value(listener)
 
     def wait_for_listener(self) -> None:
         """ """
@@ -688,7 +759,8 @@ class DealerClient(Closeable):
         """ """
         __closed = False
         __dealer_client: DealerClient
-        __last_scheduled_ping: sched.Event
+        __last_scheduled_ping: typing.Union[util.TimerWheel.Timer, None] = None
+        __pong_check: typing.Union[util.TimerWheel.Timer, None] = None
         __received_pong = False
         __session: Session
         __url: str
@@ -699,7 +771,6 @@ class DealerClient(Closeable):
             self.__session = session
             self.__dealer_client = dealer_client
             self.__url = url
-            self.__scheduler = sched.scheduler()
             self.__ws = websocket.WebSocketApp(url)
 
         def close(self):
@@ -708,7 +779,11 @@ class DealerClient(Closeable):
                 self.__ws.close()
                 self.__closed = True
             if self.__last_scheduled_ping is not None:
-                self.__scheduler.cancel(self.__last_scheduled_ping)
+                self.__last_scheduled_ping.cancel()
+                self.__last_scheduled_ping = None
+            if self.__pong_check is not None:
+                self.__pong_check.cancel()
+                self.__pong_check = None
 
         def on_failure(self, ws: websocket.WebSocketApp, error):
             """
@@ -775,12 +850,11 @@ class DealerClient(Closeable):
                         return
                     self.__received_pong = False
 
-                self.__scheduler.enter(3, 1, anonymous2)
-                self.__last_scheduled_ping = self.__scheduler.enter(
-                    30, 1, anonymous)
+                self.__pong_check = timers.schedule(3, anonymous2)
+                self.__last_scheduled_ping = timers.schedule(30, anonymous)
 
-            self.__last_scheduled_ping = self.__scheduler.enter(
-                30, 1, anonymous)
+            timers = util.TimerWheel.instance()
+            self.__last_scheduled_ping = timers.schedule(30, anonymous)
 
         def send_ping(self):
             """ """
@@ -811,14 +885,197 @@ class DealerClient(Closeable):
         RATE_LIMITED = 7
 
 
+class EndpointSelector:
+    """Ranks endpoints by TCP connect round-trip time and recent failures
+
+    Failures add a penalty that halves every penalty_half_life seconds, so
+    a demoted endpoint recovers on its own. Endpoints whose measurement is
+    older than probe_interval are probed again in the background. Scores
+    can be kept across restarts in a small JSON state file.
+
+    """
+    logger = logging.getLogger("Librespot:EndpointSelector")
+    failure_penalty_ms = 2000.0
+    penalty_half_life = 5 * 60
+    probe_interval = 60 * 60
+    probe_timeout = 2.0
+    rtt_smoothing = 0.3
+    unknown_rtt_ms = 250.0
+    __lock: threading.Lock
+    __probing: typing.Set[str]
+    __save_lock: threading.Lock
+    __scores: typing.Dict[str, typing.Dict[str, float]]
+    __state_file: typing.Union[str, None]
+    __worker = concurrent.futures.ThreadPoolExecutor(
+        max_workers=4, thread_name_prefix="endpoint-probe")
+
+    def __init__(self, state_file: str = None):
+        self.__lock = threading.Lock()
+        self.__probing = set()
+        self.__save_lock = threading.Lock()
+        self.__scores = {}
+        self.__state_file = None
+        if state_file is not None:
+            self.set_state_file(state_file)
+
+    def probe(self, endpoint: str) -> typing.Union[float, None]:
+        """Measure the TCP connect time of an endpoint
+
+        :param endpoint: str:
+        :returns: Round-trip time in milliseconds, None if it failed
+
+        """
+        host, port = endpoint.rsplit(":", 1)
+        start = time.perf_counter()
+        try:
+            sock = socket.create_connection((host, int(port)),
+                                            timeout=self.probe_timeout)
+        except OSError as ex:
+            self.logger.debug("Probe of {} failed: {}".format(endpoint, ex))
+            self.report_failure(endpoint)
+            return None
+        finally:
+            with self.__lock:
+                self.__probing.discard(endpoint)
+        rtt = (time.perf_counter() - start) * 1000
+        sock.close()
+        self.report_success(endpoint, rtt)
+        return rtt
+
+    def rank(self, endpoints: typing.List[str]) -> typing.List[str]:
+        """Order endpoints from best to worst
+
+        Endpoints without a recent measurement are probed in the
+        background, the ranking uses what is already known.
+
+        :param endpoints: typing.List[str]:
+
+        """
+        now = time.time()
+        with self.__lock:
+            stale = [
+                endpoint for endpoint in endpoints
+                if endpoint not in self.__probing and now - self.__scores.get(
+                    endpoint, {}).get("probed", 0) > self.probe_interval
+            ]
+            self.__probing.update(stale)
+            scored = [(self.__score(endpoint, now), random.random(), endpoint)
+                      for endpoint in endpoints]
+        for endpoint in stale:
+            self.__worker.submit(self.probe, endpoint)
+        return [endpoint for _, _, endpoint in sorted(scored)]
+
+    def report_failure(self, endpoint: str) -> None:
+        """Demote an endpoint after a failed connection
+
+        :param endpoint: str:
+
+        """
+        now = time.time()
+        with self.__lock:
+            score = self.__scores.setdefault(endpoint, {})
+            score["penalty"] = self.__penalty(score, now) + \
+                self.failure_penalty_ms
+            score["updated"] = now
+            score["probed"] = now
+        self.save()
+
+    def report_success(self, endpoint: str, rtt_ms: float) -> None:
+        """Record the connect time of an endpoint
+
+        :param endpoint: str:
+        :param rtt_ms: float:
+
+        """
+        now = time.time()
+        with self.__lock:
+            score = self.__scores.setdefault(endpoint, {})
+            rtt = score.get("rtt")
+            score["rtt"] = rtt_ms if rtt is None else (
+                rtt + (rtt_ms - rtt) * self.rtt_smoothing)
+            score["penalty"] = self.__penalty(score, now)
+            score["updated"] = now
+            score["probed"] = now
+        self.save()
+
+    def save(self) -> None:
+        """Write the scores to the state file, if one is set
+
+        Probe workers save concurrently, writes are serialised so the
+        file always holds one complete snapshot.
+
+        """
+        state_file = self.__state_file
+        if state_file is None:
+            return
+        with self.__save_lock:
+            with self.__lock:
+                data = json.dumps(self.__scores)
+            try:
+                os.makedirs(os.path.dirname(state_file) or os.curdir,
+                            exist_ok=True)
+                temp = state_file + ".tmp"
+                with open(temp, "w") as f:
+                    f.write(data)
+                os.replace(temp, state_file)
+            except OSError as ex:
+                self.logger.debug(
+                    "Couldn't save endpoint scores: {}".format(ex))
+
+    def scores(self) -> typing.Dict[str, float]:
+        """Current score of every known endpoint, lower is better"""
+        now = time.time()
+        with self.__lock:
+            return {
+                endpoint: self.__score(endpoint, now)
+                for endpoint in self.__scores
+            }
+
+    def set_state_file(self, state_file: str) -> None:
+        """Load scores from a state file and keep it updated
+
+        :param state_file: str:
+
+        """
+        if state_file == self.__state_file:
+            return
+        self.__state_file = state_file
+        try:
+            with open(state_file) as f:
+                scores = json.load(f)
+        except (OSError, ValueError):
+            return
+        if type(scores) is dict:
+            with self.__lock:
+                for endpoint, score in scores.items():
+                    if type(score) is dict:
+                        self.__scores.setdefault(endpoint, score)
+
+    def __penalty(self, score: typing.Dict[str, float], now: float) -> float:
+        penalty = score.get("penalty", 0.0)
+        if penalty == 0:
+            return 0.0
+        elapsed = max(0.0, now - score.get("updated", now))
+        return penalty * math.pow(0.5, elapsed / self.penalty_half_life)
+
+    def __score(self, endpoint: str, now: float) -> float:
+        score = self.__scores.get(endpoint)
+        if score is None:
+            return self.unknown_rtt_ms
+        rtt = score.get("rtt")
+        return ((self.unknown_rtt_ms if rtt is None else rtt) +
+                self.__penalty(score, now))
+
+
 class EventService(Closeable):
     """ """
     logger = logging.getLogger("Librespot:EventService")
     __session: Session
-    __worker = concurrent.futures.ThreadPoolExecutor()
+    __worker: concurrent.futures.ThreadPoolExecutor
 
     def __init__(self, session: Session):
         self.__session = session
+        self.__worker = concurrent.futures.ThreadPoolExecutor()
 
     def __worker_callback(self, event_builder: EventBuilder):
         try:
@@ -963,16 +1220,15 @@ class MessageType(enum.Enum):
 
 class Session(Closeable, MessageListener, SubListener):
     """ """
-    cipher_pair: typing.Union[CipherPair, None]
+    cipher_pair: typing.Union[CipherPair, None] = None
     country_code: str = "EN"
     connection: typing.Union[ConnectionHolder, None]
     logger = logging.getLogger("Librespot:Session")
-    scheduled_reconnect: typing.Union[sched.Event, None] = None
-    scheduler = sched.scheduler(time.time)
+    scheduled_reconnect: typing.Union[util.TimerWheel.Timer, None] = None
     __api: ApiClient
     __ap_welcome: Authentication.APWelcome
     __audio_key_manager: typing.Union[AudioKeyManager, None] = None
-    __auth_lock = threading.Condition()
+    __auth_lock: threading.Condition
     __auth_lock_bool = False
     __cache_manager: typing.Union[CacheManager, None]
     __cdn_manager: typing.Union[CdnManager, None]
@@ -983,10 +1239,17 @@ class Session(Closeable, MessageListener, SubListener):
     __content_feeder: typing.Union[PlayableContentFeeder, None]
     __dealer_client: typing.Union[DealerClient, None] = None
     __event_service: typing.Union[EventService, None] = None
+    __in_flight: InFlightRequests
     __keys: DiffieHellman
     __mercury_client: MercuryClient
+    __packet_dispatcher: PacketDispatcher
     __receiver: typing.Union[Receiver, None] = None
+    __reconnect_lock: threading.RLock
     __search: typing.Union[SearchManager, None]
+    __send_connection: typing.Union[ConnectionHolder, None] = None
+    __send_lock: threading.Lock
+    __sender: typing.Union[Sender, None] = None
+    __single_flight: util.SingleFlight
     __server_key = (b"\xac\xe0F\x0b\xff\xc20\xaf\xf4k\xfe\xc3\xbf\xbf\x86="
                     b"\xa1\x91\xc6\xcc3l\x93\xa1O\xb3\xb0\x16\x12\xac\xacj"
                     b"\xf1\x80\xe7\xf6\x14\xd9B\x9d\xbe.4fC\xe3b\xd22z\x1a"
@@ -1003,14 +1266,36 @@ class Session(Closeable, MessageListener, SubListener):
                     b"\x9d\xb3\x08l\x19\x0eH\xb3\x9df\xeb\x00\x06\xa2Z\xee\xa1"
                     b"\x1b\x13\x87<\xd7\x19\xe6U\xbd")
     __stored_str: str = ""
-    __token_provider: typing.Union[TokenProvider, None]
-    __user_attributes = {}
+    __token_provider: typing.Union[TokenProvider, None] = None
+    __user_attributes: typing.Dict[str, str]
 
     def __init__(self, inner: Inner, address: str) -> None:
+        self.__auth_lock = threading.Condition()
+        self.__user_attributes = {}
         self.__client = Session.create_client(inner.conf)
-        self.connection = Session.ConnectionHolder.create(address, None)
+        self.connection = Session.ConnectionHolder.create(address, inner.conf)
         self.__inner = inner
+        self.__in_flight = Session.InFlightRequests()
+        self.__single_flight = util.SingleFlight()
         self.__keys = DiffieHellman()
+        self.__reconnect_lock = threading.RLock()
+        self.__send_lock = threading.Lock()
+        if inner.conf.send_queue:
+            self.__sender = Session.Sender(self.__send_queued,
+                                           self.__handle_send_error)
+        self.__packet_dispatcher = Session.PacketDispatcher(
+            inner.conf.receive_queue_size)
+        self.__packet_dispatcher.register(Packet.Type.ping, self.__handle_ping)
+        self.__packet_dispatcher.register(Packet.Type.pong_ack, lambda _: None)
+        self.__packet_dispatcher.register(Packet.Type.country_code,
+                                          self.__handle_country_code)
+        self.__packet_dispatcher.register(Packet.Type.license_version,
+                                          self.__handle_license_version)
+        self.__packet_dispatcher.register(Packet.Type.unknown_0x10,
+                                          self.__handle_unknown_0x10)
+        self.__packet_dispatcher.register(
+            Packet.Type.product_info,
+            lambda packet: self.parse_product_info(packet.payload))
         self.logger.info("Created new session! device_id: {}, ap: {}".format(
             inner.device_id, address))
 
@@ -1056,6 +1341,26 @@ class Session(Closeable, MessageListener, SubListener):
             self.__dealer_client = DealerClient(self)
             self.__search = SearchManager(self)
             self.__event_service = EventService(self)
+            self.__packet_dispatcher.register_receiver(
+                self.__mercury_client,
+                Packet.Type.mercury_sub,
+                Packet.Type.mercury_unsub,
+                Packet.Type.mercury_event,
+                Packet.Type.mercury_req,
+                lane="mercury",
+            )
+            self.__packet_dispatcher.register_receiver(
+                self.__audio_key_manager,
+                Packet.Type.aes_key,
+                Packet.Type.aes_key_error,
+                lane="audio-key",
+            )
+            self.__packet_dispatcher.register_receiver(
+                self.__channel_manager,
+                Packet.Type.channel_error,
+                Packet.Type.stream_chunk_res,
+                lane="channel",
+            )
             self.__auth_lock_bool = False
             self.__auth_lock.notify_all()
         self.dealer().connect()
@@ -1095,6 +1400,11 @@ class Session(Closeable, MessageListener, SubListener):
         self.logger.info("Closing session. device_id: {}".format(
             self.__inner.device_id))
         self.__closing = True
+        if self.scheduled_reconnect is not None:
+            self.scheduled_reconnect.cancel()
+            self.scheduled_reconnect = None
+        if self.__token_provider is not None:
+            self.__token_provider.close()
         if self.__dealer_client is not None:
             self.__dealer_client.close()
             self.__dealer_client = None
@@ -1109,6 +1419,10 @@ class Session(Closeable, MessageListener, SubListener):
         if self.__receiver is not None:
             self.__receiver.stop()
             self.__receiver = None
+        self.__packet_dispatcher.close()
+        if self.__sender is not None:
+            self.__sender.close()
+            self.__sender = None
         if self.__client is not None:
             self.__client.close()
             self.__client = None
@@ -1117,11 +1431,18 @@ class Session(Closeable, MessageListener, SubListener):
             self.connection = None
         with self.__auth_lock:
             self.__ap_welcome = None
+            if self.cipher_pair is not None:
+                self.cipher_pair.close()
             self.cipher_pair = None
             self.__closed = True
+            self.__auth_lock.notify_all()
         self.logger.info("Closed session. device_id: {}".format(
             self.__inner.device_id))
 
+    def configuration(self) -> Configuration:
+        """ """
+        return self.__inner.conf
+
     def connect(self) -> None:
         """Connect to the Spotify Server"""
         acc = Session.Accumulator()
@@ -1149,11 +1470,11 @@ class Session(Closeable, MessageListener, SubListener):
         # Read APResponseMessage
         try:
             ap_response_message_length = self.connection.read_int()
-        except struct.error:
+        except (struct.error, ConnectionError):
             time.sleep(1)
             ap_response_message_length = self.connection.read_int()
         acc.write_int(ap_response_message_length)
-        ap_response_message_bytes = self.connection.read(
+        ap_response_message_bytes = self.connection.read_exact(
             ap_response_message_length - 4)
         acc.write(ap_response_message_bytes)
         ap_response_message_proto = Keyexchange.APResponseMessage()
@@ -1211,9 +1532,16 @@ class Session(Closeable, MessageListener, SubListener):
         finally:
             self.connection.set_timeout(0)
         buffer.seek(20)
-        with self.__auth_lock:
-            self.cipher_pair = CipherPair(buffer.read(32), buffer.read(32))
+        with self.__auth_lock, self.__send_lock:
+            if self.cipher_pair is not None:
+                self.cipher_pair.close()
+            self.cipher_pair = CipherPair(
+                buffer.read(32),
+                buffer.read(32),
+                precompute=self.__inner.conf.precompute_send_nonces)
             self.__auth_lock_bool = True
+        self.connection.set_flush_deadline(
+            self.__inner.conf.flush_deadline_us)
         self.logger.info("Connection successfully!")
 
     def content_feeder(self) -> PlayableContentFeeder:
@@ -1303,6 +1631,10 @@ class Session(Closeable, MessageListener, SubListener):
         if uri == "hm://connect-state/v1/connect/logout":
             self.close()
 
+    def packet_dispatcher(self) -> PacketDispatcher:
+        """ """
+        return self.__packet_dispatcher
+
     def parse_product_info(self, data) -> None:
         """Parse product information
 
@@ -1324,8 +1656,25 @@ class Session(Closeable, MessageListener, SubListener):
         """ """
         return self.__inner.preferred_locale
 
-    def reconnect(self) -> None:
-        """Reconnect to the Spotify Server"""
+    def reconnect(self, failed: ConnectionHolder = None) -> None:
+        """Reconnect to the Spotify Server
+
+        Concurrent calls run one after the other. A call for a failed
+        connection that another thread already replaced does nothing, so
+        the receiver and the sender noticing the same dead socket
+        reconnect and replay the in-flight requests only once.
+
+        :param failed: Connection the caller saw fail, None reconnects
+            unconditionally  (Default value = None)
+
+        """
+        with self.__reconnect_lock:
+            if failed is not None and failed is not self.connection:
+                self.logger.debug("Connection was already replaced")
+                return
+            self.__reconnect()
+
+    def __reconnect(self) -> None:
         if self.connection is not None:
             self.connection.close()
         if self.__receiver is not None:  
@@ -1354,11 +1703,20 @@ class Session(Closeable, MessageListener, SubListener):
                 self.logger.warning("Librespot re-connect failed to authenticate due to %s", e)
         self.logger.info("Re-authenticated as {}!".format(
             self.__ap_welcome.canonical_username))
+        if self.__mercury_client is not None:
+            self.__mercury_client.discard_partials(
+                key[1] for key in self.__in_flight.keys()
+                if key[0] == "mercury")
+        self.__in_flight.replay(self, self.__inner.conf.replay_budget)
 
     def reconnecting(self) -> bool:
         """ """
         return not self.__closing and not self.__closed and self.connection is None
     
+    def in_flight(self) -> InFlightRequests:
+        """Requests that are sent again after a reconnect"""
+        return self.__in_flight
+
     def is_connected(self) -> bool:
         if not self.__receiver:
            return False 
@@ -1379,13 +1737,21 @@ class Session(Closeable, MessageListener, SubListener):
         """
         return self.__api.track_metadata_api(track)
 
-    def send(self, cmd: bytes, payload: bytes):
+    def send(self,
+             cmd: bytes,
+             payload: bytes,
+             priority: Packet.Priority = None):
         """Send data to socket using send_unchecked
 
+        With the send queue enabled the packet is handed to the writer
+        thread and this returns without waiting for authentication.
+
         :param cmd: Command
         :param payload: Payload
         :param cmd: bytes:
         :param payload: bytes:
+        :param priority: Lane of the send queue, derived from the command
+            when None  (Default value = None)
 
         """
         if self.__closing and self.connection is None:
@@ -1393,6 +1759,9 @@ class Session(Closeable, MessageListener, SubListener):
             return
         if self.__closed:
             raise RuntimeError("Session is closed!")
+        if self.__sender is not None:
+            self.__sender.send(cmd, payload, priority)
+            return
         with self.__auth_lock:
             if self.cipher_pair is None or self.__auth_lock_bool:
                 self.__auth_lock.wait()
@@ -1487,8 +1856,81 @@ class Session(Closeable, MessageListener, SubListener):
         else:
             raise RuntimeError("Unknown CMD 0x" + packet.cmd.hex())
 
+    def __handle_country_code(self, packet: Packet) -> None:
+        self.country_code = packet.payload.decode()
+        self.logger.info("Received country_code: {}".format(
+            self.country_code))
+
+    def __handle_license_version(self, packet: Packet) -> None:
+        license_version = io.BytesIO(packet.payload)
+        license_id = struct.unpack(">h", license_version.read(2))[0]
+        if license_id != 0:
+            buffer = license_version.read()
+            self.logger.info("Received license_version: {}, {}".format(
+                license_id, buffer.decode()))
+        else:
+            self.logger.info("Received license_version: {}".format(license_id))
+
+    def __handle_ping(self, packet: Packet) -> None:
+        if self.scheduled_reconnect is not None:
+            self.scheduled_reconnect.cancel()
+
+        def anonymous():
+            """ """
+            self.logger.warning("Socket timed out. Reconnecting...")
+            self.reconnect()
+
+        self.scheduled_reconnect = util.TimerWheel.instance(
+        ).schedule_blocking(2 * 60 + 5, anonymous)
+        connection = self.connection
+        try:
+            self.send(Packet.Type.pong, packet.payload)
+        except ConnectionError:
+            if self.scheduled_reconnect is not None:
+                self.scheduled_reconnect.cancel()
+                self.scheduled_reconnect = None
+            self.reconnect(connection)
+
+    def __handle_unknown_0x10(self, packet: Packet) -> None:
+        self.logger.debug("Received 0x10: {}".format(
+            util.bytes_to_hex(packet.payload)))
+
+    def single_flight(self) -> util.SingleFlight:
+        """Coalesces identical concurrent requests of this session"""
+        return self.__single_flight
+
+    def sender(self) -> typing.Union[Sender, None]:
+        """ """
+        return self.__sender
+
+    def __send_queued(self, cmd: bytes, payload: bytes) -> None:
+        while True:
+            with self.__send_lock:
+                if self.__closed:
+                    return
+                if self.cipher_pair is not None and not self.__auth_lock_bool:
+                    self.__send_connection = self.connection
+                    self.cipher_pair.send_encoded(self.connection, cmd,
+                                                  payload)
+                    return
+            with self.__auth_lock:
+                self.__auth_lock.wait_for(
+                    lambda: self.__closed or self.cipher_pair is not None and
+                    not self.__auth_lock_bool)
+
+    def __handle_send_error(self, ex: Exception) -> None:
+        if not isinstance(ex, ConnectionError) or self.__closing:
+            self.logger.warning("Failed sending packet: {}".format(ex))
+            return
+        self.logger.warning("Connection lost while sending: {}".format(ex))
+        if self.scheduled_reconnect is not None:
+            self.scheduled_reconnect.cancel()
+            self.scheduled_reconnect = None
+        self.reconnect(self.__send_connection)
+
     def __send_unchecked(self, cmd: bytes, payload: bytes) -> None:
-        self.cipher_pair.send_encoded(self.connection, cmd, payload)
+        with self.__send_lock:
+            self.cipher_pair.send_encoded(self.connection, cmd, payload)
 
     def __wait_auth_lock(self) -> None:
         if self.__closing and self.connection is None:
@@ -1607,6 +2049,8 @@ class Session(Closeable, MessageListener, SubListener):
 
     class Builder(AbsBuilder):
         """ """
+        connect_attempts = 4
+
         def __init__(self):
             super().__init__()
             self.login_credentials: Authentication.LoginCredentials = None
@@ -1782,34 +2226,30 @@ class Session(Closeable, MessageListener, SubListener):
             """
             if self.login_credentials is None:
                 raise RuntimeError("You must select an authentication method.")
-            session = Session(
-                Session.Inner(
-                    self.device_type,
-                    self.device_name,
-                    self.preferred_locale,
-                    self.conf,
-                    self.device_id,
-                ),
-                ApResolver,
-            )
-            for _ in range(4):
+            for attempt in range(self.connect_attempts):
+                session = None
                 try:
+                    # Session() already races the access points, so it's
+                    # retried together with connect()
+                    session = Session(
+                        Session.Inner(
+                            self.device_type,
+                            self.device_name,
+                            self.preferred_locale,
+                            self.conf,
+                            self.device_id,
+                        ),
+                        ApResolver,
+                    )
                     session.connect()
                     break
-                except struct.error as e:
+                except (struct.error, ConnectionError) as e:
+                    if session is not None:
+                        session.close()
+                    if attempt + 1 == self.connect_attempts:
+                        raise
+                    logger.warning("Connecting failed, retrying: {}".format(e))
                     time.sleep(1)
-                    print(e)
-                    session.close()
-                    session = Session(
-                Session.Inner(
-                    self.device_type,
-                    self.device_name,
-                    self.preferred_locale,
-                    self.conf,
-                    self.device_id,
-                ),
-                ApResolver,
-                    )
             session.authenticate(self.login_credentials)
             return session
 
@@ -1836,6 +2276,27 @@ class Session(Closeable, MessageListener, SubListener):
         # Fetching
         retry_on_chunk_error: bool
 
+        # Connection
+        precompute_send_nonces: int
+        flush_deadline_us: int
+        receive_queue_size: int
+        send_queue: bool
+        connect_stagger_ms: int
+        connect_timeout: float
+        replay_budget: int
+        mercury_cache_size: int
+        mercury_cache_disk_size: int
+        audio_key_cache_size: int
+        audio_key_cache_ttl: float
+        audio_key_cache_disk_size: int
+        use_head_files: bool
+        fast_start_size: int
+        progressive_chunks: bool
+        read_ahead_chunks: int
+        read_ahead_max_chunks: int
+        read_ahead_memory: int
+        endpoint_state_file: typing.Union[str, None]
+
         def __init__(
             self,
             # proxy_enabled: bool,
@@ -1851,6 +2312,25 @@ class Session(Closeable, MessageListener, SubListener):
             store_credentials: bool,
             stored_credentials_file: str,
             retry_on_chunk_error: bool,
+            precompute_send_nonces: int = 0,
+            flush_deadline_us: int = 0,
+            receive_queue_size: int = 0,
+            send_queue: bool = False,
+            connect_stagger_ms: int = 250,
+            connect_timeout: float = 10.0,
+            replay_budget: int = 64,
+            mercury_cache_size: int = 0,
+            mercury_cache_disk_size: int = 0,
+            audio_key_cache_size: int = 0,
+            audio_key_cache_ttl: float = 7 * 24 * 3600,
+            audio_key_cache_disk_size: int = 0,
+            use_head_files: bool = False,
+            fast_start_size: int = 0,
+            progressive_chunks: bool = False,
+            read_ahead_chunks: int = 3,
+            read_ahead_max_chunks: int = 8,
+            read_ahead_memory: int = 64 * 1024 * 1024,
+            endpoint_state_file: str = None,
         ):
             # self.proxyEnabled = proxy_enabled
             # self.proxyType = proxy_type
@@ -1865,6 +2345,25 @@ class Session(Closeable, MessageListener, SubListener):
             self.store_credentials = store_credentials
             self.stored_credentials_file = stored_credentials_file
             self.retry_on_chunk_error = retry_on_chunk_error
+            self.precompute_send_nonces = precompute_send_nonces
+            self.flush_deadline_us = flush_deadline_us
+            self.receive_queue_size = receive_queue_size
+            self.send_queue = send_queue
+            self.connect_stagger_ms = connect_stagger_ms
+            self.connect_timeout = connect_timeout
+            self.replay_budget = replay_budget
+            self.mercury_cache_size = mercury_cache_size
+            self.mercury_cache_disk_size = mercury_cache_disk_size
+            self.audio_key_cache_size = audio_key_cache_size
+            self.audio_key_cache_ttl = audio_key_cache_ttl
+            self.audio_key_cache_disk_size = audio_key_cache_disk_size
+            self.use_head_files = use_head_files
+            self.fast_start_size = fast_start_size
+            self.progressive_chunks = progressive_chunks
+            self.read_ahead_chunks = read_ahead_chunks
+            self.read_ahead_max_chunks = read_ahead_max_chunks
+            self.read_ahead_memory = read_ahead_memory
+            self.endpoint_state_file = endpoint_state_file
 
         class Builder:
             """ """
@@ -1891,6 +2390,27 @@ class Session(Closeable, MessageListener, SubListener):
             # Fetching
                 self.retry_on_chunk_error: bool = True
 
+            # Connection
+                self.precompute_send_nonces: int = 0
+                self.flush_deadline_us: int = 0
+                self.receive_queue_size: int = 0
+                self.send_queue: bool = False
+                self.connect_stagger_ms: int = 250
+                self.connect_timeout: float = 10.0
+                self.replay_budget: int = 64
+                self.mercury_cache_size: int = 0
+                self.mercury_cache_disk_size: int = 0
+                self.audio_key_cache_size: int = 0
+                self.audio_key_cache_ttl: float = 7 * 24 * 3600
+                self.audio_key_cache_disk_size: int = 0
+                self.use_head_files: bool = False
+                self.fast_start_size: int = 0
+                self.progressive_chunks: bool = False
+                self.read_ahead_chunks: int = 3
+                self.read_ahead_max_chunks: int = 8
+                self.read_ahead_memory: int = 64 * 1024 * 1024
+                self.endpoint_state_file: typing.Union[str, None] = None
+
             # def set_proxy_enabled(
             #         self,
             #         proxy_enabled: bool) -> Session.Configuration.Builder:
@@ -1996,6 +2516,296 @@ class Session(Closeable, MessageListener, SubListener):
                 self.retry_on_chunk_error = retry_on_chunk_error
                 return self
 
+            def set_precompute_send_nonces(
+                    self, precompute_send_nonces: int
+            ) -> Session.Configuration.Builder:
+                """Set precompute_send_nonces
+
+                Number of upcoming send nonces the cipher keys in the
+                background, 0 disables the precomputation.
+
+                :param precompute_send_nonces: int:
+                :returns: Builder
+
+                """
+                self.precompute_send_nonces = precompute_send_nonces
+                return self
+
+            def set_flush_deadline_us(
+                    self,
+                    flush_deadline_us: int) -> Session.Configuration.Builder:
+                """Set flush_deadline_us
+
+                Microseconds an outgoing packet may wait so that it is sent
+                together with the following ones, 0 sends every packet
+                immediately.
+
+                :param flush_deadline_us: int:
+                :returns: Builder
+
+                """
+                self.flush_deadline_us = flush_deadline_us
+                return self
+
+            def set_receive_queue_size(
+                    self,
+                    receive_queue_size: int) -> Session.Configuration.Builder:
+                """Set receive_queue_size
+
+                Size of the per-subsystem queues that Mercury, audio key
+                and channel packets are handed to by the receiver thread,
+                0 dispatches them on the receiver thread. Packets arriving
+                at a full queue are dropped.
+
+                :param receive_queue_size: int:
+                :returns: Builder
+
+                """
+                self.receive_queue_size = receive_queue_size
+                return self
+
+            def set_send_queue(
+                    self, send_queue: bool) -> Session.Configuration.Builder:
+                """Set send_queue
+
+                Send packets from a dedicated writer thread that serves
+                pong first, then audio keys and Mercury GETs, then
+                everything else.
+
+                :param send_queue: bool:
+                :returns: Builder
+
+                """
+                self.send_queue = send_queue
+                return self
+
+            def set_connect_stagger_ms(
+                    self,
+                    connect_stagger_ms: int) -> Session.Configuration.Builder:
+                """Set connect_stagger_ms
+
+                Delay before racing the next access point while the
+                previous connection attempt is still pending.
+
+                :param connect_stagger_ms: int:
+                :returns: Builder
+
+                """
+                self.connect_stagger_ms = connect_stagger_ms
+                return self
+
+            def set_connect_timeout(
+                    self,
+                    connect_timeout: float) -> Session.Configuration.Builder:
+                """Set connect_timeout
+
+                Seconds before giving up on all access points.
+
+                :param connect_timeout: float:
+                :returns: Builder
+
+                """
+                self.connect_timeout = connect_timeout
+                return self
+
+            def set_replay_budget(
+                    self, replay_budget: int) -> Session.Configuration.Builder:
+                """Set replay_budget
+
+                Maximum number of in-flight Mercury GET/SUB and audio key
+                requests sent again after a reconnect, 0 disables it.
+
+                :param replay_budget: int:
+                :returns: Builder
+
+                """
+                self.replay_budget = replay_budget
+                return self
+
+            def set_mercury_cache_size(
+                    self,
+                    mercury_cache_size: int) -> Session.Configuration.Builder:
+                """Set mercury_cache_size
+
+                Bytes of Mercury GET responses kept in memory, honouring
+                their MC-TTL and MC-ETag headers, 0 disables the cache.
+
+                :param mercury_cache_size: int:
+                :returns: Builder
+
+                """
+                self.mercury_cache_size = mercury_cache_size
+                return self
+
+            def set_mercury_cache_disk_size(
+                self, mercury_cache_disk_size: int
+            ) -> Session.Configuration.Builder:
+                """Set mercury_cache_disk_size
+
+                Bytes of Mercury GET responses kept in the cache directory
+                when both the cache and the Mercury cache are enabled.
+
+                :param mercury_cache_disk_size: int:
+                :returns: Builder
+
+                """
+                self.mercury_cache_disk_size = mercury_cache_disk_size
+                return self
+
+            def set_audio_key_cache_size(
+                    self,
+                    audio_key_cache_size: int) -> Session.Configuration.Builder:
+                """Set audio_key_cache_size
+
+                Number of audio keys kept in memory, 0 disables the audio
+                key cache.
+
+                :param audio_key_cache_size: int:
+                :returns: Builder
+
+                """
+                self.audio_key_cache_size = audio_key_cache_size
+                return self
+
+            def set_audio_key_cache_ttl(
+                    self,
+                    audio_key_cache_ttl: float) -> Session.Configuration.Builder:
+                """Set audio_key_cache_ttl
+
+                Seconds a cached audio key is used before it's requested
+                again.
+
+                :param audio_key_cache_ttl: float:
+                :returns: Builder
+
+                """
+                self.audio_key_cache_ttl = audio_key_cache_ttl
+                return self
+
+            def set_audio_key_cache_disk_size(
+                self, audio_key_cache_disk_size: int
+            ) -> Session.Configuration.Builder:
+                """Set audio_key_cache_disk_size
+
+                Number of encrypted audio keys kept in the cache directory
+                when both the cache and the audio key cache are enabled.
+                Their secret is kept in audio-keys.key next to the stored
+                credentials file, without one only the memory tier is used.
+
+                :param audio_key_cache_disk_size: int:
+                :returns: Builder
+
+                """
+                self.audio_key_cache_disk_size = audio_key_cache_disk_size
+                return self
+
+            def set_use_head_files(
+                    self, use_head_files: bool) -> Session.Configuration.Builder:
+                """Set use_head_files
+
+                Start streams from the head file while the first CDN chunk
+                is fetched in the background.
+
+                :param use_head_files: bool:
+                :returns: Builder
+
+                """
+                self.use_head_files = use_head_files
+                return self
+
+            def set_fast_start_size(
+                    self, fast_start_size: int) -> Session.Configuration.Builder:
+                """Set fast_start_size
+
+                Bytes asked for by the first request of a stream, the rest of
+                the first chunk is fetched in the background. 0 requests the
+                whole first chunk before returning, larger values are clamped
+                to the chunk size.
+
+                :param fast_start_size: int:
+                :returns: Builder
+
+                """
+                self.fast_start_size = fast_start_size
+                return self
+
+            def set_progressive_chunks(
+                    self,
+                    progressive_chunks: bool) -> Session.Configuration.Builder:
+                """Set progressive_chunks
+
+                Download chunks as a stream and let readers continue as soon
+                as the bytes they need are decrypted.
+
+                :param progressive_chunks: bool:
+                :returns: Builder
+
+                """
+                self.progressive_chunks = progressive_chunks
+                return self
+
+            def set_read_ahead_chunks(
+                    self,
+                    read_ahead_chunks: int) -> Session.Configuration.Builder:
+                """Set read_ahead_chunks
+
+                Chunks requested ahead of the read position of a stream at
+                least.
+
+                :param read_ahead_chunks: int:
+                :returns: Builder
+
+                """
+                self.read_ahead_chunks = read_ahead_chunks
+                return self
+
+            def set_read_ahead_max_chunks(
+                    self, read_ahead_max_chunks: int
+            ) -> Session.Configuration.Builder:
+                """Set read_ahead_max_chunks
+
+                Upper bound of the read-ahead window, which grows when
+                reads stall or outpace the downloads.
+
+                :param read_ahead_max_chunks: int:
+                :returns: Builder
+
+                """
+                self.read_ahead_max_chunks = read_ahead_max_chunks
+                return self
+
+            def set_read_ahead_memory(
+                    self,
+                    read_ahead_memory: int) -> Session.Configuration.Builder:
+                """Set read_ahead_memory
+
+                Bytes requested ahead by all streams together above which
+                windows shrink back to read_ahead_chunks. 0 disables the
+                limit.
+
+                :param read_ahead_memory: int:
+                :returns: Builder
+
+                """
+                self.read_ahead_memory = read_ahead_memory
+                return self
+
+            def set_endpoint_state_file(
+                self, endpoint_state_file: typing.Union[str, None]
+            ) -> Session.Configuration.Builder:
+                """Set endpoint_state_file
+
+                JSON file the access point scores are kept in across
+                restarts, e.g. endpoints.json in the cache directory. None
+                keeps them in memory only.
+
+                :param endpoint_state_file: typing.Union[str, None]:
+                :returns: Builder
+
+                """
+                self.endpoint_state_file = endpoint_state_file
+                return self
+
             def build(self) -> Session.Configuration:
                 """Build Configuration instance
 
@@ -2017,15 +2827,59 @@ class Session(Closeable, MessageListener, SubListener):
                     self.store_credentials,
                     self.stored_credentials_file,
                     self.retry_on_chunk_error,
+                    self.precompute_send_nonces,
+                    self.flush_deadline_us,
+                    self.receive_queue_size,
+                    self.send_queue,
+                    self.connect_stagger_ms,
+                    self.connect_timeout,
+                    self.replay_budget,
+                    self.mercury_cache_size,
+                    self.mercury_cache_disk_size,
+                    self.audio_key_cache_size,
+                    self.audio_key_cache_ttl,
+                    self.audio_key_cache_disk_size,
+                    self.use_head_files,
+                    self.fast_start_size,
+                    self.progressive_chunks,
+                    self.read_ahead_chunks,
+                    self.read_ahead_max_chunks,
+                    self.read_ahead_memory,
+                    self.endpoint_state_file,
                 )
 
     class ConnectionHolder:
         """ """
-        __buffer: io.BytesIO
+        connect_attempts = 3
+        flush_threshold = 64 * 1024
+        receive_buffer_size = 64 * 1024
+        __buffer: typing.List[bytes]
+        __buffer_lock: threading.Condition
+        __buffer_size: int
+        __buffer_since: typing.Union[int, None]
+        __closed: bool
+        __flush_deadline_us: int
+        __flush_error: typing.Union[OSError, None]
+        __flusher: typing.Union[threading.Thread, None]
+        __metrics: Session.ConnectionHolder.Metrics
+        __receive_buffer: bytearray
+        __receive_end: int
+        __receive_start: int
         __socket: socket.socket
 
         def __init__(self, sock: socket.socket):
-            self.__buffer = io.BytesIO()
+            self.__buffer = []
+            self.__buffer_lock = threading.Condition()
+            self.__buffer_size = 0
+            self.__buffer_since = None
+            self.__closed = False
+            self.__flush_deadline_us = 0
+            self.__flush_error = None
+            self.__flusher = None
+            self.__metrics = Session.ConnectionHolder.Metrics()
+            self.__receive_buffer = bytearray(self.receive_buffer_size)
+            self.__receive_end = 0
+            self.__receive_start = 0
             self.__socket = sock
 
         @staticmethod
@@ -2038,53 +2892,246 @@ class Session(Closeable, MessageListener, SubListener):
             :returns: ConnectionHolder instance
 
             """
-            sock = socket.socket()
-            for _ in range(3):
-                try:
-                   address = apresolver.get_random_accesspoint()
-                   ap_address = address.split(":")[0]
-                   ap_port = int(address.split(":")[1])
-                   sock.connect((ap_address, ap_port))
-                   break
-                except Exception as e:
-                    logger.warning(e)
-            return Session.ConnectionHolder(sock)
+            selector = apresolver.selector()
+            stagger_ms, timeout = 250, 10.0
+            if conf is not None:
+                if conf.endpoint_state_file is not None:
+                    selector.set_state_file(conf.endpoint_state_file)
+                stagger_ms, timeout = conf.connect_stagger_ms, conf.connect_timeout
+            addresses = apresolver.get_ranked_accesspoints()
+            sock, address, elapsed_ms = Session.ConnectionHolder.race(
+                addresses[:Session.ConnectionHolder.connect_attempts],
+                stagger_ms, timeout, selector)
+            logger.info("Connected to {} in {:.1f}ms".format(
+                address, elapsed_ms))
+            connection = Session.ConnectionHolder(sock)
+            connection.metrics().endpoint = address
+            connection.metrics().connect_time_ms = elapsed_ms
+            return connection
+
+        @staticmethod
+        def race(
+            addresses: typing.List[str],
+            stagger_ms: int,
+            timeout: float,
+            endpoint_selector: EndpointSelector = None
+        ) -> typing.Tuple[socket.socket, str, float]:
+            """Connect to the first address that answers
+
+            A connection attempt is started every stagger_ms, or as soon as
+            the previous one fails, in the given order. The first attempt
+            to complete wins and the others are abandoned.
+
+            :param addresses: host:port strings, best first
+            :param stagger_ms: int:
+            :param timeout: Seconds before giving up on all attempts
+            :param endpoint_selector: Told about successes and failures
+            :returns: The connected socket, its address and connect time
+
+            """
+            pending = list(addresses)
+            attempts: typing.Dict[socket.socket, typing.Tuple[str, float]] = {}
+            sel = selectors.DefaultSelector()
+            deadline = time.monotonic() + timeout
+            next_start = 0.0
+
+            def failed(address: str, ex: Exception) -> None:
+                logger.warning("Connecting to {} failed: {}".format(
+                    address, ex))
+                if endpoint_selector is not None:
+                    endpoint_selector.report_failure(address)
+
+            try:
+                while True:
+                    now = time.monotonic()
+                    if len(pending) > 0 and now >= next_start:
+                        address = pending.pop(0)
+                        next_start = now + stagger_ms / 1000
+                        try:
+                            host, port = address.rsplit(":", 1)
+                            family, kind, proto, _, sockaddr = socket.getaddrinfo(
+                                host, int(port), type=socket.SOCK_STREAM)[0]
+                            sock = socket.socket(family, kind, proto)
+                        except (OSError, ValueError) as ex:
+                            failed(address, ex)
+                            next_start = now
+                            continue
+                        sock.setblocking(False)
+                        err = sock.connect_ex(sockaddr)
+                        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK,
+                                       errno.EALREADY):
+                            sock.close()
+                            failed(address, OSError(err, os.strerror(err)))
+                            next_start = now
+                            continue
+                        attempts[sock] = (address, time.perf_counter())
+                        sel.register(sock, selectors.EVENT_WRITE)
+                        continue
+                    if len(attempts) == 0 and len(pending) == 0:
+                        raise ConnectionError(
+                            "Couldn't connect to any access point")
+                    if now >= deadline:
+                        for address, _ in attempts.values():
+                            failed(address, TimeoutError("timed out"))
+                        raise ConnectionError(
+                            "Connecting to the access points timed out")
+                    wait = deadline - now
+                    if len(pending) > 0:
+                        wait = min(wait, next_start - now)
+                    for key, _ in sel.select(max(0.0, wait)):
+                        sock = key.fileobj
+                        address, start = attempts.pop(sock)
+                        sel.unregister(sock)
+                        err = sock.getsockopt(socket.SOL_SOCKET,
+                                              socket.SO_ERROR)
+                        if err == 0:
+                            elapsed_ms = (time.perf_counter() - start) * 1000
+                            sock.setblocking(True)
+                            if endpoint_selector is not None:
+                                endpoint_selector.report_success(
+                                    address, elapsed_ms)
+                            return sock, address, elapsed_ms
+                        sock.close()
+                        failed(address, OSError(err, os.strerror(err)))
+                        next_start = time.monotonic()
+            finally:
+                for sock in attempts:
+                    sock.close()
+                sel.close()
 
         def close(self) -> None:
             """Close the connection"""
+            with self.__buffer_lock:
+                self.__closed = True
+                self.__buffer_lock.notify_all()
             self.__socket.close()
 
         def flush(self) -> None:
-            """Flush data to socket"""
+            """Flush data to socket
+
+            With a flush deadline set, the buffered data is handed to the
+            flusher thread, which sends it together with whatever else is
+            flushed before the deadline expires. A send error of the
+            flusher thread is raised by the next write or flush.
+
+            """
+            with self.__buffer_lock:
+                self.__check_flush_error()
+                self.__metrics.flushes += 1
+                if (self.__flush_deadline_us > 0
+                        and self.__buffer_size < self.flush_threshold):
+                    self.__buffer_lock.notify_all()
+                    return
+                try:
+                    self.__send_buffer()
+                except BrokenPipeError:
+                    pass
+
+        def set_flush_deadline(self, deadline_us: int) -> None:
+            """Set how long flushed data may wait to be coalesced
+
+            :param deadline_us: Microseconds to wait, 0 to send on every
+                flush
+            :param deadline_us: int:
+
+            """
+            with self.__buffer_lock:
+                self.__flush_deadline_us = deadline_us
+                if deadline_us > 0 and self.__flusher is None:
+                    self.__flusher = threading.Thread(
+                        target=self.__flusher_run,
+                        name="session-packet-flusher",
+                        daemon=True)
+                    self.__flusher.start()
+                self.__buffer_lock.notify_all()
+
+        def __flusher_run(self) -> None:
+            with self.__buffer_lock:
+                while not self.__closed:
+                    if self.__buffer_since is None:
+                        self.__buffer_lock.wait()
+                        continue
+                    remaining = (self.__buffer_since +
+                                 self.__flush_deadline_us * 1000 -
+                                 time.perf_counter_ns())
+                    if (remaining > 0
+                            and self.__buffer_size < self.flush_threshold):
+                        self.__buffer_lock.wait(remaining / 1000000000)
+                        continue
+                    try:
+                        self.__send_buffer()
+                    except OSError as ex:
+                        logger.warning(
+                            "Failed to flush buffered packets: {}".format(ex))
+                        self.__flush_error = ex
+                        return
+
+        def __check_flush_error(self) -> None:
+            """Raise the error that stopped the flusher thread, if any"""
+            if self.__flush_error is not None:
+                raise self.__flush_error
+
+        def __send_buffer(self) -> None:
+            """Send everything buffered in as few syscalls as possible"""
+            if len(self.__buffer) == 0:
+                return
+            buffer = self.__buffer
+            since = self.__buffer_since
+            self.__buffer = []
+            self.__buffer_size = 0
+            self.__buffer_since = None
             try:
-                self.__buffer.seek(0)
-                self.__socket.send(self.__buffer.read())
-                self.__buffer = io.BytesIO()
-            except BrokenPipeError:
-                pass
+                if not hasattr(self.__socket, "sendmsg"):
+                    self.__socket.sendall(b"".join(buffer))
+                    self.__metrics.send_calls += 1
+                else:
+                    views = [memoryview(data) for data in buffer]
+                    while len(views) > 0:
+                        sent = self.__socket.sendmsg(views)
+                        self.__metrics.send_calls += 1
+                        while len(views) > 0 and sent >= len(views[0]):
+                            sent -= len(views.pop(0))
+                        if sent > 0:
+                            views[0] = views[0][sent:]
+            finally:
+                self.__metrics.add_flush_latency(time.perf_counter_ns() -
+                                                 since)
+
+        def metrics(self) -> Session.ConnectionHolder.Metrics:
+            """ """
+            return self.__metrics
 
         def read(self, length: int) -> bytes:
-            """Read data from socket
+            """Read up to length bytes, from the receive buffer if possible
 
             :param length: int:
             :returns: Bytes data from socket
 
             """
-            return self.__socket.recv(length)
+            if self.__receive_end == self.__receive_start:
+                self.__receive(1)
+            length = min(length, self.__receive_end - self.__receive_start)
+            return bytes(self.read_view(length))
 
         def read_exact(self, length: int) -> bytes:
             """Read exactly length bytes from socket or raise on EOF."""
-            if length == 0:
-                return b""
-            buffer = bytearray()
-            remaining = length
-            while remaining > 0:
-                chunk = self.__socket.recv(remaining)
-                if chunk == b"":
-                    raise ConnectionError("EOF")
-                buffer.extend(chunk)
-                remaining -= len(chunk)
-            return bytes(buffer)
+            return bytes(self.read_view(length))
+
+        def read_view(self, length: int) -> memoryview:
+            """Read exactly length bytes without copying them
+
+            The view points into the receive buffer and is only valid
+            until the next read from this connection.
+
+            :param length: int:
+            :returns: memoryview of the bytes
+
+            """
+            if self.__receive_end - self.__receive_start < length:
+                self.__receive(length)
+            start = self.__receive_start
+            self.__receive_start += length
+            return memoryview(self.__receive_buffer)[start:start + length]
 
         def read_int(self) -> int:
             """Read integer from socket
@@ -2093,7 +3140,7 @@ class Session(Closeable, MessageListener, SubListener):
             :returns: integer from socket
 
             """
-            return struct.unpack(">i", self.read(4))[0]
+            return struct.unpack(">i", self.read_view(4))[0]
 
         def read_short(self) -> int:
             """Read short integer from socket
@@ -2102,7 +3149,31 @@ class Session(Closeable, MessageListener, SubListener):
             :returns: short integer from socket
 
             """
-            return struct.unpack(">h", self.read(2))[0]
+            return struct.unpack(">h", self.read_view(2))[0]
+
+        def __receive(self, length: int) -> None:
+            """Fill the receive buffer until length bytes are pending"""
+            pending = self.__receive_end - self.__receive_start
+            if self.__receive_start + length > len(self.__receive_buffer):
+                if length > len(self.__receive_buffer):
+                    buffer = bytearray(
+                        max(length, 2 * len(self.__receive_buffer)))
+                    buffer[:pending] = self.__receive_buffer[
+                        self.__receive_start:self.__receive_end]
+                    self.__receive_buffer = buffer
+                elif pending > 0:
+                    self.__receive_buffer[:pending] = self.__receive_buffer[
+                        self.__receive_start:self.__receive_end]
+                self.__receive_start = 0
+                self.__receive_end = pending
+            while self.__receive_end - self.__receive_start < length:
+                received = self.__socket.recv_into(
+                    memoryview(self.__receive_buffer)[self.__receive_end:])
+                self.__metrics.recv_calls += 1
+                if received == 0:
+                    raise ConnectionError("EOF")
+                self.__metrics.bytes_received += received
+                self.__receive_end += received
 
         def set_timeout(self, seconds: float) -> None:
             """Set socket's timeout
@@ -2120,7 +3191,13 @@ class Session(Closeable, MessageListener, SubListener):
             :param data: bytes:
 
             """
-            self.__buffer.write(data)
+            with self.__buffer_lock:
+                self.__check_flush_error()
+                if self.__buffer_since is None:
+                    self.__buffer_since = time.perf_counter_ns()
+                self.__buffer.append(data)
+                self.__buffer_size += len(data)
+                self.__metrics.bytes_sent += len(data)
 
         def write_int(self, data: int) -> None:
             """Write data to buffer
@@ -2140,6 +3217,157 @@ class Session(Closeable, MessageListener, SubListener):
             """
             self.write(struct.pack(">h", data))
 
+        class Metrics:
+            """ """
+            bytes_received = 0
+            bytes_sent = 0
+            connect_time_ms = 0.0
+            endpoint: typing.Union[str, None] = None
+            flush_latency_ns = 0
+            flushes = 0
+            packets_received = 0
+            recv_calls = 0
+            send_calls = 0
+            sends = 0
+
+            def add_flush_latency(self, elapsed_ns: int) -> None:
+                """
+
+                :param elapsed_ns: int:
+
+                """
+                self.sends += 1
+                self.flush_latency_ns += elapsed_ns
+
+            def flush_latency_us(self) -> float:
+                """Average time from the first buffered write to its send"""
+                return (0.0 if self.sends == 0 else self.flush_latency_ns /
+                        self.sends / 1000)
+
+            def recv_calls_per_packet(self) -> float:
+                """ """
+                return (0.0 if self.packets_received == 0 else
+                        self.recv_calls / self.packets_received)
+
+            def send_calls_per_flush(self) -> float:
+                """ """
+                return (0.0 if self.flushes == 0 else self.send_calls /
+                        self.flushes)
+
+            def __str__(self) -> str:
+                return ("endpoint: {}, connect_time: {:.1f}ms, "
+                        "recv_calls: {}, packets_received: {}, "
+                        "bytes_received: {}, send_calls: {}, flushes: {}, "
+                        "bytes_sent: {}, flush_latency: {:.1f}us".format(
+                            self.endpoint, self.connect_time_ms,
+                            self.recv_calls, self.packets_received,
+                            self.bytes_received, self.send_calls,
+                            self.flushes, self.bytes_sent,
+                            self.flush_latency_us()))
+
+    class InFlightRequests:
+        """Idempotent requests that haven't been answered yet
+
+        Mercury GET/SUB and audio key requests are kept here until their
+        response arrives, so that after a reconnect they can be sent again
+        on the new connection instead of waiting out their timeout.
+
+        """
+        logger = logging.getLogger("Librespot:InFlightRequests")
+        prune_threshold = 256
+        dropped = 0
+        expired = 0
+        replayed = 0
+        replays = 0
+        __lock: threading.Lock
+        __requests: typing.Dict[typing.Hashable, typing.Tuple[
+            float, bytes, bytes, Packet.Priority]]
+
+        def __init__(self):
+            self.__lock = threading.Lock()
+            self.__requests = {}
+
+        def complete(self, key: typing.Hashable) -> None:
+            """Forget a request once its response arrived
+
+            :param key: typing.Hashable:
+
+            """
+            with self.__lock:
+                self.__requests.pop(key, None)
+
+        def keys(self) -> typing.List[typing.Hashable]:
+            """Keys of the requests waiting for a response"""
+            with self.__lock:
+                return list(self.__requests)
+
+        def pending(self) -> int:
+            """Number of requests waiting for a response"""
+            with self.__lock:
+                return len(self.__requests)
+
+        def replay(self, session: Session, budget: int) -> int:
+            """Send the requests that are still awaited again
+
+            Requests whose caller already gave up are dropped, the rest are
+            sent by priority up to the budget.
+
+            :param session: Session:
+            :param budget: Maximum number of requests sent again
+            :returns: Number of requests sent again
+
+            """
+            with self.__lock:
+                self.__prune(time.monotonic())
+                requests = sorted(self.__requests.values(),
+                                  key=lambda request: request[3].value)
+                self.replays += 1
+            replay = requests[:max(0, budget)]
+            for _, cmd, payload, priority in replay:
+                session.send(cmd, payload, priority)
+            self.replayed += len(replay)
+            self.dropped += len(requests) - len(replay)
+            if len(requests) > 0:
+                self.logger.info(
+                    "Replayed {} of {} in-flight requests".format(
+                        len(replay), len(requests)))
+            return len(replay)
+
+        def track(self,
+                  key: typing.Hashable,
+                  cmd: bytes,
+                  payload: bytes,
+                  timeout: float,
+                  priority: Packet.Priority = None) -> None:
+            """Remember a request until it's completed or times out
+
+            :param key: Unique key, completed with the same key
+            :param cmd: bytes:
+            :param payload: bytes:
+            :param timeout: Seconds the caller waits for the response
+            :param priority: Packet.Priority:  (Default value = None)
+
+            """
+            if priority is None:
+                priority = Packet.Priority.for_cmd(cmd)
+            now = time.monotonic()
+            with self.__lock:
+                if len(self.__requests) >= self.prune_threshold:
+                    self.__prune(now)
+                self.__requests[key] = (now + timeout, cmd, payload, priority)
+
+        def __prune(self, now: float) -> None:
+            for key, request in list(self.__requests.items()):
+                if request[0] <= now:
+                    del self.__requests[key]
+                    self.expired += 1
+
+        def __str__(self) -> str:
+            return ("replays: {}, replayed: {}, dropped: {}, expired: {}, "
+                    "pending: {}".format(self.replays, self.replayed,
+                                         self.dropped, self.expired,
+                                         self.pending()))
+
     class Inner:
         """ """
         device_type: Connect.DeviceType = None
@@ -2163,6 +3391,212 @@ class Session(Closeable, MessageListener, SubListener):
             self.device_id = (device_id if device_id is not None else
                               util.random_hex_string(40))
 
+    class PacketDispatcher(Closeable):
+        """Routes received packets through a table indexed by command byte
+
+        Handlers registered without a lane run on the receiver thread. With
+        a queue size above 0, handlers registered with a lane run on that
+        lane's worker thread, so a slow subsystem only holds back its own
+        packets while ping/pong keeps being answered by the receiver.
+
+        """
+        logger = logging.getLogger("Librespot:PacketDispatcher")
+        __closed: bool
+        __handlers: typing.List[typing.Union[typing.Tuple[
+            typing.Callable[[Packet], None], typing.Union[str, None]], None]]
+        __handlers_lock: threading.Lock
+        __lanes: typing.Dict[str, Session.PacketDispatcher.Lane]
+        __queue_size: int
+        __unhandled: typing.List[int]
+
+        def __init__(self, queue_size: int = 0):
+            self.__closed = False
+            self.__handlers = [None] * 256
+            self.__handlers_lock = threading.Lock()
+            self.__lanes = {}
+            self.__queue_size = queue_size
+            self.__unhandled = [0] * 256
+
+        def close(self) -> None:
+            """Stop the lane workers"""
+            with self.__handlers_lock:
+                self.__closed = True
+                lanes = list(self.__lanes.values())
+                self.__lanes.clear()
+            for lane in lanes:
+                lane.close()
+
+        def dispatch(self, packet: Packet) -> bool:
+            """Hand the packet to the handler registered for its command
+
+            :param packet: Packet:
+            :returns: Whether a handler was registered
+
+            """
+            cmd = packet.cmd[0]
+            entry = self.__handlers[cmd]
+            if entry is None:
+                self.__unhandled[cmd] += 1
+                if self.__unhandled[cmd] == 1:
+                    self.logger.debug(
+                        "No handler for cmd: 0x{}, further packets are only "
+                        "counted".format(util.bytes_to_hex(packet.cmd)))
+                return False
+            handler, lane_name = entry
+            lane = None if lane_name is None else self.__lanes.get(lane_name)
+            if lane is None:
+                handler(packet)
+            else:
+                lane.put(handler, packet)
+            return True
+
+        def lanes(self) -> typing.Dict[str, Session.PacketDispatcher.Lane]:
+            """ """
+            return dict(self.__lanes)
+
+        def register(self,
+                     cmd: bytes,
+                     handler: typing.Union[PacketsReceiver,
+                                           typing.Callable[[Packet], None]],
+                     lane: str = None) -> None:
+            """Register the handler of a command, replacing any previous one
+
+            :param cmd: bytes:
+            :param handler: PacketsReceiver or function taking the Packet
+            :param lane: Name of the queue the handler runs from, None to
+                run it on the receiver thread  (Default value = None)
+
+            """
+            if isinstance(handler, PacketsReceiver):
+                handler = handler.dispatch
+            with self.__handlers_lock:
+                if (lane is not None and self.__queue_size > 0
+                        and not self.__closed and lane not in self.__lanes):
+                    self.__lanes[lane] = Session.PacketDispatcher.Lane(
+                        lane, self.__queue_size)
+                self.__handlers[cmd[0]] = (handler, lane)
+
+        def register_receiver(self,
+                              receiver: PacketsReceiver,
+                              *cmds: bytes,
+                              lane: str = None) -> None:
+            """Register a PacketsReceiver for several commands
+
+            :param receiver: PacketsReceiver:
+            :param *cmds: bytes:
+            :param lane: str:  (Default value = None)
+
+            """
+            for cmd in cmds:
+                self.register(cmd, receiver, lane)
+
+        def unhandled(self) -> typing.Dict[bytes, int]:
+            """Count of received packets without a handler, by command"""
+            return {
+                bytes([cmd]): count
+                for cmd, count in enumerate(self.__unhandled) if count > 0
+            }
+
+        def unregister(self, cmd: bytes) -> None:
+            """
+
+            :param cmd: bytes:
+
+            """
+            with self.__handlers_lock:
+                self.__handlers[cmd[0]] = None
+
+        class Lane(Closeable):
+            """Packet queue drained by its own worker thread
+
+            Queuing never blocks the receiver thread. Packets arriving while
+            size packets are already waiting are dropped and counted, their
+            requests then fail with their usual timeout.
+
+            """
+            dropped = 0
+            high_water_mark = 0
+            processed = 0
+            name: str
+            size: int
+            __closed: bool
+            __condition: threading.Condition
+            __items: collections.deque
+            __thread: threading.Thread
+
+            def __init__(self, name: str, size: int):
+                self.name = name
+                self.size = size
+                self.__closed = False
+                self.__condition = threading.Condition()
+                self.__items = collections.deque()
+                self.__thread = threading.Thread(
+                    target=self.run,
+                    name="session-packet-{}".format(name),
+                    daemon=True)
+                self.__thread.start()
+
+            def close(self) -> None:
+                """Stop the worker once it's done with its current packet"""
+                with self.__condition:
+                    self.__closed = True
+                    self.__items.clear()
+                    self.__condition.notify_all()
+
+            def depth(self) -> int:
+                """ """
+                return len(self.__items)
+
+            def put(self, handler: typing.Callable[[Packet], None],
+                    packet: Packet) -> bool:
+                """Queue a packet without blocking
+
+                :param handler: typing.Callable[[Packet], None]:
+                :param packet: Packet:
+                :returns: False if the lane was full or closed and the
+                    packet was dropped
+
+                """
+                with self.__condition:
+                    if self.__closed:
+                        return False
+                    depth = len(self.__items)
+                    if depth >= self.size:
+                        if self.dropped == 0:
+                            Session.PacketDispatcher.logger.warning(
+                                "Packet lane {} is full ({} packets), "
+                                "dropping".format(self.name, self.size))
+                        self.dropped += 1
+                        return False
+                    self.__items.append((handler, packet))
+                    if depth + 1 > self.high_water_mark:
+                        self.high_water_mark = depth + 1
+                    self.__condition.notify()
+                    return True
+
+            def run(self) -> None:
+                """ """
+                while True:
+                    with self.__condition:
+                        self.__condition.wait_for(
+                            lambda: self.__closed or len(self.__items) > 0)
+                        if self.__closed:
+                            return
+                        handler, packet = self.__items.popleft()
+                    try:
+                        handler(packet)
+                    except Exception:
+                        Session.PacketDispatcher.logger.exception(
+                            "Failed handling cmd: 0x{} on lane {}".format(
+                                util.bytes_to_hex(packet.cmd), self.name))
+                    self.processed += 1
+
+            def __str__(self) -> str:
+                return ("{}: depth: {}, high_water_mark: {}, dropped: {}, "
+                        "processed: {}".format(self.name, self.depth(),
+                                               self.high_water_mark,
+                                               self.dropped, self.processed))
+
     class Receiver:
         """ """
         __session: Session
@@ -2186,88 +3620,95 @@ class Session(Closeable, MessageListener, SubListener):
             self.__session.logger.info("Session.Receiver started")
             while self.__running:
                 packet: Packet
-                cmd: bytes
+                connection = self.__session.connection
                 try:
                     packet = self.__session.cipher_pair.receive_encoded(
-                        self.__session.connection)
-                    cmd = Packet.Type.parse(packet.cmd)
-                    if cmd is None:
-                        self.__session.logger.info(
-                            "Skipping unknown command cmd: 0x{}, payload: {}".
-                            format(util.bytes_to_hex(packet.cmd),
-                                   packet.payload))
-                        continue
+                        connection)
                 except (RuntimeError, ConnectionResetError,
                         ConnectionError) as ex:
                     if self.__running:
                         self.__session.logger.fatal(
                             "Failed reading packet! {}".format(ex))
-                        self.__session.reconnect()
+                        self.__session.reconnect(connection)
                     break
                 if not self.__running:
                     break
-                if cmd == Packet.Type.ping:
-                    if self.__session.scheduled_reconnect is not None:
-                        self.__session.scheduler.cancel(
-                            self.__session.scheduled_reconnect)
-
-                    def anonymous():
-                        """ """
-                        self.__session.logger.warning(
-                            "Socket timed out. Reconnecting...")
-                        self.__session.reconnect()
-
-                    self.__session.scheduled_reconnect = self.__session.scheduler.enter(
-                        2 * 60 + 5, 1, anonymous)
+                self.__session.packet_dispatcher().dispatch(packet)
+
+    class Sender(Closeable):
+        """Single writer thread draining a queue with three priority lanes
+
+        Packets are written with the send function. Errors it raises are
+        handed to the error handler, which the session uses to reconnect
+        when the connection was lost.
+        """
+        __histograms: typing.Dict[Packet.Priority, util.Histogram]
+        __on_error: typing.Callable[[Exception], None]
+        __queue: queue.PriorityQueue
+        __send: typing.Callable[[bytes, bytes], None]
+        __sequence: int
+        __sequence_lock: threading.Lock
+        __thread: threading.Thread
+
+        def __init__(self, send: typing.Callable[[bytes, bytes], None],
+                     on_error: typing.Callable[[Exception], None]):
+            self.__histograms = {
+                priority: util.Histogram()
+                for priority in Packet.Priority
+            }
+            self.__on_error = on_error
+            self.__queue = queue.PriorityQueue()
+            self.__send = send
+            self.__sequence = 0
+            self.__sequence_lock = threading.Lock()
+            self.__thread = threading.Thread(target=self.run,
+                                             name="session-packet-sender",
+                                             daemon=True)
+            self.__thread.start()
+
+        def close(self) -> None:
+            """ """
+            self.__queue.put((-1, -1, 0, None, None, None))
+
+        def histograms(
+                self) -> typing.Dict[Packet.Priority, util.Histogram]:
+            """Time packets spent queued, by lane"""
+            return self.__histograms
+
+        def send(self, cmd: bytes, payload: bytes,
+                 priority: Packet.Priority = None) -> None:
+            """
+
+            :param cmd: bytes:
+            :param payload: bytes:
+            :param priority: Packet.Priority:  (Default value = None)
+
+            """
+            if priority is None:
+                priority = Packet.Priority.for_cmd(cmd)
+            with self.__sequence_lock:
+                sequence = self.__sequence
+                self.__sequence += 1
+            self.__queue.put((priority.value, sequence, time.perf_counter_ns(),
+                              priority, cmd, payload))
+
+        def run(self) -> None:
+            """ """
+            while True:
+                _, _, queued, priority, cmd, payload = self.__queue.get()
+                if cmd is None:
+                    return
+                self.__histograms[priority].add(
+                    (time.perf_counter_ns() - queued) / 1000000)
+                try:
+                    self.__send(cmd, payload)
+                except (OSError, RuntimeError) as ex:
+                    logger.warning("Failed sending cmd: 0x{}: {}".format(
+                        util.bytes_to_hex(cmd), ex))
                     try:
-                        self.__session.send(Packet.Type.pong, packet.payload)
-                    except ConnectionResetError:
-                        if self.__session.scheduled_reconnect is not None:
-                           self.__session.scheduler.cancel(
-                                self.__session.scheduled_reconnect)
-                           self.__session.scheduled_reconnect = None
-                        self.__session.reconnect()
-                        
-                elif cmd == Packet.Type.pong_ack:
-                    continue
-                elif cmd == Packet.Type.country_code:
-                    self.__session.__country_code = packet.payload.decode()
-                    self.__session.logger.info(
-                        "Received country_code: {}".format(
-                            self.__session.__country_code))
-                elif cmd == Packet.Type.license_version:
-                    license_version = io.BytesIO(packet.payload)
-                    license_id = struct.unpack(">h",
-                                               license_version.read(2))[0]
-                    if license_id != 0:
-                        buffer = license_version.read()
-                        self.__session.logger.info(
-                            "Received license_version: {}, {}".format(
-                                license_id, buffer.decode()))
-                    else:
-                        self.__session.logger.info(
-                            "Received license_version: {}".format(license_id))
-                elif cmd == Packet.Type.unknown_0x10:
-                    self.__session.logger.debug("Received 0x10: {}".format(
-                        util.bytes_to_hex(packet.payload)))
-                elif cmd in [
-                        Packet.Type.mercury_sub,
-                        Packet.Type.mercury_unsub,
-                        Packet.Type.mercury_event,
-                        Packet.Type.mercury_req,
-                ]:
-                    self.__session.mercury().dispatch(packet)
-                elif cmd in [Packet.Type.aes_key, Packet.Type.aes_key_error]:
-                    self.__session.audio_key().dispatch(packet)
-                elif cmd in [
-                        Packet.Type.channel_error, Packet.Type.stream_chunk_res
-                ]:
-                    self.__session.channel().dispatch(packet)
-                elif cmd == Packet.Type.product_info:
-                    self.__session.parse_product_info(packet.payload)
-                else:
-                    self.__session.logger.info("Skipping {}".format(
-                        util.bytes_to_hex(cmd)))
+                        self.__on_error(ex)
+                    except Exception:
+                        logger.exception("Failed handling send error")
 
     class SpotifyAuthenticationException(Exception):
         """ """
@@ -2421,12 +3862,24 @@ class TokenProvider:
     """ """
     logger = logging.getLogger("Librespot:TokenProvider")
     token_expire_threshold = 10
+    token_refresh_ahead = 60
+    __refresh_timers: typing.Dict[int, util.TimerWheel.Timer]
     __session: Session
     __tokens: typing.List[StoredToken] 
+    __tokens_lock: threading.Lock
 
     def __init__(self, session: Session):
+        self.__refresh_timers = {}
         self.__session = session
         self.__tokens = []
+        self.__tokens_lock = threading.Lock()
+
+    def close(self) -> None:
+        """Cancel the scheduled token refreshes"""
+        with self.__tokens_lock:
+            for timer in self.__refresh_timers.values():
+                timer.cancel()
+            self.__refresh_timers.clear()
 
     def find_token_with_all_scopes(
             self, scopes: typing.List[str]) -> typing.Union[StoredToken, None]:
@@ -2461,14 +3914,14 @@ class TokenProvider:
         token = self.find_token_with_all_scopes(scopes)
         if token is not None:
             if token.expired():
-                self.__tokens.remove(token)
+                self.__remove_token(token)
                 self.logger.debug("Login5 token expired, need to re-authenticate")
             else:
                 return token
 
         token = self.login5(scopes)
         if token is not None:
-            self.__tokens.append(token)
+            self.__add_token(token)
             self.logger.debug("Using Login5 access token for scopes: {}".format(scopes))
         return token
 
@@ -2512,6 +3965,38 @@ class TokenProvider:
         else:
             self.logger.error("Login5 authentication failed: No APWelcome found")
 
+    def __add_token(self, token: StoredToken) -> None:
+        with self.__tokens_lock:
+            self.__tokens.append(token)
+            self.__refresh_timers[id(token)] = util.TimerWheel.instance(
+            ).schedule_blocking(
+                max(0, token.expires_in - self.token_refresh_ahead),
+                self.__refresh, token)
+
+    def __refresh(self, token: StoredToken) -> None:
+        with self.__tokens_lock:
+            if self.__refresh_timers.pop(id(token), None) is None:
+                return
+        try:
+            fresh = self.login5(token.scopes)
+        except (IOError, RuntimeError) as ex:
+            self.logger.warning("Couldn't refresh token for scopes {}: {}".format(
+                token.scopes, ex))
+            return
+        if fresh is None:
+            return
+        self.__add_token(fresh)
+        self.__remove_token(token)
+        self.logger.debug("Refreshed token for scopes: {}".format(token.scopes))
+
+    def __remove_token(self, token: StoredToken) -> None:
+        with self.__tokens_lock:
+            timer = self.__refresh_timers.pop(id(token), None)
+            if timer is not None:
+                timer.cancel()
+            if token in self.__tokens:
+                self.__tokens.remove(token)
+
     class StoredToken:
         """ """
         expires_in: int
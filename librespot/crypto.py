@@ -1,26 +1,68 @@
 from __future__ import annotations
 from Cryptodome import Random
 from librespot import util
-import io
-import re
+from librespot.structure import Closeable
+import enum
 import struct
+import threading
+import time
 import typing
 
 if typing.TYPE_CHECKING:
     from librespot.core import Session
 
 
-class CipherPair:
+class CipherPair(Closeable):
     __receive_cipher: Shannon
     __receive_nonce = 0
     __send_cipher: Shannon
     __send_nonce = 0
 
-    def __init__(self, send_key: bytes, receive_key: bytes):
-        self.__send_cipher = Shannon()
+    def __init__(self,
+                 send_key: bytes,
+                 receive_key: bytes,
+                 cipher: typing.Type[typing.Union[Shannon,
+                                                  FastShannon]] = None,
+                 precompute: int = 0):
+        """
+        Args:
+            send_key: Key of the send direction
+            receive_key: Key of the receive direction
+            cipher: Shannon implementation, FastShannon by default
+            precompute: Number of upcoming send nonces to key in the
+                background, 0 to key every nonce on the send path
+        """
+        if cipher is None:
+            cipher = FastShannon
+        self.__send_cipher = cipher()
         self.__send_cipher.key(send_key)
-        self.__receive_cipher = Shannon()
+        self.__receive_cipher = cipher()
         self.__receive_cipher.key(receive_key)
+        self.__closed = False
+        self.__precompute = precompute
+        self.__precompute_lock = threading.Condition()
+        self.__precompute_metrics = CipherPair.PrecomputeMetrics()
+        self.__precompute_next = 0
+        self.__prepared: typing.Dict[int, tuple] = {}
+        if precompute > 0:
+            thread = threading.Thread(target=self.__precompute_run,
+                                      name="cipher-nonce-precompute",
+                                      daemon=True)
+            thread.start()
+
+    def close(self) -> None:
+        with self.__precompute_lock:
+            self.__closed = True
+            self.__prepared.clear()
+            self.__precompute_lock.notify_all()
+
+    def precompute_metrics(self) -> CipherPair.PrecomputeMetrics:
+        """
+        Return the counters of the send nonce precomputation
+        Returns:
+            CipherPair.PrecomputeMetrics
+        """
+        return self.__precompute_metrics
 
     def send_encoded(self, connection: Session.ConnectionHolder, cmd: bytes,
                      payload: bytes) -> None:
@@ -31,19 +73,60 @@ class CipherPair:
         :param payload:
         :return:
         """
-        self.__send_cipher.nonce(self.__send_nonce)
-        self.__send_nonce += 1
-        buffer = io.BytesIO()
-        buffer.write(cmd)
-        buffer.write(struct.pack(">H", len(payload)))
-        buffer.write(payload)
-        buffer.seek(0)
-        contents = self.__send_cipher.encrypt(buffer.read())
+        self.__key_send_nonce()
+        contents = self.__send_cipher.encrypt(b"".join(
+            (cmd, struct.pack(">H", len(payload)), payload)))
         mac = self.__send_cipher.finish(4)
         connection.write(contents)
         connection.write(mac)
         connection.flush()
 
+    def __key_send_nonce(self) -> None:
+        if self.__precompute <= 0:
+            self.__send_cipher.nonce(self.__send_nonce)
+            self.__send_nonce += 1
+            return
+        # The nonce advances under the lock the precompute thread waits on,
+        # so its window starts at the next nonce once it's woken up
+        with self.__precompute_lock:
+            nonce = self.__send_nonce
+            self.__send_nonce += 1
+            state = self.__prepared.pop(nonce, None)
+            if state is not None:
+                self.__precompute_metrics.hits += 1
+            self.__precompute_lock.notify_all()
+        if state is not None:
+            self.__send_cipher.load_nonce_state(state)
+            return
+        start = time.perf_counter_ns()
+        self.__send_cipher.nonce(nonce)
+        elapsed_ns = time.perf_counter_ns() - start
+        with self.__precompute_lock:
+            self.__precompute_metrics.misses += 1
+            self.__precompute_metrics.add_keying_time(elapsed_ns)
+
+    def __precompute_run(self) -> None:
+        while True:
+            with self.__precompute_lock:
+                self.__precompute_lock.wait_for(
+                    lambda: self.__closed or self.__precompute_next <
+                    self.__send_nonce + self.__precompute)
+                if self.__closed:
+                    return
+                for stale in [
+                        n for n in self.__prepared if n < self.__send_nonce
+                ]:
+                    self.__prepared.pop(stale)
+                nonce = max(self.__precompute_next, self.__send_nonce)
+                self.__precompute_next = nonce + 1
+            start = time.perf_counter_ns()
+            state = self.__send_cipher.nonce_state(nonce)
+            elapsed_ns = time.perf_counter_ns() - start
+            with self.__precompute_lock:
+                self.__precompute_metrics.add_keying_time(elapsed_ns)
+                if not self.__closed and nonce >= self.__send_nonce:
+                    self.__prepared[nonce] = state
+
     def receive_encoded(self, connection: Session.ConnectionHolder) -> Packet:
         """
         Receive and parse decrypted data from the socket
@@ -56,21 +139,55 @@ class CipherPair:
             self.__receive_cipher.nonce(self.__receive_nonce)
             self.__receive_nonce += 1
             header_bytes = self.__receive_cipher.decrypt(
-                connection.read_exact(3))
+                connection.read_view(3))
             cmd = struct.pack(">s", bytes([header_bytes[0]]))
             payload_length = (header_bytes[1] << 8) | (header_bytes[2] & 0xff)
             payload_bytes = self.__receive_cipher.decrypt(
-                connection.read_exact(payload_length))
-            mac = connection.read_exact(4)
+                connection.read_view(payload_length))
+            mac = connection.read_view(4)
             expected_mac = self.__receive_cipher.finish(4)
             if mac != expected_mac:
                 raise RuntimeError("Bad MAC")
+            connection.metrics().packets_received += 1
             return Packet(cmd, payload_bytes)
         except ConnectionError:
             raise
         except (IndexError, OSError):
             raise RuntimeError("Failed to receive packet")
 
+    class PrecomputeMetrics:
+        hits = 0
+        misses = 0
+        keyed = 0
+        keying_time_ns = 0
+
+        def add_keying_time(self, elapsed_ns: int) -> None:
+            self.keyed += 1
+            self.keying_time_ns += elapsed_ns
+
+        def hit_rate(self) -> float:
+            total = self.hits + self.misses
+            return 0.0 if total == 0 else self.hits / total
+
+        def keying_time_us(self) -> float:
+            """
+            Average time a nonce takes to key
+            """
+            return 0.0 if self.keyed == 0 else (self.keying_time_ns /
+                                                 self.keyed / 1000)
+
+        def saved_time_us(self) -> float:
+            """
+            Average keying time removed from the send path per packet
+            """
+            return self.hit_rate() * self.keying_time_us()
+
+        def __str__(self) -> str:
+            return ("hits: {}, misses: {}, hit_rate: {:.2f}, "
+                    "saved: {:.1f}us/packet".format(self.hits, self.misses,
+                                                    self.hit_rate(),
+                                                    self.saved_time_us()))
+
 
 class DiffieHellman:
     """
@@ -136,6 +253,29 @@ class Packet:
     def is_cmd(self, cmd: bytes) -> bool:
         return cmd == self.cmd
 
+    class Priority(enum.Enum):
+        """
+        Lane of the session send queue, lower values are sent first
+        """
+        CONTROL = 0
+        INTERACTIVE = 1
+        BULK = 2
+
+        @staticmethod
+        def for_cmd(cmd: bytes) -> Packet.Priority:
+            if cmd == Packet.Type.pong:
+                return Packet.Priority.CONTROL
+            if cmd in (Packet.Type.request_key, Packet.Type.mercury_req,
+                       Packet.Type.stream_chunk):
+                return Packet.Priority.INTERACTIVE
+            return Packet.Priority.BULK
+
+        @staticmethod
+        def for_method(method: str) -> Packet.Priority:
+            if method == "GET":
+                return Packet.Priority.INTERACTIVE
+            return Packet.Priority.BULK
+
     class Type:
         secret_block = b"\x02"
         ping = b"\x04"
@@ -168,16 +308,13 @@ class Packet:
         unknown_0x0f = b"\x0f"
         unknown_0x10 = b"\x10"
 
+        commands: typing.List[typing.Union[bytes, None]]
+
         @staticmethod
         def parse(val: typing.Union[bytes, None]) -> typing.Union[bytes, None]:
-            for cmd in [
-                    Packet.Type.__dict__[attr] for attr in Packet.Type.__dict__
-                    if re.search("__.+?__", attr) is None
-                    and type(Packet.Type.__dict__[attr]) is bytes
-            ]:
-                if cmd == val:
-                    return cmd
-            return None
+            if val is None or len(val) != 1:
+                return None
+            return Packet.Type.commands[val[0]]
 
         @staticmethod
         def for_method(method: str) -> bytes:
@@ -188,6 +325,13 @@ class Packet:
             return Packet.Type.mercury_req
 
 
+Packet.Type.commands = [None] * 256
+for _cmd in vars(Packet.Type).values():
+    if type(_cmd) is bytes:
+        Packet.Type.commands[_cmd[0]] = _cmd
+del _cmd
+
+
 class Shannon:
     n = 16
     fold = n
@@ -299,6 +443,31 @@ class Shannon:
         self.gen_konst()
         self.nbuf = 0
 
+    def nonce_state(self, nonce: typing.Union[bytes, int]) -> tuple:
+        """
+        Compute the state nonce() would produce without touching this cipher
+        Args:
+            nonce: Nonce to key
+        Returns:
+            Opaque state for load_nonce_state()
+        """
+        scratch = Shannon()
+        scratch.init_r = list(self.init_r)
+        scratch.nonce(nonce)
+        return scratch.r, scratch.crc, scratch.konst
+
+    def load_nonce_state(self, state: tuple) -> None:
+        """
+        Restore a state computed by nonce_state()
+        Args:
+            state: State returned by nonce_state()
+        """
+        r, crc, konst = state
+        self.r = list(r)
+        self.crc = list(crc)
+        self.konst = konst
+        self.nbuf = 0
+
     def encrypt(self, buffer: bytes, n: int = None) -> bytes:
         if n is None:
             return self.encrypt(buffer, len(buffer))
@@ -413,3 +582,255 @@ class Shannon:
                     buffer[i + j] = (self.sbuf >> (i * 8)) & 0xff
                 break
         return bytes(buffer)
+
+
+class FastShannon:
+    """
+    Shannon stream cipher with the same output as Shannon, tuned for speed.
+    The register and the CRC are kept as rings with a rotating offset
+    instead of being shifted on every cycle, and whole 32-bit words are
+    unpacked and packed in bulk.
+    """
+    n = 16
+    fold = n
+    initkonst = 0x6996c53a
+    keyp = 13
+    konst: int
+    sbuf: int
+    mbuf: int
+    nbuf: int
+    __crc: typing.List[int]
+    __crc_offset: int
+    __init_r: typing.List[int]
+    __r: typing.List[int]
+    __r_offset: int
+
+    def __init__(self):
+        self.__r = [0] * self.n
+        self.__r_offset = 0
+        self.__crc = [0] * self.n
+        self.__crc_offset = 0
+        self.__init_r = [0] * self.n
+        self.konst = 0
+        self.sbuf = 0
+        self.mbuf = 0
+        self.nbuf = 0
+
+    def __cycle(self) -> None:
+        r = self.__r
+        o = self.__r_offset
+        t = r[(o + 12) & 15] ^ r[(o + 13) & 15] ^ self.konst
+        t ^= ((t << 5) | (t >> 27) | (t << 7) | (t >> 25)) & 0xffffffff
+        t ^= ((t << 19) | (t >> 13) | (t << 22) | (t >> 10)) & 0xffffffff
+        u = r[o]
+        t ^= ((u << 1) | (u >> 31)) & 0xffffffff
+        r[o] = t
+        o = (o + 1) & 15
+        t ^= r[(o + 2) & 15]
+        t ^= ((t << 7) | (t >> 25) | (t << 22) | (t >> 10)) & 0xffffffff
+        t ^= ((t << 5) | (t >> 27) | (t << 19) | (t >> 13)) & 0xffffffff
+        r[o] ^= t
+        self.sbuf = t ^ r[(o + 8) & 15] ^ r[(o + 12) & 15]
+        self.__r_offset = o
+
+    def __mac_func(self, i: int) -> None:
+        c = self.__crc
+        p = self.__crc_offset
+        c[p] ^= c[(p + 2) & 15] ^ c[(p + 15) & 15] ^ i
+        self.__crc_offset = (p + 1) & 15
+        self.__r[(self.__r_offset + self.keyp) & 15] ^= i
+
+    def __diffuse(self) -> None:
+        for _ in range(self.fold):
+            self.__cycle()
+
+    def __load_key(self, key: bytes) -> None:
+        padding_size = int((len(key) + 3) / 4) * 4 - len(key)
+        key = key + (b"\x00" * padding_size) + struct.pack("<I", len(key))
+        for (word, ) in struct.iter_unpack("<I", key):
+            self.__r[(self.__r_offset + self.keyp) & 15] ^= word
+            self.__cycle()
+        self.__crc = self.__logical_r()
+        self.__crc_offset = 0
+        self.__diffuse()
+        self.__xor_crc()
+
+    def __logical_r(self) -> typing.List[int]:
+        o = self.__r_offset
+        return self.__r[o:] + self.__r[:o]
+
+    def __xor_crc(self) -> None:
+        r = self.__r
+        c = self.__crc
+        o = self.__r_offset
+        p = self.__crc_offset
+        for i in range(self.n):
+            r[(o + i) & 15] ^= c[(p + i) & 15]
+
+    def __words(self, words: typing.Tuple[int, ...],
+                decrypt: bool) -> typing.List[int]:
+        """
+        Run cycle, MAC and keystream masking over whole words
+        Args:
+            words: Little-endian words of the input
+            decrypt: Whether the words are ciphertext
+        Returns:
+            The processed words
+        """
+        r = self.__r
+        o = self.__r_offset
+        c = self.__crc
+        p = self.__crc_offset
+        konst = self.konst
+        keyp = self.keyp
+        out = []
+        append = out.append
+        t = 0
+        for w in words:
+            t = r[(o + 12) & 15] ^ r[(o + 13) & 15] ^ konst
+            t ^= ((t << 5) | (t >> 27) | (t << 7) | (t >> 25)) & 0xffffffff
+            t ^= ((t << 19) | (t >> 13) | (t << 22) |
+                  (t >> 10)) & 0xffffffff
+            u = r[o]
+            t ^= ((u << 1) | (u >> 31)) & 0xffffffff
+            r[o] = t
+            o = (o + 1) & 15
+            t ^= r[(o + 2) & 15]
+            t ^= ((t << 7) | (t >> 25) | (t << 22) | (t >> 10)) & 0xffffffff
+            t ^= ((t << 5) | (t >> 27) | (t << 19) | (t >> 13)) & 0xffffffff
+            r[o] ^= t
+            t ^= r[(o + 8) & 15] ^ r[(o + 12) & 15]
+            if decrypt:
+                w ^= t
+                append(w)
+            else:
+                append(w ^ t)
+            c[p] ^= c[(p + 2) & 15] ^ c[(p + 15) & 15] ^ w
+            p = (p + 1) & 15
+            r[(o + keyp) & 15] ^= w
+        self.sbuf = t
+        self.__r_offset = o
+        self.__crc_offset = p
+        return out
+
+    def __crypt(self, buffer: bytes, n: typing.Union[int, None],
+                decrypt: bool) -> bytes:
+        if n is None:
+            n = len(buffer)
+        buffer = bytearray(buffer)
+        i = 0
+        if self.nbuf != 0:
+            while self.nbuf != 0 and n != 0:
+                if decrypt:
+                    buffer[i] ^= (self.sbuf >> (32 - self.nbuf)) & 0xff
+                    self.mbuf ^= buffer[i] << (32 - self.nbuf)
+                else:
+                    self.mbuf ^= buffer[i] << (32 - self.nbuf)
+                    buffer[i] ^= (self.sbuf >> (32 - self.nbuf)) & 0xff
+                i += 1
+                self.nbuf -= 8
+                n -= 1
+            if self.nbuf != 0:
+                return b""
+            self.__mac_func(self.mbuf)
+        words = n >> 2
+        if words != 0:
+            fmt = "<{}I".format(words)
+            struct.pack_into(
+                fmt, buffer, i,
+                *self.__words(struct.unpack_from(fmt, buffer, i), decrypt))
+            i += words << 2
+        n &= 0x03
+        if n != 0:
+            self.__cycle()
+            self.mbuf = 0
+            self.nbuf = 32
+            while self.nbuf != 0 and n != 0:
+                if decrypt:
+                    buffer[i] ^= (self.sbuf >> (32 - self.nbuf)) & 0xff
+                    self.mbuf ^= buffer[i] << (32 - self.nbuf)
+                else:
+                    self.mbuf ^= buffer[i] << (32 - self.nbuf)
+                    buffer[i] ^= (self.sbuf >> (32 - self.nbuf)) & 0xff
+                i += 1
+                self.nbuf -= 8
+                n -= 1
+        return bytes(buffer)
+
+    def key(self, key: bytes) -> None:
+        self.__r = [1, 1] + [0] * (self.n - 2)
+        for i in range(2, self.n):
+            self.__r[i] = self.__r[i - 1] + self.__r[i - 2]
+        self.__r_offset = 0
+        self.konst = self.initkonst
+        self.__load_key(key)
+        self.konst = self.__r[self.__r_offset]
+        self.__init_r = self.__logical_r()
+        self.nbuf = 0
+
+    def nonce(self, nonce: typing.Union[bytes, int]) -> None:
+        if type(nonce) is int:
+            nonce = bytes(struct.pack(">I", nonce))
+        self.__r = list(self.__init_r)
+        self.__r_offset = 0
+        self.konst = self.initkonst
+        self.__load_key(nonce)
+        self.konst = self.__r[self.__r_offset]
+        self.nbuf = 0
+
+    def nonce_state(self, nonce: typing.Union[bytes, int]) -> tuple:
+        """
+        Compute the state nonce() would produce without touching this cipher
+        Args:
+            nonce: Nonce to key
+        Returns:
+            Opaque state for load_nonce_state()
+        """
+        scratch = FastShannon()
+        scratch.__init_r = self.__init_r
+        scratch.nonce(nonce)
+        return (scratch.__r, scratch.__r_offset, scratch.__crc,
+                scratch.__crc_offset, scratch.konst)
+
+    def load_nonce_state(self, state: tuple) -> None:
+        """
+        Restore a state computed by nonce_state()
+        Args:
+            state: State returned by nonce_state()
+        """
+        r, r_offset, crc, crc_offset, konst = state
+        self.__r = list(r)
+        self.__r_offset = r_offset
+        self.__crc = list(crc)
+        self.__crc_offset = crc_offset
+        self.konst = konst
+        self.nbuf = 0
+
+    def encrypt(self, buffer: bytes, n: int = None) -> bytes:
+        return self.__crypt(buffer, n, False)
+
+    def decrypt(self, buffer: bytes, n: int = None) -> bytes:
+        return self.__crypt(buffer, n, True)
+
+    def finish(self, n: int) -> bytes:
+        buffer = bytearray(4)
+        i = 0
+        if self.nbuf != 0:
+            self.__mac_func(self.mbuf)
+        self.__cycle()
+        self.__r[(self.__r_offset + self.keyp) & 15] ^= \
+            self.initkonst ^ (self.nbuf << 3)
+        self.nbuf = 0
+        self.__xor_crc()
+        self.__diffuse()
+        while n > 0:
+            self.__cycle()
+            if n >= 4:
+                struct.pack_into("<I", buffer, i, self.sbuf)
+                n -= 4
+                i += 4
+            else:
+                for j in range(n):
+                    buffer[i + j] = (self.sbuf >> (i * 8)) & 0xff
+                break
+        return bytes(buffer)
@@ -1,15 +1,21 @@
 from __future__ import annotations
 from librespot import util
+from librespot.cache import ResponseCache
 from librespot.crypto import Packet
 from librespot.proto import Mercury_pb2 as Mercury, Pubsub_pb2 as Pubsub
 from librespot.structure import Closeable, PacketsReceiver, SubListener
 from requests.structures import CaseInsensitiveDict
+import asyncio
+import concurrent.futures
+import functools
 import io
 import json
 import logging
+import os
 import queue
 import struct
 import threading
+import time
 import typing
 
 if typing.TYPE_CHECKING:
@@ -26,24 +32,59 @@ class JsonMercuryRequest:
 class MercuryClient(Closeable, PacketsReceiver):
     logger = logging.getLogger("Librespot:MercuryClient")
     mercury_request_timeout = 3
-    __callbacks: typing.Dict[int, Callback] = {}
-    __remove_callback_lock = threading.Condition()
-    __partials: typing.Dict[int, typing.List[bytes]] = {}
-    __seq_holder = 0
-    __seq_holder_lock = threading.Condition()
+    replayable_methods = ("GET", "SUB")
+    __cache: typing.Union[ResponseCache, None]
+    __callbacks: typing.Dict[int, Callback]
+    __remove_callback_lock: threading.Condition
+    __partials: typing.Dict[int, typing.List[bytes]]
+    __seq_holder: int
+    __seq_holder_lock: threading.Condition
     __session: Session
-    __subscriptions: typing.List[InternalSubListener] = []
-    __subscriptions_lock = threading.Condition()
+    __subscriptions: util.PrefixRouter
 
     def __init__(self, session: Session):
+        conf = session.configuration()
+        self.__cache = None
+        if conf.mercury_cache_size > 0:
+            self.__cache = ResponseCache(
+                conf.mercury_cache_size,
+                os.path.join(conf.cache_dir, "mercury")
+                if conf.cache_enabled else None,
+                conf.mercury_cache_disk_size)
+        self.__callbacks = {}
+        self.__remove_callback_lock = threading.Condition()
+        self.__partials = {}
+        self.__seq_holder = 0
+        self.__seq_holder_lock = threading.Condition()
         self.__session = session
+        self.__subscriptions = util.PrefixRouter()
+
+    def cache(self) -> typing.Union[ResponseCache, None]:
+        """
+        The GET response cache, None unless it's enabled
+        """
+        return self.__cache
+
+    def discard_partials(self, seqs: typing.Iterable[int]) -> None:
+        """
+        Drop the parts received so far for the given sequence numbers
+
+        Used before requests are sent again on a new connection, so that
+        parts from the old one aren't joined with the new response.
+
+        Args:
+            seqs: Sequence numbers of the requests sent again
+        """
+        for seq in seqs:
+            self.__partials.pop(seq, None)
 
     def close(self) -> None:
         """
         Close the MercuryClient instance
         """
-        if len(self.__subscriptions) != 0:
-            for listener in self.__subscriptions:
+        subscriptions = self.__subscriptions.values()
+        if len(subscriptions) != 0:
+            for listener in subscriptions:
                 if listener.is_sub:
                     self.unsubscribe(listener.uri)
                 else:
@@ -51,47 +92,56 @@ class MercuryClient(Closeable, PacketsReceiver):
         if len(self.__callbacks) != 0:
             with self.__remove_callback_lock:
                 self.__remove_callback_lock.wait(self.mercury_request_timeout)
-        self.__callbacks.clear()
+        with self.__remove_callback_lock:
+            self.__callbacks.clear()
 
     def dispatch(self, packet: Packet) -> None:
-        payload = io.BytesIO(packet.payload)
-        seq_length = struct.unpack(">H", payload.read(2))[0]
+        payload = memoryview(packet.payload)
+        seq_length = struct.unpack_from(">H", payload)[0]
         if seq_length == 2:
-            seq = struct.unpack(">H", payload.read(2))[0]
+            seq = struct.unpack_from(">H", payload, 2)[0]
         elif seq_length == 4:
-            seq = struct.unpack(">i", payload.read(4))[0]
+            seq = struct.unpack_from(">i", payload, 2)[0]
         elif seq_length == 8:
-            seq = struct.unpack(">q", payload.read(8))[0]
+            seq = struct.unpack_from(">q", payload, 2)[0]
         else:
             raise RuntimeError("Unknown seq length: {}".format(seq_length))
-        flags = payload.read(1)
-        parts = struct.unpack(">H", payload.read(2))[0]
+        offset = 2 + seq_length
+        flags = payload[offset:offset + 1].tobytes()
+        parts = struct.unpack_from(">H", payload, offset + 1)[0]
+        offset += 3
         partial = self.__partials.get(seq)
-        if partial is None or flags == 0:
+        if partial is None or flags == b"\x00":
             partial = []
             self.__partials[seq] = partial
         self.logger.debug(
             "Handling packet, cmd: 0x{}, seq: {}, flags: {}, parts: {}".format(
                 util.bytes_to_hex(packet.cmd), seq, flags, parts))
+        callback = None
+        if not packet.is_cmd(Packet.Type.mercury_event):
+            with self.__remove_callback_lock:
+                callback = self.__callbacks.get(seq)
         for _ in range(parts):
-            size = struct.unpack(">H", payload.read(2))[0]
-            buffer = payload.read(size)
-            partial.append(buffer)
-            self.__partials[seq] = partial
+            size = struct.unpack_from(">H", payload, offset)[0]
+            part = payload[offset + 2:offset + 2 + size]
+            offset += 2 + size
+            if (callback is not None and len(partial) > 0
+                    and callback.part(part)):
+                continue
+            partial.append(part)
         if flags != b"\x01":
             return
         self.__partials.pop(seq)
         header = Mercury.Header()
-        header.ParseFromString(partial[0])
+        header.ParseFromString(bytes(partial[0]))
         response = MercuryClient.Response(header, partial)
         if packet.is_cmd(Packet.Type.mercury_event):
-            dispatched = False
-            with self.__subscriptions_lock:
-                for sub in self.__subscriptions:
-                    if sub.matches(header.uri):
-                        sub.dispatch(response)
-                        dispatched = True
-            if not dispatched:
+            if self.__cache is not None:
+                self.__cache.invalidate(header.uri)
+            subscriptions = self.__subscriptions.match(header.uri)
+            for sub in subscriptions:
+                sub.dispatch(response)
+            if len(subscriptions) == 0:
                 self.logger.debug(
                     "Couldn't dispatch Mercury event seq: {}, uri: {}, code: {}, payload: {}"
                     .format(seq, header.uri, header.status_code,
@@ -99,8 +149,9 @@ class MercuryClient(Closeable, PacketsReceiver):
         elif (packet.is_cmd(Packet.Type.mercury_req)
               or packet.is_cmd(Packet.Type.mercury_sub)
               or packet.is_cmd(Packet.Type.mercury_sub)):
-            callback = self.__callbacks.get(seq)
-            self.__callbacks.pop(seq)
+            self.__session.in_flight().complete(("mercury", seq))
+            with self.__remove_callback_lock:
+                callback = self.__callbacks.pop(seq, None)
             if callback is not None:
                 callback.response(response)
             else:
@@ -115,26 +166,28 @@ class MercuryClient(Closeable, PacketsReceiver):
                     seq, header.uri, header.status_code))
 
     def interested_in(self, uri: str, listener: SubListener) -> None:
-        self.__subscriptions.append(
+        self.__add_subscription(
             MercuryClient.InternalSubListener(uri, listener, False))
 
     def not_interested_in(self, listener: SubListener) -> None:
-        try:
-            for subscription in self.__subscriptions:
-                if subscription.listener is listener:
-                    self.__subscriptions.remove(subscription)
-                    break
-        except ValueError:
-            pass
+        for subscription in self.__subscriptions.values():
+            if subscription.listener is listener:
+                self.__subscriptions.remove_value(subscription)
+                break
 
-    def send(self, request: RawMercuryRequest, callback) -> int:
+    def send(self,
+             request: RawMercuryRequest,
+             callback,
+             timeout: float = None) -> int:
         """
         Send the Mercury request
         Args:
             request: RawMercuryRequest
             callback: Callback function
+            timeout: Seconds the caller waits, defaults to
+                mercury_request_timeout
         Returns:
-            MercuryClient.Response
+            Sequence number of the request
         """
         buffer = io.BytesIO()
         seq: int
@@ -156,36 +209,173 @@ class MercuryClient(Closeable, PacketsReceiver):
             buffer.write(part)
         buffer.seek(0)
         cmd = Packet.Type.for_method(request.header.method)
-        self.__session.send(cmd, buffer.read())
-        self.__callbacks[seq] = callback
+        payload = buffer.read()
+        priority = Packet.Priority.for_method(request.header.method)
+        with self.__remove_callback_lock:
+            self.__callbacks[seq] = callback
+        if request.header.method in self.replayable_methods:
+            self.__session.in_flight().track(
+                ("mercury", seq), cmd, payload,
+                self.mercury_request_timeout if timeout is None else timeout,
+                priority)
+        self.__session.send(cmd, payload, priority)
         return seq
 
-    def send_sync(self, request: RawMercuryRequest) -> Response:
+    def send_async(
+        self,
+        request: RawMercuryRequest,
+        timeout: float = None,
+        on_part: typing.Callable[[memoryview], None] = None
+    ) -> concurrent.futures.Future[MercuryClient.Response]:
+        """
+        Send the Mercury request without waiting for the response
+        Args:
+            request: RawMercuryRequest
+            timeout: Seconds before the future fails with an IOError,
+                defaults to mercury_request_timeout
+            on_part: Called from the receiving thread with each payload
+                part as it arrives, the parts are then not kept in the
+                response
+        Returns:
+            Future of the MercuryClient.Response, cancelling it drops the
+            response
+        """
+        if timeout is None:
+            timeout = self.mercury_request_timeout
+        future = concurrent.futures.Future()
+        transform = None
+        if (self.__cache is not None and on_part is None
+                and request.header.method == "GET"):
+            key = self.__cache_key(request.header)
+            entry = self.__cache.lookup(key)
+            if entry is not None and not entry.expired():
+                future.set_result(self.__cached_response(entry))
+                return future
+            if entry is not None and entry.etag is not None:
+                request = request.with_user_field("If-None-Match", entry.etag)
+            transform = functools.partial(self.__cache_response, key, entry)
+
+        seq = self.send(
+            request, MercuryClient.FutureCallback(future, on_part, transform),
+            timeout)
+        timer = None
+
+        def expire() -> None:
+            self.__drop_callback(seq)
+            util.settle_future(
+                future,
+                exception=IOError(
+                    "Request timeout out, {} passed, yet no response. seq: {}"
+                    .format(timeout, seq)))
+
+        def done(_) -> None:
+            if timer is not None:
+                timer.cancel()
+            if future.cancelled():
+                self.__drop_callback(seq)
+
+        if not future.done():
+            timer = util.TimerWheel.instance().schedule(timeout, expire)
+        future.add_done_callback(done)
+        return future
+
+    async def send_asyncio(self,
+                           request: RawMercuryRequest,
+                           timeout: float = None) -> MercuryClient.Response:
+        """
+        Send the Mercury request from a coroutine
+        Args:
+            request: RawMercuryRequest
+            timeout: Seconds before an IOError is raised
+        Returns:
+            MercuryClient.Response
+        """
+        return await asyncio.wrap_future(self.send_async(request, timeout))
+
+    def send_sync(self,
+                  request: RawMercuryRequest,
+                  timeout: float = None) -> MercuryClient.Response:
         """
         Send the Mercury request
         Args:
             request: RawMercuryRequest
+            timeout: Seconds before an IOError is raised
         Returns:
             MercuryClient.Response
         """
-        callback = MercuryClient.SyncCallback()
-        seq = self.send(request, callback)
+        if timeout is None:
+            timeout = self.mercury_request_timeout
+        future = self.send_async(request, timeout)
         try:
-            response = callback.wait_response()
-            if response is None:
-                raise IOError(
-                    "Request timeout out, {} passed, yet no response. seq: {}".
-                    format(self.mercury_request_timeout, seq))
-            return response
-        except queue.Empty as e:
-            raise IOError(e)
-
-    def send_sync_json(self, request: JsonMercuryRequest) -> typing.Any:
-        response = self.send_sync(request.request)
+            # The timeout timer fails the future first unless it lags
+            return future.result(timeout + 1)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise IOError(
+                "Request timeout out, {} passed, yet no response.".format(
+                    timeout))
+
+    def send_sync_json(self,
+                       request: JsonMercuryRequest,
+                       timeout: float = None) -> typing.Any:
+        response = self.send_sync(request.request, timeout)
         if 200 <= response.status_code < 300:
             return json.loads(response.payload)
         raise MercuryClient.MercuryException(response)
 
+    def __add_subscription(self,
+                           subscription: InternalSubListener) -> None:
+        self.__subscriptions.add(subscription.uri, subscription)
+
+    def __cache_response(
+        self, key: str, entry: typing.Union[ResponseCache.Entry, None],
+        response: MercuryClient.Response
+    ) -> MercuryClient.Response:
+        fields = response.user_fields()
+        policy = fields.get("MC-Cache-Policy", b"").decode().lower()
+        if "no-cache" in policy or "no-store" in policy:
+            return response
+        try:
+            ttl = int(fields.get("MC-TTL", b"0"))
+        except ValueError:
+            ttl = 0
+        etag = fields.get("MC-ETag")
+        etag = None if etag is None else etag.decode()
+        if entry is not None and response.status_code == 304:
+            entry = ResponseCache.Entry(entry.parts, time.time() + ttl,
+                                        etag or entry.etag)
+            self.__cache.revalidate(key, entry)
+            return self.__cached_response(entry)
+        if response.status_code != 200 or (ttl <= 0 and etag is None):
+            return response
+        self.__cache.put(
+            key,
+            ResponseCache.Entry(
+                [response.header.SerializeToString()] +
+                [bytes(part) for part in response.parts],
+                time.time() + ttl, etag))
+        return response
+
+    def __cache_key(self, header: Mercury.Header) -> str:
+        # The disk tier is shared by every account using the cache_dir
+        fields = sorted("{}={}".format(field.key, field.value.hex())
+                        for field in header.user_fields)
+        return "{}\x00{}\x00{}".format(header.uri, self.__session.username(),
+                                       "&".join(fields))
+
+    @staticmethod
+    def __cached_response(
+            entry: ResponseCache.Entry) -> MercuryClient.Response:
+        header = Mercury.Header()
+        header.ParseFromString(entry.parts[0])
+        return MercuryClient.Response(header, entry.parts)
+
+    def __drop_callback(self, seq: int) -> None:
+        self.__session.in_flight().complete(("mercury", seq))
+        with self.__remove_callback_lock:
+            self.__callbacks.pop(seq, None)
+            self.__remove_callback_lock.notify_all()
+
     def subscribe(self, uri: str, listener: SubListener) -> None:
         """
         Subscribe URI
@@ -196,14 +386,15 @@ class MercuryClient(Closeable, PacketsReceiver):
         response = self.send_sync(RawMercuryRequest.sub(uri))
         if response.status_code != 200:
             raise RuntimeError(response)
-        if len(response.payload) > 0:
-            for payload in response.payload:
+        if len(response.parts) > 0:
+            for payload in response.iter_parts():
                 sub = Pubsub.Subscription()
                 sub.ParseFromString(payload)
-                self.__subscriptions.append(
-                    MercuryClient.InternalSubListener(sub.uri, listener, True))
+                self.__add_subscription(
+                    MercuryClient.InternalSubListener(sub.uri, listener,
+                                                      True))
         else:
-            self.__subscriptions.append(
+            self.__add_subscription(
                 MercuryClient.InternalSubListener(uri, listener, True))
         self.logger.debug("Subscribed successfully to {}!".format(uri))
 
@@ -216,16 +407,58 @@ class MercuryClient(Closeable, PacketsReceiver):
         response = self.send_sync(RawMercuryRequest.unsub(uri))
         if response.status_code != 200:
             raise RuntimeError(response)
-        for subscription in self.__subscriptions:
-            if subscription.matches(uri):
-                self.__subscriptions.remove(subscription)
-                break
+        subscriptions = self.__subscriptions.match(uri)
+        if len(subscriptions) > 0:
+            self.__subscriptions.remove_value(subscriptions[0])
         self.logger.debug("Unsubscribed successfully from {}!".format(uri))
 
     class Callback:
+        def part(self, part: memoryview) -> bool:
+            """
+            Offered every payload part as soon as its packet arrives
+            Args:
+                part: View into the packet buffer
+            Returns:
+                True if the part was consumed and mustn't be kept for the
+                response
+            """
+            return False
+
         def response(self, response: MercuryClient.Response) -> None:
             raise NotImplementedError
 
+    class FutureCallback(Callback):
+        __future: concurrent.futures.Future
+        __on_part: typing.Union[typing.Callable[[memoryview], None], None]
+
+        def __init__(
+            self,
+            future: concurrent.futures.Future,
+            on_part: typing.Callable[[memoryview], None] = None,
+            transform: typing.Callable[[MercuryClient.Response],
+                                       MercuryClient.Response] = None):
+            self.__future = future
+            self.__on_part = on_part
+            self.__transform = transform
+
+        def part(self, part: memoryview) -> bool:
+            if self.__on_part is None or self.__future.done():
+                return False
+            try:
+                self.__on_part(part)
+            except Exception as ex:
+                util.settle_future(self.__future, exception=ex)
+            return True
+
+        def response(self, response: MercuryClient.Response) -> None:
+            if self.__transform is not None:
+                try:
+                    response = self.__transform(response)
+                except Exception as ex:
+                    util.settle_future(self.__future, exception=ex)
+                    return
+            util.settle_future(self.__future, response)
+
     class InternalSubListener:
         uri: str
         listener: SubListener
@@ -265,17 +498,49 @@ class MercuryClient(Closeable, PacketsReceiver):
         pass
 
     class Response:
+        header: Mercury.Header
         uri: str
-        payload: bytes
+        parts: typing.List[memoryview]
         status_code: int
+        __payload: typing.Union[bytes, None]
 
-        def __init__(self, header: Mercury.Header, payload: list[bytes]):
+        def __init__(self, header: Mercury.Header,
+                     payload: typing.List[typing.Union[bytes, memoryview]]):
+            self.header = header
             self.uri = header.uri
             self.status_code = header.status_code
-            self.payload = b"".join(payload[1:])
+            self.parts = payload[1:]
+            self.__payload = None
+
+        @property
+        def payload(self) -> bytes:
+            """
+            All the payload parts joined, built on first access
+            """
+            if self.__payload is None:
+                self.__payload = b"".join(self.parts)
+            return self.__payload
+
+        def user_fields(self) -> CaseInsensitiveDict[str, bytes]:
+            """
+            The user fields of the response header
+            """
+            return CaseInsensitiveDict(
+                {field.key: field.value
+                 for field in self.header.user_fields})
+
+        def iter_parts(self) -> typing.Iterator[memoryview]:
+            """
+            Iterate over the payload parts without copying them
+            """
+            for part in self.parts:
+                yield memoryview(part)
 
     class SyncCallback(Callback):
-        __reference = queue.Queue()
+        __reference: queue.Queue
+
+        def __init__(self):
+            self.__reference = queue.Queue()
 
         def response(self, response: MercuryClient.Response) -> None:
             """
@@ -317,6 +582,16 @@ class RawMercuryRequest:
         self.header = header
         self.payload = payload
 
+    def with_user_field(self, key: str, value: str) -> RawMercuryRequest:
+        """
+        Copy of the request with an extra user field
+        """
+        header = Mercury.Header()
+        header.CopyFrom(self.header)
+        header.user_fields.append(
+            Mercury.UserField(key=key, value=value.encode()))
+        return RawMercuryRequest(header, self.payload)
+
     @staticmethod
     def sub(uri: str):
         return RawMercuryRequest.new_builder().set_uri(uri).set_method(
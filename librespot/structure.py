@@ -15,6 +15,9 @@ class AudioDecrypt:
     def decrypt_chunk(self, chunk_index: int, buffer: bytes):
         raise NotImplementedError
 
+    def decrypt_stream(self, chunk_index: int):
+        raise NotImplementedError
+
     def decrypt_time_ms(self):
         raise NotImplementedError
 
@@ -71,6 +74,15 @@ class NoopAudioDecrypt(AudioDecrypt):
     def decrypt_chunk(self, chunk_index: int, buffer: bytes):
         return buffer
 
+    def decrypt_stream(self, chunk_index: int):
+
+        def decrypt(buffer: bytes, output=None):
+            if output is None:
+                return buffer
+            output[:] = buffer
+
+        return decrypt
+
     def decrypt_time_ms(self):
         return 0
 
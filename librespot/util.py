@@ -1,6 +1,13 @@
+from __future__ import annotations
 from Cryptodome import Random
 import binascii
+import bisect
+import concurrent.futures
+import logging
 import math
+import threading
+import time
+import typing
 
 
 def bytes_to_hex(buffer: bytes) -> str:
@@ -32,6 +39,25 @@ def int_to_bytes(i: int):
     return b"\x00" if i == 0 else binascii.unhexlify(fmt % i)
 
 
+def settle_future(future: concurrent.futures.Future,
+                  result: typing.Any = None,
+                  exception: Exception = None) -> None:
+    """
+    Complete the future unless it's already done or cancelled
+    Args:
+        future: Future to complete
+        result: Result, unless exception is given
+        exception: Exception the future fails with
+    """
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except concurrent.futures.InvalidStateError:
+        pass
+
+
 def random_hex_string(length: int):
     buffer = Random.get_random_bytes(int(length / 2))
     return bytes_to_hex(buffer)
@@ -115,3 +141,489 @@ class Base62:
     class CharacterSets:
         gmp = b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
         inverted = b'0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+class Histogram:
+    """
+    Thread-safe histogram of durations with fixed millisecond buckets
+    """
+    buckets = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+    __counts: typing.List[int]
+    __lock: threading.Lock
+    __max: float
+    __sum: float
+
+    def __init__(self):
+        self.__counts = [0] * (len(self.buckets) + 1)
+        self.__lock = threading.Lock()
+        self.__max = 0.0
+        self.__sum = 0.0
+
+    def add(self, value_ms: float) -> None:
+        """
+        Record a duration
+        Args:
+            value_ms: Duration in milliseconds
+        """
+        index = bisect.bisect_left(self.buckets, value_ms)
+        with self.__lock:
+            self.__counts[index] += 1
+            self.__sum += value_ms
+            if value_ms > self.__max:
+                self.__max = value_ms
+
+    def count(self) -> int:
+        return sum(self.__counts)
+
+    def max(self) -> float:
+        return self.__max
+
+    def mean(self) -> float:
+        count = self.count()
+        return 0.0 if count == 0 else self.__sum / count
+
+    def percentile(self, p: float) -> float:
+        """
+        Estimate a percentile as the upper bound of its bucket
+        Args:
+            p: Percentile between 0 and 100
+        Returns:
+            Upper bound in milliseconds, or the maximum for the last bucket
+        """
+        with self.__lock:
+            counts = list(self.__counts)
+        rank = sum(counts) * p / 100
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if count > 0 and seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.__max
+        return 0.0
+
+    def snapshot(self) -> typing.Dict[str, int]:
+        """
+        Return the bucket counts keyed by their upper bound
+        """
+        with self.__lock:
+            counts = list(self.__counts)
+        labels = ["<={}ms".format(b) for b in self.buckets]
+        labels.append(">{}ms".format(self.buckets[-1]))
+        return dict(zip(labels, counts))
+
+    def __str__(self) -> str:
+        return "count: {}, mean: {:.2f}ms, p50: {}ms, p99: {}ms, max: {:.2f}ms".format(
+            self.count(), self.mean(), self.percentile(50),
+            self.percentile(99), self.max())
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel shared by the whole process
+
+    Timers are hashed by their deadline tick into a fixed number of slots,
+    so scheduling and cancelling don't depend on how many timers are
+    outstanding. A single thread advances the wheel and hands due
+    callbacks to a small worker pool. Callbacks that block, such as
+    reconnects and HTTP refreshes, are scheduled with schedule_blocking
+    and run on a pool of their own, so they can't hold up request
+    timeouts.
+    """
+    logger = logging.getLogger("Librespot:TimerWheel")
+    blocking_workers = 8
+    slots = 512
+    tick = 0.05
+    workers = 4
+    __instance: typing.Union[TimerWheel, None] = None
+    __instance_lock = threading.Lock()
+    __blocking_executor: concurrent.futures.ThreadPoolExecutor
+    __closed: bool
+    __current: int
+    __executor: concurrent.futures.ThreadPoolExecutor
+    __lag: Histogram
+    __lock: threading.Condition
+    __outstanding: int
+    __start: float
+    __thread: typing.Union[threading.Thread, None]
+    __wheel: typing.List[typing.List[TimerWheel.Timer]]
+
+    def __init__(self, tick: float = None, slots: int = None):
+        self.tick = self.tick if tick is None else tick
+        self.slots = self.slots if slots is None else slots
+        self.__blocking_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.blocking_workers,
+            thread_name_prefix="timer-wheel-blocking")
+        self.__closed = False
+        self.__current = 0
+        self.__executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="timer-wheel-worker")
+        self.__lag = Histogram()
+        self.__lock = threading.Condition()
+        self.__outstanding = 0
+        self.__start = time.monotonic()
+        self.__thread = None
+        self.__wheel = [[] for _ in range(self.slots)]
+        self.cancelled = 0
+        self.fired = 0
+
+    @staticmethod
+    def instance() -> TimerWheel:
+        """
+        Return the timer wheel shared by the process
+        """
+        with TimerWheel.__instance_lock:
+            if TimerWheel.__instance is None:
+                TimerWheel.__instance = TimerWheel()
+            return TimerWheel.__instance
+
+    def close(self) -> None:
+        """
+        Stop the wheel, outstanding timers never fire
+        """
+        with self.__lock:
+            self.__closed = True
+            self.__wheel = [[] for _ in range(self.slots)]
+            self.__outstanding = 0
+            self.__lock.notify_all()
+        self.__executor.shutdown(wait=False)
+        self.__blocking_executor.shutdown(wait=False)
+
+    def lag(self) -> Histogram:
+        """
+        Delay between the deadline of fired timers and their firing
+        """
+        return self.__lag
+
+    def outstanding(self) -> int:
+        with self.__lock:
+            return self.__outstanding
+
+    def schedule(self, delay: float, callback: typing.Callable,
+                 *args) -> TimerWheel.Timer:
+        """
+        Run a cheap callback after a delay
+        Args:
+            delay: Seconds from now
+            callback: Called with args on a worker thread, mustn't block
+        Returns:
+            Handle that cancels the timer
+        """
+        return self.__schedule(delay, callback, args, False)
+
+    def schedule_blocking(self, delay: float, callback: typing.Callable,
+                          *args) -> TimerWheel.Timer:
+        """
+        Run a callback that may block, e.g. on network I/O, after a delay
+        Args:
+            delay: Seconds from now
+            callback: Called with args on a thread of the blocking pool
+        Returns:
+            Handle that cancels the timer
+        """
+        return self.__schedule(delay, callback, args, True)
+
+    def __schedule(self, delay: float, callback: typing.Callable,
+                   args: tuple, blocking: bool) -> TimerWheel.Timer:
+        deadline = time.monotonic() + max(0.0, delay)
+        timer = TimerWheel.Timer(self, deadline, callback, args, blocking)
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError("TimerWheel is closed!")
+            timer.tick = max(
+                self.__current + 1,
+                math.ceil((deadline - self.__start) / self.tick))
+            self.__wheel[timer.tick % self.slots].append(timer)
+            self.__outstanding += 1
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run,
+                                                 name="timer-wheel",
+                                                 daemon=True)
+                self.__thread.start()
+            elif self.__outstanding == 1:
+                self.__lock.notify()
+        return timer
+
+    def _cancel(self, timer: TimerWheel.Timer) -> bool:
+        with self.__lock:
+            bucket = self.__wheel[timer.tick % self.slots]
+            try:
+                bucket.remove(timer)
+            except ValueError:
+                return False
+            self.__outstanding -= 1
+            self.cancelled += 1
+            return True
+
+    def __advance(self, target: int) -> typing.List[TimerWheel.Timer]:
+        due = []
+        ticks = range(self.__current + 1, target + 1)
+        if len(ticks) > self.slots:
+            ticks = range(target - self.slots + 1, target + 1)
+        for tick in ticks:
+            bucket = self.__wheel[tick % self.slots]
+            if len(bucket) == 0:
+                continue
+            remaining = []
+            for timer in bucket:
+                (due if timer.tick <= target else remaining).append(timer)
+            self.__wheel[tick % self.slots] = remaining
+        self.__current = target
+        self.__outstanding -= len(due)
+        return due
+
+    def __fire(self, timer: TimerWheel.Timer) -> None:
+        try:
+            timer.callback(*timer.args)
+        except Exception:
+            self.logger.exception("Timer callback failed: {}".format(
+                timer.callback))
+
+    def __run(self) -> None:
+        while True:
+            with self.__lock:
+                if self.__closed:
+                    return
+                if self.__outstanding == 0:
+                    self.__lock.wait()
+                    self.__current = max(
+                        self.__current,
+                        int((time.monotonic() - self.__start) / self.tick) - 1)
+                    continue
+                next_tick = self.__start + (self.__current + 1) * self.tick
+                wait = next_tick - time.monotonic()
+                if wait > 0:
+                    self.__lock.wait(wait)
+                    continue
+                now = time.monotonic()
+                due = self.__advance(int((now - self.__start) / self.tick))
+            for timer in due:
+                self.__lag.add(max(0.0, now - timer.deadline) * 1000)
+                self.fired += 1
+                executor = (self.__blocking_executor
+                            if timer.blocking else self.__executor)
+                try:
+                    executor.submit(self.__fire, timer)
+                except RuntimeError:
+                    return
+
+    def __str__(self) -> str:
+        return "outstanding: {}, fired: {}, cancelled: {}, lag: {}".format(
+            self.outstanding(), self.fired, self.cancelled, self.__lag)
+
+    class Timer:
+        """
+        Handle of a scheduled callback
+        """
+        args: tuple
+        blocking: bool
+        callback: typing.Callable
+        deadline: float
+        tick: int
+        __wheel: TimerWheel
+
+        def __init__(self,
+                     wheel: TimerWheel,
+                     deadline: float,
+                     callback: typing.Callable,
+                     args: tuple,
+                     blocking: bool = False):
+            self.__wheel = wheel
+            self.args = args
+            self.blocking = blocking
+            self.callback = callback
+            self.deadline = deadline
+            self.tick = 0
+
+        def cancel(self) -> bool:
+            """
+            Cancel the timer
+            Returns:
+                False if it already fired or was cancelled
+            """
+            return self.__wheel._cancel(self)
+
+        def remaining(self) -> float:
+            """
+            Seconds left until the deadline
+            """
+            return max(0.0, self.deadline - time.monotonic())
+
+
+class PrefixRouter:
+    """
+    Prefix trie mapping URI prefixes to values
+
+    match() walks the trie along the URI, so its cost depends on the
+    length of the URI and not on how many prefixes are registered. Writers
+    are serialised by a lock and only ever replace the value tuple of a
+    node, so readers don't need to take it.
+    """
+    __lock: threading.Lock
+    __prefixes: typing.Dict[typing.Any, typing.List[str]]
+    __root: PrefixRouter.Node
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__prefixes = {}
+        self.__root = PrefixRouter.Node()
+
+    def add(self, prefix: str, value: typing.Any) -> None:
+        """
+        Route URIs starting with prefix to value
+        Args:
+            prefix: URI prefix, an empty prefix matches every URI
+            value: Hashable value returned by match()
+        """
+        with self.__lock:
+            node = self.__root
+            for char in prefix:
+                child = node.children.get(char)
+                if child is None:
+                    child = PrefixRouter.Node()
+                    node.children[char] = child
+                node = child
+            node.values = node.values + (value, )
+            self.__prefixes.setdefault(value, []).append(prefix)
+
+    def match(self, uri: str) -> typing.List[typing.Any]:
+        """
+        Find the values of every prefix of the URI
+        Args:
+            uri: URI to route
+        Returns:
+            Values ordered from the shortest prefix to the longest, each
+            value once
+        """
+        node = self.__root
+        matches = list(node.values)
+        for char in uri:
+            node = node.children.get(char)
+            if node is None:
+                break
+            matches.extend(node.values)
+        return list(dict.fromkeys(matches)) if len(matches) > 1 else matches
+
+    def prefixes(self, value: typing.Any) -> typing.List[str]:
+        with self.__lock:
+            return list(self.__prefixes.get(value, []))
+
+    def remove(self, prefix: str, value: typing.Any) -> bool:
+        """
+        Remove one route
+        Returns:
+            False if the route didn't exist
+        """
+        with self.__lock:
+            path = [self.__root]
+            for char in prefix:
+                node = path[-1].children.get(char)
+                if node is None:
+                    return False
+                path.append(node)
+            if value not in path[-1].values:
+                return False
+            values = list(path[-1].values)
+            values.remove(value)
+            path[-1].values = tuple(values)
+            prefixes = self.__prefixes[value]
+            prefixes.remove(prefix)
+            if len(prefixes) == 0:
+                del self.__prefixes[value]
+            for i in range(len(prefix), 0, -1):
+                node = path[i]
+                if len(node.values) > 0 or len(node.children) > 0:
+                    break
+                del path[i - 1].children[prefix[i - 1]]
+            return True
+
+    def remove_value(self, value: typing.Any) -> int:
+        """
+        Remove every route to value
+        Returns:
+            Number of routes removed
+        """
+        removed = 0
+        for prefix in self.prefixes(value):
+            if self.remove(prefix, value):
+                removed += 1
+        return removed
+
+    def values(self) -> typing.List[typing.Any]:
+        with self.__lock:
+            return list(self.__prefixes)
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return sum(len(prefixes) for prefixes in self.__prefixes.values())
+
+    class Node:
+        children: typing.Dict[str, PrefixRouter.Node]
+        values: typing.Tuple[typing.Any, ...]
+
+        def __init__(self):
+            self.children = {}
+            self.values = ()
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls for the same key into a single call
+
+    The first caller for a key runs the function; callers arriving while it
+    runs wait for it and get the same result or exception. Keys are tuples
+    whose first element names the kind of request, coalesced calls are
+    also counted per kind.
+    """
+    calls = 0
+    coalesced = 0
+    __coalesced_by_kind: typing.Dict[typing.Hashable, int]
+    __flights: typing.Dict[typing.Hashable, concurrent.futures.Future]
+    __lock: threading.Lock
+
+    def __init__(self):
+        self.__coalesced_by_kind = {}
+        self.__flights = {}
+        self.__lock = threading.Lock()
+
+    def coalesced_by_kind(self) -> typing.Dict[typing.Hashable, int]:
+        with self.__lock:
+            return dict(self.__coalesced_by_kind)
+
+    def do(self, key: typing.Tuple, function: typing.Callable, *args,
+           **kwargs) -> typing.Any:
+        """
+        Call function unless a call for key is already running
+        Args:
+            key: Normalized identity of the request
+            function: Called with args and kwargs
+        Returns:
+            The result of the call, shared by every waiter
+        """
+        with self.__lock:
+            flight = self.__flights.get(key)
+            if flight is None:
+                flight = concurrent.futures.Future()
+                self.__flights[key] = flight
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                self.__coalesced_by_kind[key[0]] = \
+                    self.__coalesced_by_kind.get(key[0], 0) + 1
+                leader = False
+        if not leader:
+            return flight.result()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as ex:
+            flight.set_exception(ex)
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            with self.__lock:
+                del self.__flights[key]
+
+    def __str__(self) -> str:
+        return "calls: {}, coalesced: {} {}".format(
+            self.calls, self.coalesced, self.coalesced_by_kind())
@@ -0,0 +1,40 @@
+"""Mercury and audio key requests of N sessions against a local AP
+
+Every session gets its own thread issuing requests, answered by the
+in-process stand-in of tests/loopback.py.
+
+Usage: python tests/benchmark_sessions.py [sessions] [requests per session]
+"""
+import concurrent.futures
+import sys
+import time
+
+from loopback import LoopbackSession
+
+from librespot.mercury import RawMercuryRequest
+
+
+def run(session: LoopbackSession, requests: int) -> None:
+    for i in range(requests):
+        session.mercury().send_sync(
+            RawMercuryRequest.get("hm://bench/{}".format(i)), timeout=10)
+        session.audio_key().audio_key(
+            i.to_bytes(16, "big"), i.to_bytes(20, "big"))
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    sessions = [LoopbackSession("s{}".format(i)) for i in range(count)]
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(count) as executor:
+        for future in [
+                executor.submit(run, session, requests)
+                for session in sessions
+        ]:
+            future.result()
+    elapsed = time.perf_counter() - start
+    for session in sessions:
+        session.close()
+    print("{} sessions, {:.0f} requests/s".format(
+        count, 2 * count * requests / elapsed))
@@ -0,0 +1,32 @@
+"""Throughput of Shannon and FastShannon on AP sized packets
+
+Usage: python tests/benchmark_shannon.py [packet size] [packets]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from librespot.crypto import FastShannon, Shannon
+
+
+def run(cipher_class, size: int, packets: int) -> float:
+    cipher = cipher_class()
+    cipher.key(bytes(range(32)))
+    payload = os.urandom(size)
+    start = time.perf_counter()
+    for nonce in range(packets):
+        cipher.nonce(nonce)
+        cipher.encrypt(payload[:3])
+        cipher.encrypt(payload[3:])
+        cipher.finish(4)
+    return size * packets / (time.perf_counter() - start) / 1e6
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 16 * 1024
+    packets = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    for cipher_class in (Shannon, FastShannon):
+        print("{:12} {:.2f} MB/s".format(cipher_class.__name__,
+                                        run(cipher_class, size, packets)))
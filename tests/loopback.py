@@ -0,0 +1,155 @@
+"""In-process stand-in for an access point, for tests and benchmarks
+
+A LoopbackSession offers the parts of Session that MercuryClient and
+AudioKeyManager use. Packets sent through it are answered by a worker
+thread of its own, like the receiver thread of a real session would.
+LoopbackAccessPoint listens on a local port, either accepting connections
+or leaving them unanswered, for tests of how access points are dialled.
+"""
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from librespot.audio import AudioKeyManager
+from librespot.core import Session
+from librespot.crypto import Packet
+from librespot.mercury import MercuryClient
+from librespot.proto import Mercury_pb2 as Mercury
+
+
+class LoopbackAccessPoint:
+    """Local TCP listener standing in for an access point
+
+    A silent access point never completes a handshake: its accept backlog
+    is filled up front, so further connection attempts hang until they
+    time out.
+    """
+
+    def __init__(self, silent: bool = False):
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__socket.bind(("127.0.0.1", 0))
+        self.__socket.listen(0)
+        self.__fillers = []
+        if silent:
+            while True:
+                filler = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                filler.settimeout(0.2)
+                self.__fillers.append(filler)
+                try:
+                    filler.connect(self.__socket.getsockname())
+                except socket.timeout:
+                    break
+
+    def address(self) -> str:
+        return "{}:{}".format(*self.__socket.getsockname())
+
+    def close(self) -> None:
+        for filler in self.__fillers:
+            filler.close()
+        self.__socket.close()
+
+
+class LoopbackSession:
+    """Session whose requests are answered by a local thread
+
+    Mercury requests get a 200 response whose single payload part is the
+    name of the session followed by the URI, with the MC-TTL and MC-ETag
+    user fields when ttl and etag are set. A request whose If-None-Match
+    matches etag gets an empty 304. Audio keys are the first 16 bytes of
+    the name, file id and gid.
+    """
+    etag = None
+    ttl = 0
+
+    def __init__(self,
+                 name: str,
+                 configuration: Session.Configuration = None):
+        self.name = name
+        self.sent = []
+        self.__configuration = (Session.Configuration.Builder().build()
+                                if configuration is None else configuration)
+        self.__in_flight = Session.InFlightRequests()
+        self.__queue = queue.Queue()
+        self.__mercury = MercuryClient(self)
+        self.__audio_key = AudioKeyManager(self)
+        self.__worker = threading.Thread(target=self.__run,
+                                         name="loopback-" + name,
+                                         daemon=True)
+        self.__worker.start()
+
+    def audio_key(self) -> AudioKeyManager:
+        return self.__audio_key
+
+    def close(self) -> None:
+        self.__queue.put(None)
+        self.__worker.join()
+
+    def configuration(self) -> Session.Configuration:
+        return self.__configuration
+
+    def device_id(self) -> str:
+        return "loopback-" + self.name
+
+    def in_flight(self) -> Session.InFlightRequests:
+        return self.__in_flight
+
+    def mercury(self) -> MercuryClient:
+        return self.__mercury
+
+    def send(self,
+             cmd: bytes,
+             payload: bytes,
+             priority: Packet.Priority = None) -> None:
+        self.__queue.put((cmd, payload))
+
+    def username(self) -> str:
+        return self.name
+
+    def __answer_audio_key(self, payload: bytes) -> Packet:
+        file_id, gid, seq = payload[:20], payload[20:36], payload[36:40]
+        key = (self.name.encode() + file_id + gid)[:16]
+        return Packet(Packet.Type.aes_key, seq + key)
+
+    def __answer_mercury(self, cmd: bytes, payload: bytes) -> Packet:
+        seq_length = struct.unpack_from(">H", payload)[0]
+        seq = payload[2:2 + seq_length]
+        header_length = struct.unpack_from(">H", payload, 5 + seq_length)[0]
+        request = Mercury.Header()
+        request.ParseFromString(payload[7 + seq_length:7 + seq_length +
+                                        header_length])
+        fields = {field.key: field.value for field in request.user_fields}
+        header = Mercury.Header(uri=request.uri, status_code=200)
+        if self.ttl > 0:
+            header.user_fields.append(
+                Mercury.UserField(key="MC-TTL", value=str(self.ttl).encode()))
+        if self.etag is not None:
+            header.user_fields.append(
+                Mercury.UserField(key="MC-ETag", value=self.etag.encode()))
+        body = ["{}:{}".format(self.name, request.uri).encode()]
+        if (self.etag is not None
+                and fields.get("If-None-Match") == self.etag.encode()):
+            header.status_code = 304
+            body = []
+        parts = [header.SerializeToString()] + body
+        return Packet(
+            cmd,
+            struct.pack(">H", seq_length) + seq + b"\x01" +
+            struct.pack(">H", len(parts)) +
+            b"".join(struct.pack(">H", len(part)) + part for part in parts))
+
+    def __run(self) -> None:
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            cmd, payload = item
+            self.sent.append(cmd)
+            if cmd == Packet.Type.request_key:
+                self.__audio_key.dispatch(self.__answer_audio_key(payload))
+            else:
+                self.__mercury.dispatch(self.__answer_mercury(cmd, payload))
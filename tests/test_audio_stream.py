@@ -0,0 +1,342 @@
+import gc
+import io
+import logging
+import os
+import threading
+import time
+import unittest
+
+from librespot.audio import AbsChunkedInputStream, CdnManager, StreamId
+from librespot.audio.decrypt import AesAudioDecrypt
+from librespot.audio.storage import ChannelManager
+from librespot.core import Session
+
+CHUNK_SIZE = 4096
+KEY = bytes(range(16))
+
+
+class _Response:
+
+    def __init__(self, data: bytes, start: int, end: int):
+        end = min(end, len(data) - 1)
+        self.status_code = 206
+        self.content = data[start:end + 1]
+        self.headers = {
+            "Content-Range": "bytes {}-{}/{}".format(start, end, len(data))
+        }
+
+    def iter_content(self, chunk_size: int):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self) -> None:
+        pass
+
+
+class _Client:
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.gate = threading.Event()
+        self.gate.set()
+        self.ranges = []
+        self.truncate = 0
+
+    def get(self, url: str, headers: dict, stream: bool = False) -> _Response:
+        self.gate.wait(5)
+        start, end = map(int, headers["Range"][len("bytes="):].split("-"))
+        self.ranges.append((start, end))
+        response = _Response(self.data, start, end)
+        if start > 0 and self.truncate > 0:
+            self.truncate -= 1
+            response.content = response.content[:100]
+        return response
+
+
+class _Session:
+    logger = logging.getLogger("Librespot:test")
+
+    def __init__(self, data: bytes):
+        self.__client = _Client(data)
+        self.__configuration = Session.Configuration.Builder().build()
+
+    def client(self) -> _Client:
+        return self.__client
+
+    def configuration(self) -> Session.Configuration:
+        return self.__configuration
+
+
+class _CdnUrl:
+    url = "https://cdn.invalid/audio"
+
+    def close(self) -> None:
+        pass
+
+
+class AudioStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chunk_size = ChannelManager.chunk_size
+        ChannelManager.chunk_size = CHUNK_SIZE
+        self.plain = os.urandom(2 * CHUNK_SIZE + 1808)
+        encrypted = AesAudioDecrypt(KEY).decrypt_chunk(0, self.plain)
+        self.session = _Session(encrypted)
+
+    def tearDown(self):
+        ChannelManager.chunk_size = self.chunk_size
+
+    def open(self, **kwargs) -> CdnManager.Streamer:
+        return CdnManager.Streamer(
+            self.session, StreamId(file=_FileId()), None, _CdnUrl(), None,
+            AesAudioDecrypt(KEY), None, **kwargs)
+
+    def streams(self):
+        for kwargs in ({}, {
+                "fast_start_size": 300
+        }, {
+                "progressive": True
+        }, {
+                "head": self.plain[:200]
+        }):
+            with self.subTest(**{k: v for k, v in kwargs.items()
+                                 if k != "head"},
+                              head="head" in kwargs):
+                stream = self.open(**kwargs).stream()
+                try:
+                    yield stream
+                finally:
+                    stream.close()
+
+    def test_raw_io_capabilities(self):
+        for stream in self.streams():
+            self.assertTrue(stream.readable())
+            self.assertTrue(stream.seekable())
+            self.assertFalse(stream.writable())
+            self.assertEqual(b"", stream.read(0))
+
+    def test_read_and_tell(self):
+        for stream in self.streams():
+            self.assertEqual(self.plain[:100], stream.read(100))
+            self.assertEqual(100, stream.tell())
+            self.assertEqual(self.plain[100:CHUNK_SIZE + 10],
+                             stream.read(CHUNK_SIZE - 90))
+            self.assertEqual(self.plain[CHUNK_SIZE + 10:], stream.read())
+            self.assertEqual(len(self.plain), stream.tell())
+
+    def test_seek_whence(self):
+        size = len(self.plain)
+        for stream in self.streams():
+            self.assertEqual(144, stream.seek(144))
+            self.assertEqual(self.plain[144:160], stream.read(16))
+            self.assertEqual(size - 10, stream.seek(-10, io.SEEK_END))
+            self.assertEqual(self.plain[-10:], stream.read())
+            self.assertEqual(size - 100, stream.seek(-100, io.SEEK_CUR))
+            self.assertEqual(self.plain[-100:-90], stream.read(10))
+            with self.assertRaises(ValueError):
+                stream.seek(-1)
+            with self.assertRaises(ValueError):
+                stream.seek(0, 3)
+
+    def test_readinto(self):
+        for stream in self.streams():
+            stream.seek(CHUNK_SIZE - 20)
+            buffer = bytearray(50)
+            self.assertEqual(50, stream.readinto(buffer))
+            self.assertEqual(self.plain[CHUNK_SIZE - 20:CHUNK_SIZE + 30],
+                             bytes(buffer))
+
+    def test_eof(self):
+        for stream in self.streams():
+            stream.seek(0, io.SEEK_END)
+            self.assertEqual(b"", stream.read())
+            self.assertEqual(b"", stream.read(5))
+            self.assertEqual(len(self.plain) + 10,
+                             stream.seek(len(self.plain) + 10))
+            self.assertEqual(b"", stream.read(3))
+            self.assertEqual(0, stream.readinto(bytearray(4)))
+
+    def test_buffered_reader(self):
+        for stream in self.streams():
+            reader = io.BufferedReader(stream, buffer_size=1000)
+            self.assertEqual(self.plain[:5000], reader.read(5000))
+            reader.seek(4000)
+            self.assertEqual(self.plain[4000:4010], reader.read(10))
+            self.assertEqual(len(self.plain), reader.seek(0, io.SEEK_END))
+            self.assertEqual(b"", reader.read())
+            reader.seek(0)
+            self.assertEqual(self.plain, reader.read())
+            reader.close()
+            self.assertTrue(stream.closed)
+
+    def test_closed_stream(self):
+        for stream in self.streams():
+            stream.close()
+            self.assertTrue(stream.closed)
+            for operation in (stream.read, stream.readall, stream.tell,
+                              lambda: stream.readinto(bytearray(1)),
+                              lambda: stream.seek(0)):
+                with self.assertRaises(ValueError):
+                    operation()
+            stream.close()
+
+    def test_truncated_chunk_body(self):
+        for progressive in (False, True):
+            with self.subTest(progressive=progressive):
+                self.session.client().truncate = 1
+                stream = self.open(progressive=progressive).stream()
+                stream.seek(CHUNK_SIZE)
+                with self.assertRaises(IOError):
+                    stream.read(200)
+                stream.retry_on_chunk_error = True
+                stream.seek(CHUNK_SIZE)
+                self.assertEqual(self.plain[CHUNK_SIZE:CHUNK_SIZE + 200],
+                                 stream.read(200))
+                stream.close()
+
+    def test_fast_start_fetches_only_the_rest_of_the_first_chunk(self):
+        for progressive in (False, True):
+            with self.subTest(progressive=progressive):
+                self.session.client().ranges.clear()
+                stream = self.open(fast_start_size=300,
+                                   progressive=progressive).stream()
+                self.assertEqual(self.plain[:CHUNK_SIZE],
+                                 stream.read(CHUNK_SIZE))
+                stream.close()
+                self.assertEqual([(0, 299), (300, CHUNK_SIZE - 1)],
+                                 self.session.client().ranges[:2])
+                self.assertNotIn((0, CHUNK_SIZE - 1),
+                                 self.session.client().ranges)
+
+    def test_close_while_opening(self):
+        self.session.client().gate.clear()
+        streamer = self.open(head=self.plain[:200])
+        streamer.stream().close()
+        self.session.client().gate.set()
+        with self.assertRaises(IOError):
+            streamer.wait_ready()
+        self.assertEqual([(0, CHUNK_SIZE - 1)], self.session.client().ranges)
+
+
+class _ChunkedStream:
+    preload_chunk_retries = 2
+
+    def __init__(self, chunks: int):
+        self.requested = []
+        self.retries = [0] * chunks
+        self.__requested_chunks = [False] * chunks
+
+    def chunks(self) -> int:
+        return len(self.__requested_chunks)
+
+    def request_chunk_from_stream(self, index: int) -> None:
+        self.requested.append(index)
+
+    def requested_chunks(self) -> list:
+        return self.__requested_chunks
+
+
+class ReadAheadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = _ChunkedStream(20)
+
+    def test_window_starts_at_min_window(self):
+        read_ahead = AbsChunkedInputStream.ReadAhead(2, 4)
+        read_ahead.advance(self.stream, 0)
+        self.assertEqual([1, 2], self.stream.requested)
+        read_ahead.advance(self.stream, 0)
+        self.assertEqual(2, read_ahead.requests)
+        read_ahead.close()
+
+    def test_stalls_grow_the_window_up_to_max_window(self):
+        read_ahead = AbsChunkedInputStream.ReadAhead(2, 4)
+        for _ in range(10):
+            read_ahead.stall()
+        read_ahead.advance(self.stream, 0)
+        self.assertEqual(4, read_ahead.window)
+        self.assertEqual([1, 2, 3, 4], self.stream.requested)
+        self.assertEqual(10, read_ahead.stalls)
+        read_ahead.close()
+
+    def test_window_stops_at_the_last_chunk(self):
+        read_ahead = AbsChunkedInputStream.ReadAhead(4, 4)
+        read_ahead.advance(self.stream, 17)
+        self.assertEqual([18, 19], self.stream.requested)
+        read_ahead.close()
+
+    def test_memory_budget_shrinks_the_window(self):
+        read_ahead = AbsChunkedInputStream.ReadAhead(1, 4, memory_budget=1)
+        for _ in range(10):
+            read_ahead.stall()
+        read_ahead.advance(self.stream, 0)
+        self.assertEqual(4, read_ahead.window)
+        # The chunks now ahead of the reader exceed the budget
+        read_ahead.advance(self.stream, 1)
+        self.assertEqual(1, read_ahead.window)
+        read_ahead.close()
+
+    def test_seek_restarts_the_window_at_the_new_position(self):
+        read_ahead = AbsChunkedInputStream.ReadAhead(2, 4)
+        read_ahead.advance(self.stream, 0)
+        read_ahead.advance(self.stream, 1)
+        self.stream.requested.clear()
+        read_ahead.advance(self.stream, 10)
+        self.assertEqual([11, 12], self.stream.requested)
+        self.assertEqual(2, read_ahead.window)
+        self.stream.requested.clear()
+        read_ahead.advance(self.stream, 3)
+        self.assertEqual([4, 5], self.stream.requested)
+        read_ahead.close()
+
+
+class _CdnManager:
+    logger = logging.getLogger("Librespot:test")
+
+    def __init__(self):
+        self.refreshes = 0
+
+    def get_audio_url(self, file_id: bytes) -> str:
+        self.refreshes += 1
+        return "https://cdn.invalid/audio?Expires={}".format(
+            int(time.time()) + 3600)
+
+
+class CdnUrlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.refresh_ahead = CdnManager.CdnUrl.refresh_ahead
+        self.refresh_min_interval = CdnManager.CdnUrl.refresh_min_interval
+        # Refresh every 50ms
+        CdnManager.CdnUrl.refresh_ahead = 7200
+        CdnManager.CdnUrl.refresh_min_interval = 0.05
+        self.manager = _CdnManager()
+
+    def tearDown(self):
+        CdnManager.CdnUrl.refresh_ahead = self.refresh_ahead
+        CdnManager.CdnUrl.refresh_min_interval = self.refresh_min_interval
+
+    def test_refreshes_until_closed(self):
+        cdn_url = CdnManager.CdnUrl(self.manager, b"\x01" * 20,
+                                    self.manager.get_audio_url(b""))
+        time.sleep(0.5)
+        cdn_url.close()
+        refreshes = self.manager.refreshes
+        self.assertGreater(refreshes, 2)
+        time.sleep(0.2)
+        self.assertEqual(refreshes, self.manager.refreshes)
+
+    def test_dropped_url_stops_refreshing(self):
+        CdnManager.CdnUrl(self.manager, b"\x01" * 20,
+                          self.manager.get_audio_url(b""))
+        gc.collect()
+        time.sleep(0.3)
+        self.assertEqual(1, self.manager.refreshes)
+
+
+class _FileId:
+    file_id = b"\x01" * 20
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+import os
+import tempfile
+import time
+import unittest
+
+from loopback import LoopbackSession
+
+from librespot.cache import AudioKeyCache, ResponseCache
+from librespot.core import Session
+from librespot.mercury import RawMercuryRequest
+
+
+class AudioKeyCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.key_file = os.path.join(self.directory.name, "audio-keys.key")
+        self.disk_dir = os.path.join(self.directory.name, "audio-keys")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def cache(self, username: str = "user",
+              key_file: str = None) -> AudioKeyCache:
+        return AudioKeyCache(4, 3600, username, self.disk_dir, 10,
+                             key_file or self.key_file)
+
+    def test_disk_entries_survive_a_new_instance(self):
+        self.cache().put(b"g", b"f", b"k" * 16)
+        cache = self.cache()
+        self.assertEqual(b"k" * 16, cache.get(b"g", b"f"))
+        self.assertEqual(1, cache.disk_hits)
+        self.assertEqual(0o600, os.stat(self.key_file).st_mode & 0o777)
+
+    def test_disk_entries_need_the_same_secret(self):
+        self.cache().put(b"g", b"f", b"k" * 16)
+        self.assertIsNone(self.cache(username="other").get(b"g", b"f"))
+        other_key_file = os.path.join(self.directory.name, "other.key")
+        self.assertIsNone(
+            self.cache(key_file=other_key_file).get(b"g", b"f"))
+
+    def test_memory_only_without_key_file(self):
+        cache = AudioKeyCache(4, 3600, "user", self.disk_dir, 10)
+        cache.put(b"g", b"f", b"k" * 16)
+        self.assertEqual(b"k" * 16, cache.get(b"g", b"f"))
+        self.assertFalse(os.path.exists(self.disk_dir))
+
+    def test_memory_only_without_stored_credentials_file(self):
+        configuration = Session.Configuration.Builder() \
+            .set_cache_dir(self.directory.name) \
+            .set_stored_credential_file(None) \
+            .set_audio_key_cache_size(4) \
+            .set_audio_key_cache_disk_size(10) \
+            .build()
+        session = LoopbackSession("user", configuration)
+        try:
+            self.assertIsNotNone(session.audio_key().cache())
+            session.audio_key().audio_key(bytes(16), bytes(20))
+        finally:
+            session.close()
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory.name, "audio-keys")))
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.disk_dir = os.path.join(self.directory.name, "mercury")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_entries_expire(self):
+        cache = ResponseCache(1024)
+        cache.put("hm://a", ResponseCache.Entry([b"x"], time.time() - 1))
+        cache.put("hm://b", ResponseCache.Entry([b"y"], time.time() + 60))
+        self.assertTrue(cache.lookup("hm://a").expired())
+        self.assertFalse(cache.lookup("hm://b").expired())
+        self.assertIsNone(cache.lookup("hm://c"))
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+    def test_disk_tier_survives_a_new_instance(self):
+        entry = ResponseCache.Entry([b"header", b"body"], time.time() + 60,
+                                    "v1")
+        ResponseCache(1024, self.disk_dir, 4096).put("hm://a", entry)
+        cache = ResponseCache(1024, self.disk_dir, 4096)
+        cached = cache.get("hm://a")
+        self.assertEqual([b"header", b"body"], cached.parts)
+        self.assertEqual("v1", cached.etag)
+        self.assertEqual(1, cache.disk_hits)
+        self.assertEqual(1, cache.invalidate("hm://a"))
+        self.assertIsNone(
+            ResponseCache(1024, self.disk_dir, 4096).get("hm://a"))
+
+    def test_disk_tier_is_capped(self):
+        cache = ResponseCache(1024, self.disk_dir, 300)
+        for i in range(10):
+            cache.put("hm://{}".format(i),
+                      ResponseCache.Entry([bytes(100)], time.time() + 60))
+        self.assertLess(len(os.listdir(self.disk_dir)), 10)
+        self.assertGreater(cache.evictions, 0)
+
+
+class MercuryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sessions = []
+
+    def tearDown(self):
+        for session in self.sessions:
+            session.close()
+        self.directory.cleanup()
+
+    def session(self, name: str = "user") -> LoopbackSession:
+        configuration = Session.Configuration.Builder() \
+            .set_cache_dir(self.directory.name) \
+            .set_mercury_cache_size(4096) \
+            .set_mercury_cache_disk_size(4096) \
+            .build()
+        session = LoopbackSession(name, configuration)
+        self.sessions.append(session)
+        return session
+
+    @staticmethod
+    def get(session: LoopbackSession, uri: str = "hm://test/a") -> bytes:
+        return session.mercury().send_sync(RawMercuryRequest.get(uri),
+                                           timeout=5).payload
+
+    def test_fresh_responses_are_served_from_the_cache(self):
+        session = self.session()
+        session.ttl = 60
+        self.assertEqual(b"user:hm://test/a", self.get(session))
+        self.assertEqual(b"user:hm://test/a", self.get(session))
+        self.assertEqual(1, len(session.sent))
+        self.assertEqual((1, 1), (session.mercury().cache().hits,
+                                  session.mercury().cache().misses))
+
+    def test_expired_responses_are_revalidated_with_their_etag(self):
+        session = self.session()
+        session.etag = "v1"
+        self.assertEqual(b"user:hm://test/a", self.get(session))
+        self.assertEqual(b"user:hm://test/a", self.get(session))
+        self.assertEqual(2, len(session.sent))
+        self.assertEqual(1, session.mercury().cache().revalidations)
+        session.etag = "v2"
+        self.assertEqual(b"user:hm://test/a", self.get(session))
+        self.assertEqual(1, session.mercury().cache().revalidations)
+
+    def test_accounts_sharing_a_cache_dir_are_kept_apart(self):
+        first = self.session("first")
+        first.ttl = 60
+        self.assertEqual(b"first:hm://test/a", self.get(first))
+        second = self.session("second")
+        second.ttl = 60
+        self.assertEqual(b"second:hm://test/a", self.get(second))
+        self.assertEqual(1, len(second.sent))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import threading
+import unittest
+
+from librespot.core import Session
+from librespot.crypto import Packet
+
+
+class PacketDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = Session.PacketDispatcher(4)
+
+    def tearDown(self):
+        self.dispatcher.close()
+
+    def test_handlers_without_lane_run_inline(self):
+        handled = []
+        self.dispatcher.register(Packet.Type.ping, handled.append)
+        packet = Packet(Packet.Type.ping, b"")
+        self.assertTrue(self.dispatcher.dispatch(packet))
+        self.assertEqual([packet], handled)
+
+    def test_order_within_a_lane(self):
+        handled = []
+        done = threading.Event()
+
+        def handle(packet: Packet) -> None:
+            handled.append(packet.payload)
+            if len(handled) == 20:
+                done.set()
+
+        self.dispatcher.register(Packet.Type.mercury_req, handle, "mercury")
+        lane = self.dispatcher.lanes()["mercury"]
+        sent = 0
+        while sent < 20:
+            if lane.depth() < lane.size:
+                self.dispatcher.dispatch(
+                    Packet(Packet.Type.mercury_req, bytes([sent])))
+                sent += 1
+        self.assertTrue(done.wait(5))
+        self.assertEqual([bytes([i]) for i in range(20)], handled)
+        self.assertEqual(0, lane.dropped)
+
+    def test_unhandled_packets_are_counted(self):
+        for _ in range(3):
+            self.assertFalse(
+                self.dispatcher.dispatch(Packet(Packet.Type.pong_ack, b"")))
+        self.dispatcher.dispatch(Packet(Packet.Type.unknown_0x10, b""))
+        self.assertEqual({
+            Packet.Type.pong_ack: 3,
+            Packet.Type.unknown_0x10: 1
+        }, self.dispatcher.unhandled())
+
+    def test_full_lane_drops_packets(self):
+        release = threading.Event()
+        started = threading.Event()
+        handled = []
+
+        def handle(packet: Packet) -> None:
+            started.set()
+            release.wait(5)
+            handled.append(packet.payload)
+
+        self.dispatcher.register(Packet.Type.aes_key, handle, "audio-key")
+        lane = self.dispatcher.lanes()["audio-key"]
+        self.dispatcher.dispatch(Packet(Packet.Type.aes_key, b"\x00"))
+        self.assertTrue(started.wait(5))
+        for i in range(1, 8):
+            self.dispatcher.dispatch(Packet(Packet.Type.aes_key, bytes([i])))
+        self.assertEqual(lane.size, lane.depth())
+        self.assertEqual(3, lane.dropped)
+        self.assertEqual(lane.size, lane.high_water_mark)
+        release.set()
+        lane.close()
+
+    def test_closed_lane_drops_packets(self):
+        lane = Session.PacketDispatcher.Lane("test", 2)
+        lane.close()
+        self.assertFalse(lane.put(lambda _: None, Packet(b"\x00", b"")))
+        self.assertEqual(0, lane.depth())
+
+
+if __name__ == "__main__":
+    unittest.main()
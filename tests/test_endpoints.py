@@ -0,0 +1,105 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from librespot.core import EndpointSelector, Session
+from loopback import LoopbackAccessPoint
+
+
+class EndpointSelectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.directory.name, "endpoints.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @staticmethod
+    def selector(state_file: str = None) -> EndpointSelector:
+        selector = EndpointSelector(state_file)
+        # Rank without probing in the background
+        selector.probe_interval = float("inf")
+        return selector
+
+    def test_rank_by_rtt(self):
+        selector = self.selector()
+        selector.report_success("a:4070", 80)
+        selector.report_success("b:4070", 20)
+        self.assertEqual(["b:4070", "a:4070", "c:4070"],
+                         selector.rank(["a:4070", "b:4070", "c:4070"]))
+
+    def test_rtt_is_smoothed(self):
+        selector = self.selector()
+        selector.report_success("a:4070", 100)
+        selector.report_success("a:4070", 0)
+        self.assertAlmostEqual(100 * (1 - selector.rtt_smoothing),
+                               selector.scores()["a:4070"])
+
+    def test_failures_demote_until_the_penalty_decays(self):
+        selector = self.selector()
+        selector.report_success("a:4070", 20)
+        selector.report_success("b:4070", 80)
+        selector.report_failure("a:4070")
+        self.assertEqual(["b:4070", "a:4070"],
+                         selector.rank(["a:4070", "b:4070"]))
+        selector.penalty_half_life = 1e-6
+        self.assertEqual(["a:4070", "b:4070"],
+                         selector.rank(["a:4070", "b:4070"]))
+
+    def test_scores_survive_a_restart(self):
+        selector = self.selector(self.state_file)
+        selector.report_success("a:4070", 80)
+        selector.report_success("b:4070", 20)
+        self.assertEqual(["b:4070", "a:4070"],
+                         self.selector(self.state_file).rank(
+                             ["a:4070", "b:4070"]))
+
+    def test_concurrent_saves_leave_a_complete_file(self):
+        selector = self.selector(self.state_file)
+        threads = [
+            threading.Thread(target=selector.report_success,
+                             args=("{}:4070".format(i), i))
+            for i in range(16)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with open(self.state_file) as f:
+            self.assertEqual(16, len(json.load(f)))
+        self.assertEqual(["endpoints.json"], os.listdir(self.directory.name))
+
+    def test_scores_are_not_persisted_by_default(self):
+        self.assertIsNone(
+            Session.Configuration.Builder().build().endpoint_state_file)
+
+
+class RaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.silent = LoopbackAccessPoint(silent=True)
+        self.live = LoopbackAccessPoint()
+
+    def tearDown(self):
+        self.silent.close()
+        self.live.close()
+
+    def test_answering_address_wins_the_race(self):
+        selector = EndpointSelector()
+        selector.probe_interval = float("inf")
+        sock, address, _ = Session.ConnectionHolder.race(
+            [self.silent.address(), self.live.address()], 50, 5, selector)
+        sock.close()
+        self.assertEqual(self.live.address(), address)
+        self.assertIn(self.live.address(), selector.scores())
+
+    def test_silent_addresses_time_out(self):
+        with self.assertRaisesRegex(ConnectionError, "timed out"):
+            Session.ConnectionHolder.race([self.silent.address()], 50, 0.3)
+
+
+if __name__ == "__main__":
+    unittest.main()
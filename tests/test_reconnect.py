@@ -0,0 +1,45 @@
+import threading
+import time
+import unittest
+
+from librespot.core import Session
+
+
+class ReconnectTest(unittest.TestCase):
+
+    def setUp(self):
+        # Only the reconnect bookkeeping is exercised, the connection
+        # itself is replaced by a marker object
+        self.session = Session.__new__(Session)
+        self.session._Session__reconnect_lock = threading.RLock()
+        self.session.connection = object()
+        self.reconnects = 0
+
+        def reconnect():
+            self.reconnects += 1
+            time.sleep(0.05)
+            self.session.connection = object()
+
+        self.session._Session__reconnect = reconnect
+
+    def test_same_failed_connection_reconnects_once(self):
+        failed = self.session.connection
+        threads = [
+            threading.Thread(target=self.session.reconnect, args=(failed, ))
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, self.reconnects)
+        self.assertIsNot(failed, self.session.connection)
+
+    def test_unconditional_reconnect(self):
+        self.session.reconnect()
+        self.session.reconnect()
+        self.assertEqual(2, self.reconnects)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import concurrent.futures
+import unittest
+
+from loopback import LoopbackSession
+
+from librespot.mercury import MercuryClient, RawMercuryRequest
+
+
+class SessionIsolationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sessions = [LoopbackSession("s{}".format(i)) for i in range(4)]
+
+    def tearDown(self):
+        for session in self.sessions:
+            session.close()
+
+    def test_sequence_numbers_are_per_session(self):
+        for session in self.sessions:
+            seqs = [
+                session.mercury().send(
+                    RawMercuryRequest.get("hm://test/{}".format(i)),
+                    _NullCallback()) for i in range(3)
+            ]
+            self.assertEqual([0, 1, 2], seqs)
+
+    def test_responses_reach_their_own_session(self):
+
+        def run(session):
+            return [
+                session.mercury().send_sync(
+                    RawMercuryRequest.get("hm://test/{}".format(i)),
+                    timeout=5).payload for i in range(50)
+            ]
+
+        with concurrent.futures.ThreadPoolExecutor(len(
+                self.sessions)) as executor:
+            results = list(executor.map(run, self.sessions))
+        for session, payloads in zip(self.sessions, results):
+            self.assertEqual([
+                "{}:hm://test/{}".format(session.name, i).encode()
+                for i in range(50)
+            ], payloads)
+            self.assertEqual(0, session.in_flight().pending())
+
+    def test_audio_keys_reach_their_own_session(self):
+        gid, file_id = bytes(16), bytes(range(20))
+        for session in self.sessions:
+            key = session.audio_key().audio_key(gid, file_id)
+            self.assertEqual((session.name.encode() + file_id)[:16], key)
+
+
+class _NullCallback(MercuryClient.Callback):
+
+    def response(self, response) -> None:
+        pass
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+import threading
+import time
+import unittest
+
+from librespot import util
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = util.TimerWheel(tick=0.01)
+
+    def tearDown(self):
+        self.wheel.close()
+
+    def test_fires_after_delay(self):
+        fired = threading.Event()
+        start = time.monotonic()
+        self.wheel.schedule(0.05, fired.set)
+        self.assertTrue(fired.wait(2))
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertEqual(1, self.wheel.fired)
+
+    def test_cancel(self):
+        fired = threading.Event()
+        timer = self.wheel.schedule(0.05, fired.set)
+        self.assertTrue(timer.cancel())
+        self.assertFalse(timer.cancel())
+        self.assertFalse(fired.wait(0.2))
+        self.assertEqual(0, self.wheel.outstanding())
+
+    def test_blocking_callbacks_dont_delay_cheap_ones(self):
+        release = threading.Event()
+        fired = threading.Event()
+        for _ in range(self.wheel.workers + 1):
+            self.wheel.schedule_blocking(0, release.wait, 5)
+        self.wheel.schedule(0.02, fired.set)
+        try:
+            self.assertTrue(fired.wait(1))
+        finally:
+            release.set()
+
+
+class PrefixRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = util.PrefixRouter()
+
+    def test_match_orders_shortest_prefix_first(self):
+        self.router.add("hm://remote/", "remote")
+        self.router.add("hm://", "all")
+        self.router.add("hm://remote/user/", "user")
+        self.router.add("hm://pusher/", "pusher")
+        self.assertEqual(["all", "remote", "user"],
+                         self.router.match("hm://remote/user/abc"))
+        self.assertEqual(["all", "remote"],
+                         self.router.match("hm://remote/device"))
+        self.assertEqual([], self.router.match("spotify:track"))
+
+    def test_value_under_several_prefixes_matches_once(self):
+        self.router.add("hm://a", "listener")
+        self.router.add("hm://a/b", "listener")
+        self.router.add("hm://a/b", "other")
+        self.assertEqual(["listener", "other"],
+                         self.router.match("hm://a/b/c"))
+        self.assertEqual(3, len(self.router))
+
+    def test_remove_value(self):
+        self.router.add("hm://a", "listener")
+        self.router.add("hm://a/b", "listener")
+        self.router.add("hm://a/b", "other")
+        self.assertEqual(2, self.router.remove_value("listener"))
+        self.assertEqual(0, self.router.remove_value("listener"))
+        self.assertEqual(["other"], self.router.match("hm://a/b/c"))
+        self.assertEqual(["other"], self.router.values())
+        self.assertFalse(self.router.remove("hm://a", "other"))
+        self.assertTrue(self.router.remove("hm://a/b", "other"))
+        self.assertEqual([], self.router.match("hm://a/b/c"))
+        self.assertEqual(0, len(self.router))
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = util.SingleFlight()
+        self.release = threading.Event()
+
+    def run_concurrently(self, count: int, function) -> list:
+        outcomes = [None] * count
+
+        def call(i: int) -> None:
+            try:
+                outcomes[i] = self.flight.do(("kind", "key"), function)
+            except Exception as ex:
+                outcomes[i] = ex
+
+        threads = [
+            threading.Thread(target=call, args=(i, )) for i in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        # Let every follower join the flight before the leader returns
+        deadline = time.monotonic() + 2
+        while (self.flight.coalesced < count - 1
+               and time.monotonic() < deadline):
+            time.sleep(0.005)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_concurrent_calls_are_merged(self):
+        calls = []
+
+        def function():
+            calls.append(None)
+            self.release.wait(2)
+            return object()
+
+        outcomes = self.run_concurrently(5, function)
+        self.assertEqual(1, len(calls))
+        self.assertIsNotNone(outcomes[0])
+        self.assertEqual(1, len(set(map(id, outcomes))))
+        self.assertEqual(1, self.flight.calls)
+        self.assertEqual({"kind": 4}, self.flight.coalesced_by_kind())
+
+    def test_exception_is_shared(self):
+        error = IOError("failed")
+
+        def function():
+            self.release.wait(2)
+            raise error
+
+        outcomes = self.run_concurrently(3, function)
+        self.assertEqual([error] * 3, outcomes)
+        self.assertEqual(1, self.flight.calls)
+
+    def test_later_calls_run_again(self):
+        self.release.set()
+        self.assertEqual(1, self.flight.do(("kind", ), lambda: 1))
+        self.assertEqual(2, self.flight.do(("kind", ), lambda: 2))
+        self.assertEqual(2, self.flight.calls)
+
+
+if __name__ == "__main__":
+    unittest.main()